@@ -1,47 +1,68 @@
 import sys
+import functools
 from ABXpy.distances import distances
-import ABXpy.distances.metrics.dtw as dtw
-import ABXpy.distances.metrics.cosine as cosine
+from ABXpy.distances import block_distances
+from ABXpy.distances import registry
 import argparse
 import os
-import numpy as np
 import warnings
 
 
-def default_distance(x, y, normalized):
+def default_distance(x, y, normalized, window=None, slope=None):
     """ Dynamic time warping cosine distance
 
     The "feature" dimension is along the columns and the "time" dimension
     along the lines of arrays x and y
+
+    The DTW can be restricted to a Sakoe-Chiba band of half-width window
+    and/or an Itakura parallelogram of maximal slope slope (see
+    ABXpy.distances.metrics.dtw.band_limits)
     """
-    if x.shape[0] > 0 and y.shape[0] > 0:
-        # x and y are not empty
-        d = dtw.dtw(x, y, cosine.cosine_distance,
-                    normalized=normalized)
-    elif x.shape[0] == y.shape[0]:
-        # both x and y are empty
-        d = 0
-    else:
-        # x or y is empty
-        d = np.inf
-    return d
+    return registry.dtw_cosine(x, y, normalized, window=window, slope=slope)
 
 
-def run(features, task, output, normalized, distance=None, j=1, group='features'):
+def run(features, task, output, normalized, distance=None, j=1,
+        group='features', block=False, window=None, slope=None,
+        threads=None, granularity=10, resume=False, cache=None,
+        metric=None):
     j = int(j)
-    if distance:
+    if metric is not None:
+        # the execution path is chosen from the capabilities of the metric
+        distancefun = registry.get_metric(metric)
+    elif distance:
         distancepair = distance.split('.')
         distancemodule = distancepair[0]
         distancefunction = distancepair[1]
         path, mod = os.path.split(distancemodule)
         sys.path.insert(0, path)
         distancefun = getattr(__import__(mod), distancefunction)
+    elif threads is not None:
+        # all the pairs of a block are computed by the dtw extension, in
+        # several threads
+        distancefun = functools.partial(
+            block_distances.dtw_cosine_batch,
+            n_threads=registry.batch_threads(threads, j))
+        block = True
+    elif block:
+        distancefun = block_distances.dtw_cosine_block
     else:
         distancefun = default_distance
+    # band constraints are passed to the distance function only if
+    # specified, so that custom distances do not need to support them
+    band = {}
+    if window is not None:
+        band['window'] = window
+    if slope is not None:
+        band['slope'] = slope
+    if band and metric is not None:
+        distancefun = distancefun.bind(**band)
+    elif band:
+        distancefun = functools.partial(distancefun, **band)
 
     distances.compute_distances(
         features, group, task, output,
-        distancefun, normalized=normalized, n_cpu=j)
+        distancefun, normalized=normalized, n_cpu=j, block=block,
+        granularity=granularity, resume=resume, cache_dir=cache)
 
 
 if __name__ == '__main__':
@@ -62,23 +83,70 @@ if __name__ == '__main__':
         help='distance module to use (distancemodule.distancefunction, '
         'default to dtw cosine distance',
         metavar='distancemodule.distancefunction')
+    parser.add_argument(
+        '-m', '--metric', default=None,
+        choices=sorted(registry.METRICS),
+        help='registered metric to use instead of a distance module, '
+        'computed with the fastest method allowed by its capabilities (see '
+        'ABXpy.distances.registry)')
     parser.add_argument(
         '-j', help='number of cpus to use',
         type=int, default=1)
+    parser.add_argument(
+        '--granularity', type=int, default=10,
+        help='with several cpus, the pairs are divided into about '
+        'GRANULARITY tasks per cpu, handed out to the cpus as they become '
+        'idle, default is %(default)s')
+    parser.add_argument(
+        '--resume', action='store_true',
+        help='if the output file exists, only compute the distances that '
+        'were not computed yet (e.g. after an interruption)')
+    parser.add_argument(
+        '--cache', default=None, metavar='DIR',
+        help='persistent cache of distances in directory DIR: distances '
+        'between items already computed (for any task) with the same '
+        'features, distance and normalization are not recomputed')
     parser.add_argument(
         '-n', '--normalization', type=int, default=None,
         help='if dtw distance selected, compute with normalization or with '
         'sum. If put to 1 : computes with normalization, if put to 0 : '
         'computes with sum. Common choice is to use normalization (-n 1)')
+    parser.add_argument(
+        '-w', '--window', type=float, default=None,
+        help='restrict the dtw to a Sakoe-Chiba band: maximal distance (in '
+        'frames) to the diagonal, or fraction of the length of the longest '
+        'item if smaller than 1 (e.g. -w 0.1). Passed as the window argument '
+        'to custom distances')
+    parser.add_argument(
+        '--itakura', type=float, default=None, metavar='SLOPE',
+        help='restrict the dtw to an Itakura parallelogram of maximal slope '
+        'SLOPE (e.g. --itakura 2). Passed as the slope argument to custom '
+        'distances')
+    parser.add_argument(
+        '--block', action='store_true',
+        help='compute the distances block by block instead of pair by pair: '
+        'the distance function must then be a block distance (see '
+        'ABXpy.distances.block_distances), the default dtw cosine distance is '
+        'computed from large matrix products over the frames of each block')
+    parser.add_argument(
+        '-t', '--threads', type=int, default=None,
+        help='compute the default dtw cosine distance block by block, with '
+        'THREADS threads in each process (0 to share the cpus between the '
+        'processes). '
+        'Combined with -j 1, the features are loaded only once')
 
     args = parser.parse_args()
-    if os.path.exists(args.output):
+    if os.path.exists(args.output) and not(args.resume):
         warnings.warn("Overwriting distance file " + args.output, UserWarning)
         os.remove(args.output)
 
     # if dtw distance selected, fore use of normalization parameter :
-    if (args.distance is None and args.normalization is None):
+    if (args.distance is None and args.normalization is None and
+            args.metric != 'utw_cosine'):
         sys.exit("ERROR : DTW normalization parameter not specified !")
 
     run(args.features, args.task, args.output, normalized=args.normalization,
-        distance=args.distance, j=args.j, group=args.group)
+        distance=args.distance, j=args.j, group=args.group, block=args.block,
+        window=args.window, slope=args.itakura, threads=args.threads,
+        granularity=args.granularity, resume=args.resume,
+        cache=args.cache, metric=args.metric)
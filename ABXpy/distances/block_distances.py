@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+"""
+Distances computed for a whole block of pairs at once.
+
+A block distance is called once for each block of a distance job, as
+block_distance(features, pairs, normalized), where features is a dictionary
+containing the features of the items involved in the block (indexed as in
+the 'by' database) and pairs is a n_pairs by 2 array of item indices. It
+returns an array containing the n_pairs distances.
+
+Working at the level of the block allows sharing per-item computations
+between the pairs and doing the frame-level computations with a few large
+matrix products instead of one small product per pair.
+"""
+
+import numpy as np
+import ABXpy.distances.metrics.cosine as cosine
+import ABXpy.distances.metrics.dtw as dtw
+import ABXpy.distances.metrics.utw as utw
+import ABXpy.distances.metrics.kullback_leibler as kullback_leibler
+
+
+def stack_features(features, items):
+    """Concatenate the frames of several items in a single array
+
+    Returns
+    -------
+    frames : numpy.Array
+        The frames of all the items, one item after the other
+    offsets : numpy.Array
+        Array of size len(items)+1, the frames of items[k] are
+        frames[offsets[k]:offsets[k+1]]
+    """
+    lengths = np.array([features[item].shape[0] for item in items],
+                       dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    frames = np.concatenate([features[item] for item in items], axis=0)
+    return frames, offsets
+
+
+def frame_indices(offsets, items):
+    """Indices of the frames of items in a stacked frame array
+
+    Returns the indices and, for each item, the position of its first frame
+    in these indices
+    """
+    lengths = offsets[items + 1] - offsets[items]
+    local_offsets = np.concatenate([[0], np.cumsum(lengths)])
+    if local_offsets[-1] == 0:
+        return np.empty(0, dtype=np.int64), local_offsets
+    indices = np.arange(local_offsets[-1]) + np.repeat(
+        offsets[items] - local_offsets[:-1], lengths)
+    return indices, local_offsets
+
+
+def dtw_cosine_block(features, pairs, normalized, max_cells=10 ** 7,
+                     window=None, slope=None):
+    """Dynamic time warping cosine distance for a block of pairs
+
+    Gives the same results as ABXpy.distance.default_distance, but the frames
+    of all the items of the block are normalized only once and the
+    frame-by-frame cosine distances of many pairs are obtained from a single
+    matrix product.
+
+    Parameters
+    ----------
+    features : dict
+        features of the items of the block, the "feature" dimension is along
+        the columns and the "time" dimension along the lines
+    pairs : numpy.Array
+        n_pairs by 2 array of items (keys of features)
+    normalized : bool
+        whether the DTW cost is normalized by the length of the path
+    max_cells : int, optional
+        maximum number of frame-by-frame distances computed by a single
+        matrix product, controls the memory used
+    window, slope : optional
+        restrict the DTW to a Sakoe-Chiba band and/or an Itakura
+        parallelogram (see dtw.band_limits)
+
+    Returns
+    -------
+    dis : numpy.Array
+        the distances between the items of each pair
+    """
+    normalized = bool(normalized)
+    dis = np.empty(pairs.shape[0])
+    for p, d in cosine_frame_distances(features, pairs, max_cells):
+        dis[p] = dtw_or_empty(d, normalized, window, slope)
+    return dis
+
+
+def dtw_cosine_batch(features, pairs, normalized, n_threads=0,
+                     window=None, slope=None):
+    """Dynamic time warping cosine distance for a block of pairs
+
+    Gives the same results as ABXpy.distance.default_distance, all the pairs
+    of the block are computed in a single call to dtw.dtw_batch, which
+    releases the GIL and uses n_threads threads (0 for one thread per cpu).
+    """
+    items = np.unique(pairs)
+    frames, offsets = stack_features(features, items)
+    pairs = np.searchsorted(items, pairs)
+    return dtw.dtw_batch(frames, offsets, pairs, 'cosine', bool(normalized),
+                         window=window, slope=slope, n_threads=n_threads)
+
+
+def utw_cosine_block(features, pairs, normalized=None):
+    """Uniform time warping cosine distance for a block of pairs
+
+    The pairs whose items have the same lengths are computed together (see
+    ABXpy.distances.metrics.utw.utw_batch). The UTW cost is not normalized,
+    so the normalized argument is ignored.
+    """
+    return utw.utw_batch([features[a] for a in pairs[:, 0]],
+                         [features[b] for b in pairs[:, 1]],
+                         cosine.cosine_distance_rows)
+
+
+def dtw_prepared_block(features, pairs, normalized, prepare, frame_distance,
+                       window=None, slope=None):
+    """Dynamic time warping for a block of pairs with a preprocessed metric
+
+    prepare is applied only once to the features of each item of the block
+    and frame_distance(prepare(x), prepare(y)) gives the frame-by-frame
+    distances between x and y (e.g. the prepare_* and *_prepared functions
+    of ABXpy.distances.metrics.kullback_leibler).
+    """
+    normalized = bool(normalized)
+    prepared = {}
+    dis = np.empty(pairs.shape[0])
+    for p, (a, b) in enumerate(pairs):
+        n, m = features[a].shape[0], features[b].shape[0]
+        if n > 0 and m > 0:
+            for item in (a, b):
+                if item not in prepared:
+                    prepared[item] = prepare(features[item])
+            d = frame_distance(prepared[a], prepared[b])
+        else:
+            d = np.empty((n, m))
+        dis[p] = dtw_or_empty(d, normalized, window, slope)
+    return dis
+
+
+def dtw_kl_block(features, pairs, normalized, window=None, slope=None):
+    """DTW with the symmetrized, thresholded Kullback-Leibler divergence"""
+    return dtw_prepared_block(features, pairs, normalized,
+                              kullback_leibler.prepare_kl,
+                              kullback_leibler.kl_divergence_prepared,
+                              window, slope)
+
+
+def dtw_js_block(features, pairs, normalized, window=None, slope=None):
+    """DTW with the Jensen-Shannon divergence"""
+    return dtw_prepared_block(features, pairs, normalized,
+                              kullback_leibler.prepare_js,
+                              kullback_leibler.js_divergence_prepared,
+                              window, slope)
+
+
+def dtw_hellinger_block(features, pairs, normalized, window=None, slope=None):
+    """DTW with the Hellinger distance"""
+    return dtw_prepared_block(features, pairs, normalized,
+                              kullback_leibler.prepare_hellinger,
+                              kullback_leibler.hellinger_distance_prepared,
+                              window, slope)
+
+
+def dtw_or_empty(d, normalized, window=None, slope=None):
+    """DTW distance from the frame-by-frame distance matrix d
+
+    Empty items are handled as in ABXpy.distance.default_distance.
+    """
+    n, m = d.shape
+    if n > 0 and m > 0:
+        if window is None and slope is None:
+            return dtw._dtw(n, m, d, normalized)
+        start, stop = dtw.band_limits(n, m, window, slope)
+        return dtw._dtw_band(n, m, d, normalized, start, stop)
+    elif n == m:
+        # both items are empty
+        return 0
+    else:
+        # one item is empty
+        return np.inf
+
+
+def cosine_frame_distances(features, pairs, max_cells=10 ** 7):
+    """Iterate over the frame-by-frame cosine distances of pairs of items
+
+    The frames of all the items are normalized once, then pairs are
+    processed grouped by their second element, as long as the
+    frame-by-frame distance matrix stays below max_cells, so that the
+    distance matrices of all the pairs of a batch are sub-matrices of a
+    single matrix product between the frames of the first elements and the
+    frames of the second elements.
+
+    Yields
+    ------
+    p : int
+        index of a pair in pairs
+    d : numpy.Array
+        the cosine distances between the frames of the elements of pairs[p]
+        (a view on the matrix of the current batch)
+    """
+    items = np.unique(pairs)
+    frames, offsets = stack_features(features, items)
+    frames, null = cosine.normalize_frames(frames)
+    lengths = offsets[1:] - offsets[:-1]
+    # position in items of the elements of each pair
+    i_a = np.searchsorted(items, pairs[:, 0])
+    i_b = np.searchsorted(items, pairs[:, 1])
+    order = np.lexsort((i_a, i_b))
+    in_rows = np.zeros(len(items), dtype=bool)
+    in_cols = np.zeros(len(items), dtype=bool)
+    n_rows, n_cols = 0, 0
+    batch = []
+    for p in order:
+        a, b = i_a[p], i_b[p]
+        new_rows = n_rows if in_rows[a] else n_rows + lengths[a]
+        new_cols = n_cols if in_cols[b] else n_cols + lengths[b]
+        if batch and new_rows * new_cols > max_cells:
+            for res in _cosine_batch(frames, null, offsets, i_a, i_b, batch):
+                yield res
+            in_rows[:] = False
+            in_cols[:] = False
+            batch = []
+            new_rows, new_cols = lengths[a], lengths[b]
+        in_rows[a] = True
+        in_cols[b] = True
+        n_rows, n_cols = new_rows, new_cols
+        batch.append(p)
+    if batch:
+        for res in _cosine_batch(frames, null, offsets, i_a, i_b, batch):
+            yield res
+
+
+def _cosine_batch(frames, null, offsets, i_a, i_b, batch):
+    batch = np.array(batch)
+    rows = np.unique(i_a[batch])
+    cols = np.unique(i_b[batch])
+    row_ind, row_offsets = frame_indices(offsets, rows)
+    col_ind, col_offsets = frame_indices(offsets, cols)
+    d = cosine.cosine_distance_normalized(frames[row_ind], frames[col_ind],
+                                          null[row_ind], null[col_ind])
+    r = np.searchsorted(rows, i_a[batch])
+    c = np.searchsorted(cols, i_b[batch])
+    for p, r_start, r_stop, c_start, c_stop in zip(
+            batch, row_offsets[r], row_offsets[r + 1],
+            col_offsets[c], col_offsets[c + 1]):
+        yield p, d[r_start:r_stop, c_start:c_stop]
+
+
+def dtw_cosine_bounds(features, pairs, normalized):
+    """Lower and upper bounds on the DTW cosine distances of pairs of items
+
+    The bounds are obtained without computing the frame-by-frame distance
+    matrix of the pairs, only the O(N + M) distances along the diagonal
+    path:
+        - the upper bound is the cost of the diagonal path
+        - the lower bound is the largest of the distances of the first and
+          last frames (LB_Kim) and of the sums over the frames of each item
+          of a lower bound of their distance to the closest frame of the
+          other item (LB_Keogh). The frames of an item are contained in the
+          box between the minimum and maximum of their normalized
+          coordinates (its envelope), so the scalar product of a normalized
+          frame with any of them is at most the maximum of this scalar
+          product over the box.
+    When normalized, the lower bound is divided by the maximal length of a
+    path and the upper bound is the normalized cost of the diagonal path.
+
+    Returns
+    -------
+    lower, upper : numpy.Array
+        the bounds of the distance of each pair
+    """
+    normalized = bool(normalized)
+    items = np.unique(pairs)
+    frames, offsets = stack_features(features, items)
+    frames, null = cosine.normalize_frames(frames.astype(np.float64))
+    # envelope of the non null frames of each item, and whether it has null
+    # frames
+    envelopes = []
+    for k in range(len(items)):
+        x_null = null[offsets[k]:offsets[k + 1]]
+        x = frames[offsets[k]:offsets[k + 1]][~x_null]
+        if x.shape[0] == 0:
+            envelope = None
+        else:
+            envelope = np.min(x, axis=0), np.max(x, axis=0)
+        envelopes.append((envelope, np.any(x_null)))
+    lower = np.empty(pairs.shape[0])
+    upper = np.empty(pairs.shape[0])
+    i_a = np.searchsorted(items, pairs[:, 0])
+    i_b = np.searchsorted(items, pairs[:, 1])
+    for p, (a, b) in enumerate(zip(i_a, i_b)):
+        x, x_null = (frames[offsets[a]:offsets[a + 1]],
+                     null[offsets[a]:offsets[a + 1]])
+        y, y_null = (frames[offsets[b]:offsets[b + 1]],
+                     null[offsets[b]:offsets[b + 1]])
+        N, M = x.shape[0], y.shape[0]
+        if N == 0 or M == 0:
+            lower[p] = upper[p] = dtw_or_empty(np.empty((N, M)), normalized)
+            continue
+        # diagonal path: one step along the longest dimension at each frame
+        L = max(N, M)
+        k = np.arange(L)
+        if L == 1:
+            path = cosine.cosine_distance_rows(x, y)
+        else:
+            path = cosine.cosine_distance_rows(x[k * (N - 1) // (L - 1)],
+                                               y[k * (M - 1) // (L - 1)])
+        lower_kim = path[0] if L == 1 else path[0] + path[-1]
+        lower_lines = np.sum(_envelope_bounds(x, x_null,
+                                              *envelopes[b]))
+        lower_cols = np.sum(_envelope_bounds(y, y_null,
+                                             *envelopes[a]))
+        lower[p] = max(lower_kim, lower_lines, lower_cols)
+        upper[p] = np.sum(path)
+        if normalized:
+            lower[p] /= N + M - 1
+            upper[p] /= L
+    return lower, upper
+
+
+def _envelope_bounds(x, x_null, envelope, any_null):
+    # lower bounds of the cosine distances between the normalized frames x
+    # and the closest frame of an item with this envelope and null frames
+    bounds = np.ones(x.shape[0])
+    if envelope is not None:
+        low, high = envelope
+        dot = np.sum(np.maximum(x * low, x * high), axis=1)
+        bounds = np.arccos(np.clip(dot, -1., 1.)) / np.pi
+    # the distance between a null frame and a non null frame is 1
+    bounds[x_null] = 0. if any_null else 1.
+    return bounds
@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent cache of distances between items, shared between tasks.
+
+Distances are stored in a sub-directory of the cache directory named by a
+hash of the contents of the feature files, of the identity of the distance
+function and of the normalization flag, so that a cached distance is only
+reused when it would be computed identically.
+
+Items are identified by their (file, onset, offset) in the 'feat_dbs' of
+the task, hashed to 64 bits, so that the distances computed for a task can
+be reused by any other task defined on the same items (with different
+on/across/by specifications, filters or sampling).
+
+Each process appends the distances it computes to its own entry file,
+so that several processes can add distances concurrently without
+synchronization. When the entry files get too large, they are merged into
+a single file sorted by key (see DistanceCache.compact), which is memory
+mapped instead of being loaded, so that the processes using the cache
+share it through the page cache.
+
+For symmetric metrics (see ABXpy.distances.registry.Metric) computed
+without normalization, the distances are stored and looked up with the
+keys of the two items in increasing order, so that the distance of (a, b)
+is reused for (b, a).
+"""
+
+import fcntl
+import hashlib
+import os
+import uuid
+import numpy as np
+
+
+ENTRY_TYPE = np.dtype([('key', '<u8'), ('a', '<i8'), ('b', '<i8'),
+                       ('distance', '<f8')])
+# multiplier of the hash of a pair of item keys
+PAIR_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+COMPACTED = 'compacted.entries'
+
+
+def file_digest(filename, chunk_size=2 ** 20):
+    """sha1 of the contents of a file"""
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as fh:
+        chunk = fh.read(chunk_size)
+        while chunk:
+            digest.update(chunk)
+            chunk = fh.read(chunk_size)
+    return digest.hexdigest()
+
+
+def distance_identity(distance):
+    """A string identifying a distance function (and its bound arguments)"""
+    if hasattr(distance, 'identity'):
+        # ABXpy.distances.registry.Metric
+        return distance.identity()
+    if hasattr(distance, 'func'):
+        # functools.partial
+        return '{}({}, {})'.format(
+            distance_identity(distance.func), distance.args,
+            sorted((distance.keywords or {}).items()))
+    return '{}.{}'.format(getattr(distance, '__module__', None),
+                          getattr(distance, '__name__', repr(distance)))
+
+
+def item_keys(items):
+    """64 bits hashes of the (file, onset, offset) of a dataframe of items"""
+    keys = np.empty(len(items), dtype=np.int64)
+    for i, (f, on, off) in enumerate(zip(items['file'], items['onset'],
+                                         items['offset'])):
+        name = '{}\0{!r}\0{!r}'.format(f, float(on), float(off))
+        if not(isinstance(name, bytes)):
+            name = name.encode('utf-8')
+        keys[i] = np.frombuffer(hashlib.md5(name).digest()[:8],
+                                dtype='<i8')[0]
+    return keys
+
+
+def pair_keys(keys_a, keys_b):
+    """64 bits hashes of pairs of item keys, by which the entries are sorted
+
+    Different pairs can have the same hash, the entries also contain the
+    item keys.
+    """
+    keys_a = np.asarray(keys_a, dtype=np.int64).view(np.uint64)
+    keys_b = np.asarray(keys_b, dtype=np.int64).view(np.uint64)
+    return keys_a * PAIR_MULTIPLIER + keys_b
+
+
+def read_entries(filename):
+    """The complete entries of an entry file (possibly being written)"""
+    try:
+        with open(filename, 'rb') as fh:
+            data = fh.read()
+    except (IOError, OSError):
+        # removed by a compaction since it was listed
+        return np.empty(0, dtype=ENTRY_TYPE)
+    data = data[:len(data) - len(data) % ENTRY_TYPE.itemsize]
+    return np.frombuffer(data, dtype=ENTRY_TYPE)
+
+
+class DistanceCache(object):
+    """Cache of the distances computed with given features and distance
+
+    Parameters
+    ----------
+    cache_dir : string
+        directory containing the caches of all the feature/distance
+        combinations, created if necessary
+    feature_files, feature_groups : list
+        the h5features files (and groups) containing the features
+    distance : callable or ABXpy.distances.registry.Metric
+        the distance function
+    normalized : bool or None
+        the normalization flag passed to the distance
+    compact_size : int, optional
+        the cache is compacted when it is opened if its entry files contain
+        more than compact_size distances
+    """
+
+    def __init__(self, cache_dir, feature_files, feature_groups, distance,
+                 normalized, compact_size=10 ** 6):
+        key = hashlib.sha1()
+        for feature_file, feature_group in zip(feature_files,
+                                               feature_groups):
+            key.update(file_digest(feature_file).encode('utf-8'))
+            key.update(str(feature_group).encode('utf-8'))
+        key.update(distance_identity(distance).encode('utf-8'))
+        key.update(repr(normalized).encode('utf-8'))
+        self.directory = os.path.join(cache_dir, key.hexdigest())
+        if not(os.path.isdir(self.directory)):
+            os.makedirs(self.directory)
+        # the normalized DTW is not symmetric (see registry.symmetric_block)
+        self.symmetric = (getattr(distance, 'symmetric', False) and
+                          not(normalized))
+        # entry file of the current process
+        self.pid, self.entry_file = None, None
+        self.load()
+        if len(self.recent) > compact_size:
+            self.compact()
+
+    def entry_files(self):
+        """The entry files not compacted yet"""
+        return [os.path.join(self.directory, name)
+                for name in os.listdir(self.directory)
+                if name.endswith('.entries') and name != COMPACTED]
+
+    def load(self):
+        """Map the compacted entries and load the other ones, sorted by key"""
+        compacted = os.path.join(self.directory, COMPACTED)
+        if os.path.exists(compacted) and os.path.getsize(compacted) > 0:
+            self.compacted = np.memmap(compacted, dtype=ENTRY_TYPE, mode='r')
+        else:
+            self.compacted = np.empty(0, dtype=ENTRY_TYPE)
+        entries = [read_entries(name) for name in self.entry_files()]
+        if entries:
+            self.recent = np.concatenate(entries)
+        else:
+            self.recent = np.empty(0, dtype=ENTRY_TYPE)
+        self.recent.sort(order=['key', 'a', 'b'])
+
+    def ordered(self, keys_a, keys_b):
+        """The keys of the pairs in the order of the entries"""
+        keys_a = np.asarray(keys_a, dtype=np.int64)
+        keys_b = np.asarray(keys_b, dtype=np.int64)
+        if self.symmetric:
+            return np.minimum(keys_a, keys_b), np.maximum(keys_a, keys_b)
+        return keys_a, keys_b
+
+    def lookup(self, keys_a, keys_b):
+        """Cached distances between the items of keys_a and keys_b
+
+        Returns
+        -------
+        dis : numpy.Array
+            the distances (NaN where not cached)
+        found : numpy.Array
+            boolean mask of the cached pairs
+        """
+        keys_a, keys_b = self.ordered(keys_a, keys_b)
+        keys = pair_keys(keys_a, keys_b)
+        dis = np.empty(len(keys))
+        dis[:] = np.nan
+        found = np.zeros(len(keys), dtype=bool)
+        for entries in [self.compacted, self.recent]:
+            if len(entries) == 0:
+                continue
+            # binary search in the sorted entries, then check the items in
+            # case of hash collisions (reported as not found)
+            pos = np.minimum(np.searchsorted(entries['key'], keys),
+                             len(entries) - 1)
+            candidates = entries[pos]
+            match = ((candidates['key'] == keys) &
+                     (candidates['a'] == keys_a) &
+                     (candidates['b'] == keys_b))
+            dis[match] = candidates['distance'][match]
+            found |= match
+        return dis, found
+
+    def add(self, keys_a, keys_b, dis):
+        """Append new distances to the entry file of the current process"""
+        if len(dis) == 0:
+            return
+        keys_a, keys_b = self.ordered(keys_a, keys_b)
+        entries = np.empty(len(dis), dtype=ENTRY_TYPE)
+        entries['key'] = pair_keys(keys_a, keys_b)
+        entries['a'] = keys_a
+        entries['b'] = keys_b
+        entries['distance'] = dis
+        if self.pid != os.getpid():
+            # first write of this process (possibly forked from the process
+            # that opened the cache)
+            self.pid = os.getpid()
+            name = os.path.join(self.directory, uuid.uuid4().hex)
+            self.entry_file = open(name + '.tmp', 'ab')
+            # marks the file as being written (see compact), before it can
+            # be seen by a compaction
+            fcntl.flock(self.entry_file, fcntl.LOCK_EX)
+            os.rename(name + '.tmp', name + '.entries')
+        self.entry_file.write(entries.tobytes())
+        self.entry_file.flush()
+
+    def close(self):
+        """Close the entry file of the current process"""
+        if self.pid == os.getpid():
+            self.entry_file.close()
+        self.pid, self.entry_file = None, None
+
+    def compact(self):
+        """Merge the entry files into the sorted compacted file
+
+        Only one process compacts the cache at a time, and the entry files
+        still being written by other processes are left aside. Processes
+        reading the cache during the compaction may miss some distances,
+        which are then computed again.
+        """
+        with open(os.path.join(self.directory, 'lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            merged = []
+            entries = [read_entries(os.path.join(self.directory, COMPACTED))]
+            for name in self.entry_files():
+                try:
+                    fh = open(name, 'rb')
+                    fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except (IOError, OSError):
+                    # being written, or already removed
+                    continue
+                merged.append((name, fh))
+                entries.append(read_entries(name))
+            entries = np.concatenate(entries)
+            entries.sort(order=['key', 'a', 'b'])
+            # remove the distances cached twice
+            if len(entries) > 1:
+                new = np.ones(len(entries), dtype=bool)
+                new[1:] = ((entries['key'][1:] != entries['key'][:-1]) |
+                           (entries['a'][1:] != entries['a'][:-1]) |
+                           (entries['b'][1:] != entries['b'][:-1]))
+                entries = entries[new]
+            tmp = os.path.join(self.directory, uuid.uuid4().hex + '.tmp')
+            entries.tofile(tmp)
+            os.rename(tmp, os.path.join(self.directory, COMPACTED))
+            for name, fh in merged:
+                os.remove(name)
+                fh.close()
+        self.load()
@@ -9,12 +9,19 @@ import h5py
 import numpy as np
 import pandas
 import multiprocessing
+import collections
 import os
-# import time
+import time
 import traceback
 import sys
 import warnings
 import pickle
+import shutil
+import tempfile
+try:
+    import Queue as queue
+except ImportError:
+    import queue
 try:
     import h5features
 except ImportError:
@@ -22,16 +29,21 @@ except ImportError:
         os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(
             os.path.realpath(__file__))))), 'h5features'))
     import h5features
+from ABXpy.distances.feature_store import FeatureStore
+import ABXpy.distances.distance_cache as distance_cache
+import ABXpy.distances.registry as registry
+import ABXpy.distances.telemetry as telemetry
 
 # FIXME Enforce single process usage when using python compiled with OMP
 # enabled
 
-# FIXME detect when multiprocessed jobs crashed
 # FIXME do a separate functions: generic load_balancing
 # FIXME write distances in a separate file
 
 
-def create_distance_jobs(pair_file, distance_file, n_cpu, buffer_max_size=100):
+def create_distance_jobs(pair_file, distance_file, n_cpu, buffer_max_size=100,
+                         feature_files=None, feature_groups=None,
+                         feature_store=None, resume=False):
     """Divide the work load into smaller blocks to be passed to the cpus
 
     Parameters:
@@ -44,6 +56,16 @@ def create_distance_jobs(pair_file, distance_file, n_cpu, buffer_max_size=100):
         number of cpus tu use
     block_ceil_size: int
         maximum size in RAM of a block in Mb
+    feature_files, feature_groups: list, optional
+        h5features files containing the features of the items. If
+        specified, the cost of a distance is estimated as the product of the
+        number of frames of the two items (the cost of a DTW) instead of
+        being considered constant.
+    feature_store: FeatureStore, optional
+        features already loaded in a store, used instead of feature_files
+    resume: bool, optional
+        if distance_file already exists, only the pairs that are not in
+        its table of completed rows are divided into blocks
     """
     # FIXME check (given an optional checking function)
     # that all features required in feat_dbs are indeed present in feature
@@ -54,30 +76,59 @@ def create_distance_jobs(pair_file, distance_file, n_cpu, buffer_max_size=100):
         # by_dsets = [by_dset for by_dset in fh['feat_dbs']]
         by_dsets = fh['bys'][...]
         by_n_pairs = []  # number of distances to be computed for each by db
+        by_first_row = []  # first row of each by db in 'unique_pairs'
         for by_dset in by_dsets:
             attrs = fh['unique_pairs'].attrs[by_dset]
             by_n_pairs.append(attrs[2] - attrs[1])
+            by_first_row.append(attrs[1])
             total_n_pairs = fh['unique_pairs/data'].shape[0]
     # initializing output datasets
     with h5py.File(distance_file) as fh:
-        fh.attrs.create('done', False)
-        g = fh.create_group('distances')
-        g.create_dataset('data', shape=(total_n_pairs, 1), dtype=np.float)
+        if resume and 'distances' in fh:
+            if fh['distances/data'].shape[0] != total_n_pairs:
+                raise ValueError(
+                    'Cannot resume: {} was not computed for task {}'
+                    .format(distance_file, pair_file))
+            if not('completed' in fh['distances']):
+                # distance file from a version without completion tracking
+                n_completed = total_n_pairs if fh.attrs['done'] else 0
+                create_completion_table(fh, n_completed)
+            completed = fh['distances/completed'][...]
+        else:
+            fh.attrs.create('done', False)
+            g = fh.create_group('distances')
+            g.create_dataset('data', shape=(total_n_pairs, 1), dtype=np.float)
+            create_completion_table(fh)
+            completed = np.zeros((0, 2), dtype=np.int64)
     """
     #### Load balancing ####
     Heuristic: each process should have approximately
-    the same number of distances to compute.
-        1 - 'by' blocks bigger than n_pairs/n_proc are divided into blocks
-            of size n_pairs/n_proc + a remainder block
-        2 - iteratively the cpu with the lowest number of distances gets
-            attributed the biggest remaining block
-    This will not be a good heuristic if the average time required to compute
-    a distance varies widely from one 'by' dataset to another or if the i/o
-    time is larger than the time required to compute the distances.
+    the same total cost, where the cost of a distance is the product of the
+    lengths of the items (or 1 if no feature files were given, i.e. each
+    process gets approximately the same number of distances).
+        1 - 'by' blocks costing more than total_cost/n_proc are divided into
+            blocks of cost total_cost/n_proc + a remainder block (blocks
+            are also limited by the size of the buffer used to store the
+            distances)
+        2 - iteratively the cpu with the lowest cost gets
+            attributed the most costly remaining block
+    This will not be a good heuristic if the i/o time is larger than the
+    time required to compute the distances.
     """
+    by_costs = pair_costs(pair_file, by_dsets, feature_files, feature_groups,
+                          feature_store)
+    # rows remaining to be computed in each 'by' dataset
+    by_intervals = [[(sta - first, sto - first) for sta, sto in
+                     missing_rows(completed, first, first + n_pairs)]
+                    for first, n_pairs in zip(by_first_row, by_n_pairs)]
     # step 1
-    by_n_pairs = np.int64(by_n_pairs)
-    total_n_pairs = np.sum(by_n_pairs)
+    by_n_pairs = np.int64([sum(sto - sta for sta, sto in intervals)
+                           for intervals in by_intervals])
+    total_n_pairs = max(np.sum(by_n_pairs), 1)
+    total_cost = np.sum([np.sum(c[sta:sto]) for c, intervals in
+                         zip(by_costs, by_intervals)
+                         for sta, sto in intervals])
+    max_block_cost = total_cost / np.float(n_cpu)
     max_block_size = min(np.int64(np.ceil(total_n_pairs / np.float(n_cpu))),
                          # buffer_max_size * 1000000 / np.dtype(by_n_pairs).itemsize)
                          buffer_max_size * 1000000 / 8)
@@ -85,32 +136,34 @@ def create_distance_jobs(pair_file, distance_file, n_cpu, buffer_max_size=100):
     start = []
     stop = []
     n_dist = []
-    for n_pairs, dset in zip(by_n_pairs, by_dsets):
-        sta = 0
-        sto = 0
-        while n_pairs > 0:
-            if n_pairs > max_block_size:
-                amount = max_block_size
-            else:
-                amount = n_pairs
-            n_pairs = n_pairs - amount
-            sto = sto + amount
-            by.append(dset)
-            start.append(sta)
-            stop.append(sto)
-            n_dist.append(amount)
-            sta = sta + amount
+    cost = []
+    for intervals, dset, costs in zip(by_intervals, by_dsets, by_costs):
+        cum_costs = np.cumsum(costs)
+        for sta, end in intervals:
+            while sta < end:
+                # biggest block starting at sta with a cost of at most
+                # max_block_cost (at least one pair)
+                done = cum_costs[sta - 1] if sta > 0 else 0
+                sto = np.searchsorted(cum_costs, done + max_block_cost,
+                                      side='right')
+                sto = min(max(sto, sta + 1), sta + max_block_size, end)
+                by.append(dset)
+                start.append(sta)
+                stop.append(sto)
+                n_dist.append(sto - sta)
+                cost.append(cum_costs[sto - 1] - done)
+                sta = sto
     # step 2
-    # blocks are sorted according to the number of distances they contain
+    # blocks are sorted according to their cost
     # (in decreasing order, hence the [::-1])
-    order = np.argsort(np.int64(n_dist))[::-1]
+    order = np.argsort(np.array(cost, dtype=np.float64))[::-1]
     # associated cpu for each block in zip(by, start, stop, n_dist)
     cpu = np.zeros(len(by), dtype=np.int64)
-    cpu_loads = np.zeros(n_cpu, dtype=np.int64)
+    cpu_loads = np.zeros(n_cpu, dtype=np.float64)
     for i in order:
         idlest_cpu = np.argmin(cpu_loads)
         cpu[i] = idlest_cpu
-        cpu_loads[idlest_cpu] = cpu_loads[idlest_cpu] + n_dist[i]
+        cpu_loads[idlest_cpu] = cpu_loads[idlest_cpu] + cost[i]
     # output job description for each cpu
     by = np.array(by)  # easier to index...
     start = np.array(start)
@@ -126,6 +179,94 @@ def create_distance_jobs(pair_file, distance_file, n_cpu, buffer_max_size=100):
         jobs.append(job)
     return jobs
 
+def pair_costs(pair_file, by_dsets, feature_files=None, feature_groups=None,
+               feature_store=None):
+    """Estimated cost of each distance to compute
+
+    The cost of a distance is the product of the numbers of frames of the
+    two items (plus one, for empty items), or 1 if neither feature_files
+    nor feature_store are specified.
+
+    Returns
+    -------
+    costs : list
+        for each 'by' dataset in by_dsets, an array containing the cost of
+        each of its pairs (in the order of the 'unique_pairs' dataset)
+    """
+    costs = []
+    if feature_files is None and feature_store is None:
+        with h5py.File(pair_file) as fh:
+            for by in by_dsets:
+                attrs = fh['unique_pairs'].attrs[by]
+                costs.append(np.ones(attrs[2] - attrs[1], dtype=np.int64))
+        return costs
+    if feature_store is None:
+        times, features = load_features(feature_files, feature_groups)
+    else:
+        times, features = feature_store.get_times_and_features()
+    accessor = Features_Accessor(times, features)
+    store = pandas.HDFStore(pair_file)
+    n_frames = [accessor.get_n_frames_from_raw(store['feat_dbs/' + by])
+                for by in by_dsets]
+    store.close()
+    with h5py.File(pair_file) as fh:
+        for by, by_n_frames in zip(by_dsets, n_frames):
+            attrs = fh['unique_pairs'].attrs[by]
+            pair_list = fh['unique_pairs/data'][attrs[1]:attrs[2], 0]
+            base = attrs[0]
+            costs.append(by_n_frames[np.mod(pair_list, base)] *
+                         by_n_frames[pair_list // base] + 1)
+    return costs
+
+
+def create_completion_table(fh, n_completed=0):
+    """Create the table of the completed rows of the distance file fh
+
+    Each line of 'distances/completed' contains the first and last
+    (excluded) rows of a range of distances that have been computed and
+    written (see record_completed). The first n_completed rows are marked
+    as completed.
+    """
+    fh['distances'].create_dataset('completed', shape=(0, 2), dtype=np.int64,
+                                   maxshape=(None, 2))
+    if n_completed:
+        record_completed(fh, 0, n_completed)
+
+
+def record_completed(fh, start, stop):
+    """Mark the rows start to stop of the distance file fh as completed
+
+    Must be called after the distances have been written, so that an
+    interrupted computation can be resumed from the completion table.
+    """
+    table = fh['distances/completed']
+    n = table.shape[0]
+    table.resize((n + 1, 2))
+    table[n, :] = (start, stop)
+    fh.flush()
+
+
+def missing_rows(completed, start, stop):
+    """The sub-intervals of rows [start, stop) not covered by completed
+
+    completed is an array of (start, stop) rows, as in the completion table
+    of a distance file.
+    """
+    intervals = []
+    pos = start
+    for sta, sto in sorted(tuple(c) for c in completed):
+        if sto <= pos:
+            continue
+        if sta >= stop:
+            break
+        if sta > pos:
+            intervals.append((pos, sta))
+        pos = max(pos, sto)
+    if pos < stop:
+        intervals.append((pos, stop))
+    return intervals
+
+
 """
 If there are very large by blocks, two additional
 things could help optimization:
@@ -138,37 +279,66 @@ If there are very small by blocks and i/o become too slow
 could group them into intermediate size h5features files
 """
 
-"""
-This function can be used concurrently by several processes.
-When it is the case synchronization of the writing operations in
-the target distance_file is required by HDF5.
-The current solution uses a global lock for the whole file.
-Since each job is writing in different places, it should in principle be
-possible to do all the write concurrently if ever necessary, using parallel
-HDF5 (based on MPI-IO).
-"""
+def load_features(feature_files, feature_groups):
+    """Read the times and features of several h5features files"""
+    times = {}
+    features = {}
+    for feature_file, feature_group in zip(feature_files, feature_groups):
+        t, f = h5features.read(feature_file, feature_group)
+        assert not(set(times.keys()).intersection(
+            t.keys())), ("The same file is indexed by (at least) two "
+                         "different feature files")
+        times.update(t)
+        features.update(f)
+    return times, features
+
+
+def create_feature_store(feature_files, feature_groups, directory):
+    """Write the features of several h5features files in a FeatureStore
+
+    The feature files are read one at a time, each one being written in its
+    own store in a subdirectory of directory before all the stores are
+    merged (see FeatureStore.merge), so that the features of all the files
+    are never in memory at once.
+    """
+    if len(feature_files) == 1:
+        times, features = load_features(feature_files, feature_groups)
+        return FeatureStore.create(times, features, directory)
+    parts = []
+    for feature_file, feature_group in zip(feature_files, feature_groups):
+        part = os.path.join(directory, 'part_' + str(len(parts)))
+        os.mkdir(part)
+        times, features = load_features([feature_file], [feature_group])
+        parts.append(FeatureStore.create(times, features, part))
+        del times, features
+    feature_store = FeatureStore.merge(parts, directory)
+    del parts
+    for k in range(len(feature_files)):
+        shutil.rmtree(os.path.join(directory, 'part_' + str(k)))
+    return feature_store
+
 
 def run_distance_job(job_description, distance_file, distance,
                      feature_files, feature_groups, splitted_features,
-                     job_id, normalize, distance_file_lock=None):
-    if distance_file_lock is None:
-        synchronize = False
-    else:
-        synchronize = True
+                     job_id, normalize, block=False, cache=None, log=None):
+    """Compute the distances of a job in the calling process
+
+    The distances of each block are written to distance_file and recorded
+    as completed as soon as they are computed (see run_distance_tasks for
+    the computation with several processes).
+    """
+    job_start = time.time()
+    normalize = normalization_flag(normalize)
     if not(splitted_features):
-        times = {}
-        features = {}
-        for feature_file, feature_group in zip(feature_files, feature_groups):
-            t, f = h5features.read(feature_file, feature_group)
-            assert not(set(times.keys()).intersection(
-                t.keys())), ("The same file is indexed by (at least) two "
-                             "different feature files")
-            times.update(t)
-            features.update(f)
+        times, features = load_features(feature_files, feature_groups)
         get_features = Features_Accessor(times, features).get_features_from_raw
+    job_stats = telemetry.block_stats()
+    job_stats['load_time'] = time.time() - job_start
     pair_file = job_description['pair_file']
     n_blocks = len(job_description['by'])
     for b in range(n_blocks):
+        block_start = time.time()
+        stats = telemetry.block_stats()
         print('Job %d: computing distances for block %d on %d' % (job_id, b,
                                                                   n_blocks))
         # get block spec
@@ -179,44 +349,107 @@ def run_distance_job(job_description, distance_file, distance,
             # FIXME modify feature_file/feature_group to adapt to 'by'
             # FIXME any change needed when several feature files before
             # splitting ?
-            times = {}
-            features = {}
-            for feature_file, feature_group in zip(feature_files,
-                                                   feature_groups):
-                t, f = h5features.read(feature_file, feature_group)
-                assert not(set(times.keys()).intersection(
-                    t.keys())), ("The same file is indexed by (at least) two "
-                                 "different feature files")
-                times.update(t)
-                features.update(f)
+            times, features = load_features(feature_files, feature_groups)
             accessor = Features_Accessor(times, features)
             get_features = accessor.get_features_from_splitted
-        # load pandas dataframe containing info for loading the features
-        store = pandas.HDFStore(pair_file)
-        by_db = store['feat_dbs/' + by]
-        store.close()
-        # load pairs to be computed
-        # indexed relatively to the above dataframe
-        with h5py.File(pair_file) as fh:
-            attrs = fh['unique_pairs'].attrs[by]
-            pair_list = fh['unique_pairs/data'][attrs[1]+start:attrs[1]+stop, 0]
-            base = attrs[0]
+            stats['load_time'] += time.time() - block_start
+        rows, dis = compute_block_distances(pair_file, by, start, stop,
+                                            distance, get_features, normalize,
+                                            block, cache, stats)
+        t = time.time()
+        with h5py.File(distance_file) as fh:
+            fh['distances/data'][rows[0]:rows[1], :] = dis
+            record_completed(fh, rows[0], rows[1])
+        stats['write_time'] += time.time() - t
+        for key in stats:
+            job_stats[key] += stats[key]
+        if log is not None:
+            log.record_block(by, rows, time.time() - block_start, stats,
+                             job=job_id)
+    if log is not None:
+        job_stats.update(job=job_id, blocks=n_blocks,
+                         wall_time=time.time() - job_start)
+        log.record('job', **job_stats)
 
-        A = np.mod(pair_list, base)
-        B = pair_list // base
-        pairs = np.column_stack([A, B])
-        n_pairs = pairs.shape[0]
-        # get dataframe with one entry by item involved in this block
-        # indexed by its 'by'-specific index
-        by_inds = np.unique(np.concatenate([A, B]))
-        items = by_db.iloc[by_inds]
-        # get a dictionary whose keys are the 'by' indices
-        features = get_features(items)
-        dis = np.empty(shape=(n_pairs, 1))
-        # FIXME: second dim is 1 because of the way it is stored to disk,
-        # but ultimately it shouldn't be necessary anymore
-        # (if using axis arg in np2h5, h52np and h5io...)
-        for i in range(n_pairs):
+
+def normalization_flag(normalize):
+    """Convert the normalized parameter (None, 1 or 0) to None or a bool"""
+    if normalize is not None:
+        if normalize == 1:
+            normalize = True
+        elif normalize == 0:
+            normalize = False
+        else:
+            print('normalized parameter neither 1 nor 0,'
+                  'using normalization')
+            normalize = True
+    return normalize
+
+
+def compute_block_distances(pair_file, by, start, stop, distance,
+                            get_features, normalize, block=False, cache=None,
+                            stats=None):
+    """Compute the distances of the pairs start to stop of a 'by' block
+
+    If cache is a DistanceCache, the distances already in the cache are not
+    computed, and the new ones are added to the cache.
+
+    If stats is a dictionary (see telemetry.block_stats), the number of
+    pairs computed and found in the cache, the number of DTW cells of the
+    computed pairs and the time spent loading the pairs and the features,
+    computing the distances and using the cache are added to it (writing
+    the distances is timed by the caller).
+
+    Returns
+    -------
+    rows : tuple
+        first and last (excluded) rows of the distances in the
+        'distances/data' dataset of the distance file
+    dis : numpy.Array
+        n_pairs by 1 array containing the distances
+    """
+    t0 = time.time()
+    pairs, items, rows = load_block(pair_file, by, start, stop)
+    n_pairs = pairs.shape[0]
+    dis = np.empty(shape=(n_pairs, 1))
+    # FIXME: second dim is 1 because of the way it is stored to disk,
+    # but ultimately it shouldn't be necessary anymore
+    # (if using axis arg in np2h5, h52np and h5io...)
+    lookup_time, add_time = 0., 0.
+    if cache is None:
+        todo = np.arange(n_pairs)
+    else:
+        t = time.time()
+        keys = pandas.Series(distance_cache.item_keys(items),
+                             index=items.index)
+        keys_a = keys[pairs[:, 0]].values
+        keys_b = keys[pairs[:, 1]].values
+        dis[:, 0], found = cache.lookup(keys_a, keys_b)
+        todo = np.where(~found)[0]
+        # only load the features of the items still needed
+        items = items.loc[np.unique(pairs[todo])]
+        lookup_time = time.time() - t
+    # get a dictionary whose keys are the 'by' indices
+    features = get_features(items)
+    t1 = time.time()
+    if block:
+        for ix in items.index:
+            if features[ix].shape[0] == 0:
+                warnings.warn('No features found for file {}, {} - {}'
+                              .format(items['file'][ix],
+                                      items['onset'][ix],
+                                      items['offset'][ix]),
+                              UserWarning)
+        try:
+            if len(todo) > 0:
+                dis[todo, 0] = distance(features, pairs[todo], normalize)
+        except:
+            sys.stderr.write(
+                'Error when calculating the distances of block {}, pairs {} '
+                'to {}\n'.format(by, start, stop))
+            raise
+    else:
+        for i in todo:
             dataA = features[pairs[i, 0]]
             dataB = features[pairs[i, 1]]
             if dataA.shape[0] == 0:
@@ -232,16 +465,8 @@ def run_distance_job(job_description, distance_file, distance,
                                       items['offset'][pairs[i, 1]]),
                               UserWarning)
             try:
-                if normalize is not None : 
-                    if normalize==1:
-                        normalize=True
-                    elif normalize==0:
-                        normalize=False
-                    else:
-                        print('normalized parameter neither 1 nor 0,'
-                        'using normalization')
-                        normalize=True
-                    dis[i,0] = distance(dataA, dataB, normalized=normalize)
+                if normalize is not None:
+                    dis[i, 0] = distance(dataA, dataB, normalized=normalize)
                 else:
                     dis[i, 0] = distance(dataA, dataB)
             except:
@@ -256,12 +481,56 @@ def run_distance_job(job_description, distance_file, distance,
                             items['offset'][pairs[i, 1]]),
                 )
                 raise
-        if synchronize:
-            distance_file_lock.acquire()
-        with h5py.File(distance_file) as fh:
-            fh['distances/data'][attrs[1]+start:attrs[1]+stop, :] = dis
-        if synchronize:
-            distance_file_lock.release()
+    t2 = time.time()
+    if cache is not None:
+        cache.add(keys_a[todo], keys_b[todo], dis[todo, 0])
+        add_time = time.time() - t2
+    if stats is not None:
+        n_frames = pandas.Series([features[ix].shape[0] for ix in items.index],
+                                 index=items.index, dtype=np.int64)
+        stats['pairs'] += len(todo)
+        stats['cached_pairs'] += n_pairs - len(todo)
+        stats['cells'] += int(np.sum(n_frames[pairs[todo, 0]].values *
+                                     n_frames[pairs[todo, 1]].values))
+        stats['load_time'] += t1 - t0 - lookup_time
+        stats['compute_time'] += t2 - t1
+        stats['cache_time'] += lookup_time + add_time
+    return rows, dis
+
+
+def load_block(pair_file, by, start, stop):
+    """Load the pairs start to stop of a 'by' block and their items
+
+    Returns
+    -------
+    pairs : numpy.Array
+        n_pairs by 2 array of 'by'-specific item indices
+    items : pandas.DataFrame
+        the items involved in the pairs, indexed by their 'by'-specific
+        index
+    rows : tuple
+        first and last (excluded) rows of the pairs in the 'unique_pairs'
+        dataset
+    """
+    # load pandas dataframe containing info for loading the features
+    store = pandas.HDFStore(pair_file)
+    by_db = store['feat_dbs/' + by]
+    store.close()
+    # load pairs to be computed
+    # indexed relatively to the above dataframe
+    with h5py.File(pair_file) as fh:
+        attrs = fh['unique_pairs'].attrs[by]
+        pair_list = fh['unique_pairs/data'][attrs[1]+start:attrs[1]+stop, 0]
+        base = attrs[0]
+
+    A = np.mod(pair_list, base)
+    B = pair_list // base
+    pairs = np.column_stack([A, B])
+    # get dataframe with one entry by item involved in this block
+    # indexed by its 'by'-specific index
+    by_inds = np.unique(np.concatenate([A, B]))
+    items = by_db.iloc[by_inds]
+    return pairs, items, (attrs[1] + start, attrs[1] + stop)
 
 
 # mem in megabytes
@@ -270,12 +539,60 @@ def run_distance_job(job_description, distance_file, distance,
 # get rid of the group in feature file (never used ?)
 def compute_distances(feature_file, feature_group, pair_file, distance_file,
                       distance, normalized, n_cpu=None, mem=1000,
-                      feature_file_as_list=False):
+                      feature_file_as_list=False, block=False, granularity=10,
+                      tmpdir=None, resume=False, cache_dir=None,
+                      metrics=True, split_features=False):
+    """Compute the distances between the pairs of a task
+
+    If block is True, distance is a block distance (see
+    ABXpy.distances.block_distances) called once for each block of pairs,
+    otherwise it is called once for each pair of items. distance can also
+    be a Metric, or the name of a metric, of ABXpy.distances.registry: the
+    distances are then computed block by block with the fastest kernel
+    allowed by the capabilities of the metric (see Metric.block_kernel) and
+    block is ignored.
+
+    When several cpus are used, the pairs are divided into about
+    granularity * n_cpu tasks of similar cost, which are handed out to the
+    cpus as they become idle (see run_distance_tasks). The features are
+    then loaded only once, one feature file at a time, in a FeatureStore
+    written in a temporary directory (created in tmpdir if specified)
+    shared by all the workers (see create_feature_store).
+
+    If split_features is True and the feature files are bigger than mem
+    (the memory available for each cpu, in Mb), the features needed by each
+    task are written in a split feature file, the tasks being divided until
+    their features fit in mem, and the workers only load the features of
+    their current task (see split_feature_file).
+
+    If resume is True and distance_file exists, only the distances that
+    are not recorded as completed in distance_file are computed.
+
+    If cache_dir is specified, distances are looked up in and added to the
+    persistent distance cache in this directory (see
+    ABXpy.distances.distance_cache), so that the distances between items
+    shared by several tasks are computed only once.
+
+    If metrics is True, the timings of the computation are recorded in a
+    JSON-lines file next to distance_file (see telemetry.metrics_file) and
+    their summary is printed at the end.
+    """
     #with h5py.File(distance_file) as fh:
     #    fh.attrs.create('distance', pickle.dumps(distance))
 
     if n_cpu is None:
         n_cpu = multiprocessing.cpu_count()
+    if metrics:
+        log = telemetry.MetricsLog(telemetry.metrics_file(distance_file))
+    else:
+        log = None
+    if isinstance(distance, str):
+        distance = registry.get_metric(distance)
+    if isinstance(distance, registry.Metric):
+        metric = distance
+        distance, block = metric.block_kernel(n_cpu), True
+    else:
+        metric = distance
     if not(feature_file_as_list):
         feature_files = [feature_file]
         feature_groups = [feature_group]
@@ -283,34 +600,308 @@ def compute_distances(feature_file, feature_group, pair_file, distance_file,
         feature_files = feature_file
         feature_groups = feature_group
     # FIXME if there are other datasets in feature_file this is not accurate
+    # (the features are shared by the workers, see FeatureStore)
     mem_needed = 0
     for feature_file in feature_files:
         feature_size = os.path.getsize(feature_file) / float(2 ** 20)
-        mem_needed = feature_size * n_cpu + mem_needed
-    splitted_features = False
-    #splitted_features = mem_needed > mem
-    # if splitted_features:
-    #    split_feature_file(feature_file, feature_group, pair_file)
-    jobs = create_distance_jobs(pair_file, distance_file, n_cpu)
-    # results = []
-    if n_cpu > 1:
-        # use of a manager seems necessary because we're using a Pool...
-        distance_file_lock = multiprocessing.Manager().Lock()
-        pool = multiprocessing.Pool(n_cpu)
-        args = [(job, distance_file, distance, feature_files, feature_groups,
-                 splitted_features, i, normalized, distance_file_lock)
-                for i, job in enumerate(jobs)]
-        pool.map(worker, args)
+        mem_needed = feature_size + mem_needed
+    if cache_dir is None:
+        cache = None
+    else:
+        cache = distance_cache.DistanceCache(
+            cache_dir, feature_files, feature_groups, metric,
+            normalization_flag(normalized))
+    # if the features do not fit in the memory available for each cpu, each
+    # task only loads the features of its items, see split_feature_file
+    splitted_features = split_features and mem_needed > mem
+    if n_cpu > 1 or splitted_features:
+        store_dir = tempfile.mkdtemp(dir=tmpdir)
+        try:
+            setup_start = time.time()
+            feature_store = create_feature_store(feature_files,
+                                                 feature_groups, store_dir)
+            # balance the tasks according to the lengths of the items
+            jobs = create_distance_jobs(pair_file, distance_file,
+                                        n_cpu * granularity,
+                                        feature_store=feature_store,
+                                        resume=resume)
+            tasks = [(job['pair_file'], by, start, stop) for job in jobs
+                     for by, start, stop in zip(job['by'], job['start'],
+                                                job['stop'])]
+            if splitted_features:
+                split_file = os.path.join(store_dir, 'split_features.h5')
+                tasks, groups = split_feature_file(
+                    *feature_store.get_times_and_features(), tasks=tasks,
+                    split_file=split_file, mem=mem)
+                tasks = [task + (group,) for task, group in zip(tasks, groups)]
+            if log is not None:
+                log.record('setup', wall_time=time.time() - setup_start,
+                           tasks=len(tasks))
+            if splitted_features:
+                run_distance_tasks(tasks, distance_file, distance,
+                                   [split_file], None, True, normalized,
+                                   n_cpu, block=block, shard_dir=store_dir,
+                                   cache=cache, log=log)
+            else:
+                run_distance_tasks(tasks, distance_file, distance,
+                                   feature_files, feature_groups, False,
+                                   normalized, n_cpu, block=block,
+                                   feature_store=store_dir,
+                                   shard_dir=store_dir, cache=cache,
+                                   log=log)
+        finally:
+            shutil.rmtree(store_dir)
     else:
+        jobs = create_distance_jobs(pair_file, distance_file, n_cpu,
+                                    resume=resume)
         run_distance_job(jobs[0], distance_file, distance,
-                         feature_files, feature_groups, splitted_features, 1, normalized)
-        with h5py.File(distance_file) as fh:
-            fh.attrs.modify('done', True)
+                         feature_files, feature_groups, splitted_features, 1,
+                         normalized, block=block, cache=cache, log=log)
+    if cache is not None:
+        cache.close()
+    with h5py.File(distance_file) as fh:
+        fh.attrs.modify('done', True)
+    if log is not None:
+        print(log.close(n_cpu=n_cpu, distance_file=distance_file))
+
+
+def run_distance_tasks(tasks, distance_file, distance, feature_files,
+                       feature_groups, splitted_features, normalize, n_cpu,
+                       block=False, max_retries=2, poll_interval=1.,
+                       feature_store=None, shard_dir=None,
+                       checkpoint_interval=600., cache=None, log=None):
+    """Compute the distances of a list of tasks with n_cpu worker processes
+
+    Each task is a (pair_file, by, start, stop) tuple, followed by the group of
+    the split feature file feature_files[0] containing its features if
+    splitted_features is True (see split_feature_file). The tasks are handed
+    out one at a time to the idle workers. Each worker appends the distances it
+    computes to its own shard file in shard_dir (a temporary directory if not
+    specified), without any synchronization, and the calling process merges the
+    shards into distance_file (see merge_distance_shards) every
+    checkpoint_interval seconds and at the end, so that an interrupted
+    computation can be resumed. A worker that dies (e.g. killed by the system)
+    is replaced and its task is handed out again, up to max_retries times. An
+    exception in a worker stops the computation.
+
+    If feature_store is the directory of a FeatureStore, the workers use it
+    instead of loading the feature files. If cache is a DistanceCache, the
+    workers use it (see compute_block_distances). If log is a
+    telemetry.MetricsLog, the timings of each task and of each merge are
+    recorded in it.
+    """
+    if shard_dir is None:
+        shard_dir = tempfile.mkdtemp()
+        remove_shards = True
+    else:
+        remove_shards = False
+    pending = collections.deque(range(len(tasks)))
+    done = np.zeros(len(tasks), dtype=bool)
+    # position of the distances of each completed task in the shards
+    # (since the last checkpoint)
+    parts = []
+    last_checkpoint = time.time()
+    retries = np.zeros(len(tasks), dtype=np.int64)
+    results = multiprocessing.Queue()
+    workers = {}  # worker id -> (process, task queue)
+    running = {}  # worker id -> task being computed by this worker
+    new_id = [0]
+
+    def start_worker():
+        w = new_id[0]
+        new_id[0] += 1
+        task_queue = multiprocessing.Queue()
+        process = multiprocessing.Process(
+            target=distance_worker,
+            args=(w, task_queue, results, distance, feature_files,
+                  feature_groups, splitted_features, normalize, block,
+                  feature_store, os.path.join(shard_dir, 'shard_%d' % w),
+                  cache))
+        process.daemon = True
+        process.start()
+        workers[w] = (process, task_queue)
+        assign(w)
+
+    def assign(w):
+        if pending:
+            i = pending.popleft()
+            running[w] = i
+            workers[w][1].put((i, tasks[i]))
 
+    try:
+        try:
+            for _ in range(min(n_cpu, len(tasks))):
+                start_worker()
+            while not(np.all(done)):
+                try:
+                    message = results.get(timeout=poll_interval)
+                except queue.Empty:
+                    message = None
+                if message is not None:
+                    status, w, i = message[:3]
+                    if status == 'error':
+                        raise RuntimeError(
+                            'Error in distance worker {} (task {}):\n{}'
+                            .format(w, i, message[3]))
+                    rows, offset, wall_time, stats = message[3:]
+                    if not(done[i]):
+                        parts.append((rows[0], rows[1], w, offset))
+                        done[i] = True
+                        if log is not None:
+                            log.record_block(tasks[i][1], rows, wall_time,
+                                             stats, task=i, worker=w)
+                        print('Computed distances for task %d on %d'
+                              % (np.sum(done), len(tasks)))
+                    if time.time() - last_checkpoint > checkpoint_interval:
+                        merge_distance_shards(distance_file, shard_dir,
+                                              parts, log=log)
+                        parts = []
+                        last_checkpoint = time.time()
+                    if running.get(w) == i:
+                        del running[w]
+                        assign(w)
+                # detect dead workers
+                for w in list(workers.keys()):
+                    process = workers[w][0]
+                    if process.is_alive():
+                        continue
+                    del workers[w]
+                    if w in running:
+                        i = running.pop(w)
+                        if not(done[i]):
+                            retries[i] += 1
+                            if retries[i] > max_retries:
+                                raise RuntimeError(
+                                    'Task {} killed {} distance workers'
+                                    .format(i, retries[i]))
+                            sys.stderr.write(
+                                'Distance worker {} died (exit code {}), '
+                                'task {} rescheduled\n'.format(
+                                    w, process.exitcode, i))
+                            pending.appendleft(i)
+                    if pending:
+                        start_worker()
+        finally:
+            for process, task_queue in workers.values():
+                if process.is_alive():
+                    process.terminate()
+                process.join()
+        merge_distance_shards(distance_file, shard_dir, parts, log=log)
+    finally:
+        if remove_shards:
+            shutil.rmtree(shard_dir)
 
-# hack, external function for visibility reasons
-def worker(args):
-    return run_distance_job(*args)
+
+def merge_distance_shards(distance_file, shard_dir, parts,
+                          buffer_size=10 ** 7, log=None):
+    """Copy the distances from the shard files to distance_file
+
+    Parameters
+    ----------
+    parts : list
+        (start, stop, worker_id, offset) tuples: the distances of rows start
+        to stop of the 'distances/data' dataset are stored from position
+        offset in the shard file of worker worker_id
+    buffer_size : int
+        maximal number of distances written at once
+
+    Parts covering contiguous rows are written with a single copy, and
+    then recorded as completed. The merge is timed in log if specified.
+    """
+    merge_start = time.time()
+    shards = {}
+    with h5py.File(distance_file) as fh:
+        dset = fh['distances/data']
+        buf = []
+        buf_start, buf_stop = 0, 0
+        for start, stop, w, offset in sorted(parts):
+            if buf and (start != buf_stop or
+                        stop - buf_start > buffer_size):
+                dset[buf_start:buf_stop, 0] = np.concatenate(buf)
+                record_completed(fh, buf_start, buf_stop)
+                buf = []
+            if not(buf):
+                buf_start = start
+            if w not in shards:
+                shards[w] = np.memmap(os.path.join(shard_dir, 'shard_%d' % w),
+                                      dtype=np.float64, mode='r')
+            buf.append(shards[w][offset:offset + stop - start])
+            buf_stop = stop
+        if buf:
+            dset[buf_start:buf_stop, 0] = np.concatenate(buf)
+            record_completed(fh, buf_start, buf_stop)
+    if log is not None:
+        log.record_merge(time.time() - merge_start,
+                         sum(stop - start for start, stop, _, _ in parts))
+
+
+def distance_worker(worker_id, tasks, results, distance, feature_files,
+                    feature_groups, splitted_features, normalize, block,
+                    feature_store, shard_file, cache=None):
+    """Worker process for run_distance_tasks
+
+    Loads the features once (or attaches to the feature store, or loads the
+    features of each task from a split feature file), then computes the
+    tasks received on the tasks queue until it gets None. The distances
+    are appended to shard_file (raw float64) and their position is sent
+    back on the results queue, along with the timings of the task (see
+    telemetry.block_stats).
+    """
+    i = None
+    worker_start = time.time()
+    try:
+        if splitted_features:
+            # the features are loaded with each task
+            pass
+        elif feature_store is None:
+            times, features = load_features(feature_files, feature_groups)
+            get_features = Features_Accessor(
+                times, features).get_features_from_raw
+        else:
+            times, features = FeatureStore(
+                feature_store).get_times_and_features()
+            get_features = Features_Accessor(
+                times, features).get_features_from_raw
+        normalize = normalization_flag(normalize)
+        # counted in the timings of the first task
+        startup_time = time.time() - worker_start
+        shard = open(shard_file, 'ab')
+        offset = 0
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            i, task = task
+            task_start = time.time()
+            stats = telemetry.block_stats()
+            stats['load_time'] += startup_time
+            startup_time = 0.
+            pair_file, by, start, stop = task[:4]
+            if splitted_features:
+                if task[4] is None:
+                    times, features = {}, {}
+                else:
+                    times, features = load_features(feature_files, [task[4]])
+                get_features = Features_Accessor(
+                    times, features).get_features_from_splitted
+                stats['load_time'] += time.time() - task_start
+            rows, dis = compute_block_distances(pair_file, by, start, stop,
+                                                distance, get_features,
+                                                normalize, block, cache, stats)
+            t = time.time()
+            dis.astype(np.float64).tofile(shard)
+            # the distances must be on disk before the task is marked as
+            # done, in case this process gets killed
+            shard.flush()
+            stats['write_time'] += time.time() - t
+            results.put(('done', worker_id, i, rows, offset,
+                         time.time() - task_start, stats))
+            offset += dis.shape[0]
+        shard.close()
+        if cache is not None:
+            cache.close()
+    except:
+        results.put(('error', worker_id, i, traceback.format_exc()))
 
 
 class Features_Accessor(object):
@@ -318,39 +909,146 @@ class Features_Accessor(object):
     def __init__(self, times, features):
         self.times = times
         self.features = features
+        self.index_files()
+
+    def index_files(self):
+        """Sort the frames of each file by time (once per worker)
+
+        This allows locating the frames of an item by binary search in
+        get_features_from_raw and returning them as a contiguous view
+        instead of scanning the whole file for each item.
+        """
+        for f in self.times:
+            t = self.times[f]
+            if t.shape[0] > 1 and np.any(t[1:] < t[:-1]):
+                order = np.argsort(t, kind='mergesort')
+                self.times[f] = t[order]
+                self.features[f] = self.features[f][order, :]
 
     def get_features_from_raw(self, items):
         features = {}
         for ix, f, on, off in zip(items.index, items['file'],
                                   items['onset'], items['offset']):
-            f=str(f)
-            t = np.where(np.logical_and(self.times[f] >= on,
-                                        self.times[f] <= off))[0]
-            # if len(t) == 0:
+            f = str(f)
+            start, stop = self.get_frame_range(f, on, off)
+            # if start >= stop:
             #     raise IOError('No features found for file {}, at '
             #                   'time {}-{}'.format(f, on, off))
-            features[ix] = self.features[f][t, :]
+            features[ix] = self.features[f][start:stop, :]
         return features
 
+    def get_frame_range(self, f, on, off):
+        """The frames of file f such that on <= t <= off are [start, stop)"""
+        t = self.times[f]
+        start = np.searchsorted(t, on, side='left')
+        stop = np.searchsorted(t, off, side='right')
+        return start, stop
+
+    def get_n_frames_from_raw(self, items):
+        """Number of frames of each item (in the order of items)"""
+        n_frames = np.zeros(len(items), dtype=np.int64)
+        files = np.array([str(f) for f in items['file']])
+        onsets = np.asarray(items['onset'])
+        offsets = np.asarray(items['offset'])
+        for f in np.unique(files):
+            ix = np.where(files == f)[0]
+            t = self.times[f]
+            n_frames[ix] = (np.searchsorted(t, offsets[ix], side='right') -
+                            np.searchsorted(t, onsets[ix], side='left'))
+        return np.maximum(n_frames, 0)
+
     def get_features_from_splitted(self, items):
+        # items without frames are not stored in split files
+        dim = 0
+        for f in self.features:
+            dim = self.features[f].shape[1]
+            break
         features = {}
         for ix, f, on, off in zip(items.index, items['file'],
                                   items['onset'], items['offset']):
-            features[ix] = self.features[f + '_' + str(on) + '_' + str(off)]
+            name = split_item_name(f, on, off)
+            if name in self.features:
+                features[ix] = self.features[name]
+            else:
+                features[ix] = np.empty((0, dim))
         return features
 
-# write split_feature_file, such that it create the appropriate files
-# + check that no filename conflict can occur in:
-# (f + '_' + str(on) + '_' + str(off))
-# -> mem -> mem_by_cpu
-# if not enough mem_by_cpu to load whole dataset:
-# rewrite files of size matching mem_by_cpu using the structure of the jobs
-# do not rewrite items of a by block if not used in considered job
-# only way this can fail is if some (sub-)by blocks contain too many items for
-# being stored in mem_by_cpu
-# do not treat this case for now, but detect it and if it ever happens:
-#   divide items in (items_1, items_2,....)
-#   read items_1, then items_1, items_2, then items_1, items_3...
+
+def split_item_name(f, on, off):
+    """Name of an item in a split feature file
+
+    No conflict can occur since on and off are numbers.
+    """
+    return str(f) + '_' + str(on) + '_' + str(off)
+
+
+def split_feature_file(times, features, tasks, split_file, mem=None):
+    """Write the features needed by each task in a split feature file
+
+    The features of the items involved in task i are written in the group
+    'task_i' of split_file, one h5features 'file' per item (named by
+    split_item_name, the times of the frames are kept), so that a worker
+    only needs to load the features of its current task (with
+    Features_Accessor.get_features_from_splitted).
+
+    Parameters
+    ----------
+    times, features : dict
+        times and features of each file (see load_features)
+    tasks : list
+        the tasks, as (pair_file, by, start, stop) tuples
+    split_file : string
+        h5features file to be created
+    mem : float, optional
+        memory available by cpu in Mb, the tasks whose features are bigger
+        are divided into smaller tasks (a warning is issued for the tasks
+        of a single pair that are still too big)
+
+    Returns
+    -------
+    tasks : list
+        the tasks, after division of the tasks that were too big
+    groups : list
+        the group of split_file containing the features of each task
+        (None if there is no feature to load)
+    """
+    accessor = Features_Accessor(times, features)
+    split_tasks = []
+    groups = []
+    # stack of the tasks to be written, in reverse order
+    pending = list(reversed(tasks))
+    while pending:
+        pair_file, by, start, stop = task = pending.pop()
+        _, items, _ = load_block(pair_file, by, start, stop)
+        frames = []
+        for f, on, off in set(zip(items['file'], items['onset'],
+                                  items['offset'])):
+            f = str(f)
+            sta, sto = accessor.get_frame_range(f, on, off)
+            if sto > sta:
+                frames.append((split_item_name(f, on, off), f, sta, sto))
+        size = sum(accessor.features[f][sta:sto, :].nbytes
+                   for _, f, sta, sto in frames) / float(2 ** 20)
+        if mem is not None and size > mem:
+            if stop - start > 1:
+                middle = (start + stop) // 2
+                pending.append((pair_file, by, middle, stop))
+                pending.append((pair_file, by, start, middle))
+                continue
+            warnings.warn('A pair of task {} needs {:.0f} Mb of features, '
+                          'more than the {} Mb available'.format(
+                              len(split_tasks), size, mem), UserWarning)
+        split_tasks.append(task)
+        if not(frames):
+            groups.append(None)
+            continue
+        groups.append('task_' + str(len(split_tasks) - 1))
+        h5features.write(
+            split_file, groups[-1], [name for name, _, _, _ in frames],
+            [accessor.times[f][sta:sto] for _, f, sta, sto in frames],
+            [accessor.features[f][sta:sto, :] for _, f, sta, sto in frames])
+    return split_tasks, groups
+
 # if this ever proves too slow: could use co-clustering on the big by blocks,
 # use it for the job creation and adopt smarter loading schemes
 
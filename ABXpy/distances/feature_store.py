@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Features stored once in a directory, for several processes.
+
+The frames of all the files are written in a single contiguous array
+(frames.npy, sorted by file and by time within each file), along with their
+times (times.npy) and an offsets table (files.npy and offsets.npy, the
+frames of files[k] are frames[offsets[k]:offsets[k+1]]).
+
+Processes open the store with copy-on-write memory-mapping, so that the
+features are read from disk only once and their pages are shared between all
+the processes of a node (if the directory is on a tmpfs such as /dev/shm,
+they are never written to disk). A process modifying the features only
+modifies its private copy of the corresponding pages.
+"""
+
+import os
+import numpy as np
+
+
+class FeatureStore(object):
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.frames = np.load(os.path.join(directory, 'frames.npy'),
+                              mmap_mode='c')
+        self.frame_times = np.load(os.path.join(directory, 'times.npy'),
+                                   mmap_mode='c')
+        self.files = np.load(os.path.join(directory, 'files.npy'))
+        self.offsets = np.load(os.path.join(directory, 'offsets.npy'))
+
+    @classmethod
+    def create(cls, times, features, directory):
+        """Write the features in directory and return the opened store
+
+        Parameters
+        ----------
+        times, features : dict
+            times and features of each file, as returned by
+            ABXpy.distances.distances.load_features
+        directory : string
+            existing directory where the store is written
+        """
+        files = sorted(times.keys())
+        lengths = [times[f].shape[0] for f in files]
+        offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        dtype = np.result_type(*[features[f].dtype for f in files])
+        dim = features[files[0]].shape[1] if files else 0
+        frames = np.lib.format.open_memmap(
+            os.path.join(directory, 'frames.npy'), mode='w+', dtype=dtype,
+            shape=(int(offsets[-1]), dim))
+        frame_times = np.lib.format.open_memmap(
+            os.path.join(directory, 'times.npy'), mode='w+',
+            dtype=np.float64, shape=(int(offsets[-1]),))
+        for f, start, stop in zip(files, offsets[:-1], offsets[1:]):
+            # frames are sorted by time
+            order = np.argsort(times[f], kind='mergesort')
+            frame_times[start:stop] = times[f][order]
+            frames[start:stop, :] = features[f][order, :]
+        frames.flush()
+        frame_times.flush()
+        del frames, frame_times
+        np.save(os.path.join(directory, 'files.npy'), np.array(files))
+        np.save(os.path.join(directory, 'offsets.npy'), offsets)
+        return cls(directory)
+
+    @classmethod
+    def merge(cls, stores, directory):
+        """Write the features of several stores in directory and return the
+        opened store
+
+        The features are copied one file at a time, so that a store can be
+        created from several feature files without holding all of them in
+        memory (see ABXpy.distances.distances.create_feature_store).
+
+        Parameters
+        ----------
+        stores : list of FeatureStore
+            stores containing different files
+        directory : string
+            existing directory where the store is written
+        """
+        located = {}
+        for store in stores:
+            for f, start, stop in zip(store.files, store.offsets[:-1],
+                                      store.offsets[1:]):
+                assert not(str(f) in located), (
+                    "The same file is indexed by (at least) two different "
+                    "feature files")
+                located[str(f)] = (store, start, stop)
+        files = sorted(located.keys())
+        lengths = [located[f][2] - located[f][1] for f in files]
+        offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        dtype = np.result_type(*[store.frames.dtype for store in stores])
+        dim = located[files[0]][0].frames.shape[1] if files else 0
+        frames = np.lib.format.open_memmap(
+            os.path.join(directory, 'frames.npy'), mode='w+', dtype=dtype,
+            shape=(int(offsets[-1]), dim))
+        frame_times = np.lib.format.open_memmap(
+            os.path.join(directory, 'times.npy'), mode='w+',
+            dtype=np.float64, shape=(int(offsets[-1]),))
+        for f, start, stop in zip(files, offsets[:-1], offsets[1:]):
+            store, sta, sto = located[f]
+            frame_times[start:stop] = store.frame_times[sta:sto]
+            frames[start:stop, :] = store.frames[sta:sto, :]
+        frames.flush()
+        frame_times.flush()
+        del frames, frame_times
+        np.save(os.path.join(directory, 'files.npy'), np.array(files))
+        np.save(os.path.join(directory, 'offsets.npy'), offsets)
+        return cls(directory)
+
+    def get_times_and_features(self):
+        """Dictionaries of the times and features of each file
+
+        The arrays are views on the store (suitable for
+        ABXpy.distances.distances.Features_Accessor).
+        """
+        times = {}
+        features = {}
+        for f, start, stop in zip(self.files, self.offsets[:-1],
+                                  self.offsets[1:]):
+            times[str(f)] = self.frame_times[start:stop]
+            features[str(f)] = self.frames[start:stop, :]
+        return times, features
@@ -5,4 +5,18 @@ Created on Sun Aug 18 22:31:59 2013
 @author: thomas
 
 This file only serves to signal that the content of the folder is a Python package.
+
+If the dtw extension is not built (see install/install_dtw.py), its pure
+NumPy implementation dtw_numpy is imported as ABXpy.distances.metrics.dtw,
+with the same functions and results. DTW_COMPILED tells which one is used.
 """
+
+import sys
+
+try:
+    from . import dtw
+    DTW_COMPILED = True
+except ImportError:
+    from . import dtw_numpy as dtw
+    sys.modules[__name__ + '.dtw'] = dtw
+    DTW_COMPILED = False
@@ -40,3 +40,47 @@ def normalize_cosine_distance(x, y):
     x /= x.sum(1).reshape(x.shape[0], 1)
     y /= y.sum(1).reshape(y.shape[0], 1)
     return cosine_distance(x, y)
+
+
+# The following functions allow normalizing the frames of many items at once
+# and then computing the cosine distances between normalized frames with a
+# single matrix product (see ABXpy.distances.block_distances)
+def normalize_frames(x):
+    """L2-normalize the lines of x
+
+    Returns the normalized array and a boolean array indicating the lines
+    with a null norm (which are left to 0 in the normalized array).
+    """
+    assert x.dtype == np.float64 or x.dtype == np.float32
+    norms = np.sqrt(np.sum(x ** 2, axis=1))
+    null = norms == 0.
+    norms[null] = 1.
+    return x / norms[:, None], null
+
+
+def cosine_distance_normalized(x, y, x_null, y_null):
+    """cosine_distance for lines already normalized with normalize_frames"""
+    d = np.dot(x, y.T)
+    # rounding errors can get the scalar product of normalized frames out of
+    # the domain of arccos
+    np.clip(d, -1., 1., out=d)
+    d = (np.arccos(d) / np.pi).astype(np.float64)
+    d[x_null, :] = 1.
+    d[:, y_null] = 1.
+    d[np.ix_(x_null, y_null)] = 0.
+    return d
+
+
+def cosine_distance_rows(x, y):
+    """cosine distances between the lines of x and the lines of y, one by one
+
+    x and y have the same shape, returns the cosine distance between x[i]
+    and y[i] for each i (e.g. as the div function of the UTW)
+    """
+    x, x_null = normalize_frames(x)
+    y, y_null = normalize_frames(y)
+    d = np.clip(np.sum(x * y, axis=1), -1., 1.)
+    d = (np.arccos(d) / np.pi).astype(np.float64)
+    d[x_null != y_null] = 1.
+    d[x_null & y_null] = 0.
+    return d
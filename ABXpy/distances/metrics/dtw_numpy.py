@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""
+Pure NumPy implementation of the dtw extension (see install/dtw.pyx)
+
+Used instead of the compiled module ABXpy.distances.metrics.dtw when it is
+not built (see ABXpy.distances.metrics), with the same functions and the same
+results: the cost of the optimal path and its length, with the tie-breaking
+rule of the backtracking of the compiled module, are exactly the same.
+
+The cost matrix is computed one anti-diagonal at a time: the cells (i, j)
+with i + j = s only depend on the anti-diagonals s - 1 and s - 2, so that
+each anti-diagonal is computed with a few NumPy operations. dtw_batch
+computes the anti-diagonals of all the pairs of a block together.
+"""
+
+import numpy as np
+
+CTYPE = np.float64  # cost type
+IND = np.intp  # array index type
+# frame-level metrics available in the fused kernel
+METRICS = {'cosine': 0, 'euclidean': 1}
+# maximal number of frame-by-frame distances of the pairs whose
+# anti-diagonals are computed together by dtw_batch, controls the memory used
+MAX_CELLS = 10 ** 7
+
+
+def dtw(x, y, metric, normalized):
+    if x.shape[0] == 0 or y.shape[0] == 0:
+        raise ValueError('Cannot compute distance between empty representations')
+    else:
+        return _dtw(x.shape[0], y.shape[0], metric(x, y), normalized)
+
+
+def dtw_band(x, y, metric, normalized, window=None, slope=None):
+    """DTW restricted to a Sakoe-Chiba band and/or an Itakura parallelogram
+
+    See band_limits for the window and slope parameters.
+    """
+    if x.shape[0] == 0 or y.shape[0] == 0:
+        raise ValueError('Cannot compute distance between empty representations')
+    else:
+        N, M = x.shape[0], y.shape[0]
+        start, stop = band_limits(N, M, window, slope)
+        return _dtw_band(N, M, metric(x, y), normalized, start, stop)
+
+
+def _dtw(N, M, dist_array, normalized):
+    dist_array = np.asarray(dist_array, dtype=CTYPE)[:N, :M]
+    return float(_wavefront([dist_array], normalized)[0])
+
+
+def _dtw_band(N, M, dist_array, normalized, start, stop):
+    dist_array = np.asarray(dist_array, dtype=CTYPE)[:N, :M]
+    return float(_wavefront([_band_mask(dist_array, start, stop)],
+                            normalized)[0])
+
+
+def _dtw_abandon(N, M, dist_array, normalized, threshold):
+    """DTW distance, abandoned as soon as it exceeds threshold
+
+    Returns the same result as _dtw if it is lower or equal to threshold,
+    and possibly inf if it is strictly larger.
+    """
+    dist_array = np.asarray(dist_array, dtype=CTYPE)[:N, :M]
+    scale = N + M - 1 if normalized else 1
+    return float(_wavefront([dist_array], normalized, threshold, scale)[0])
+
+
+def band_limits(N, M, window=None, slope=None):
+    """Columns of each line of the N by M cost matrix inside the band
+
+    See the compiled module for the parameters.
+    """
+    lines = np.arange(N, dtype=CTYPE)
+    if N > 1:
+        # diagonal and position of each line relatively to the diagonal
+        center = lines * (M - 1) / (N - 1)
+        u = lines / (N - 1)
+    else:
+        center = np.zeros(1, dtype=CTYPE)
+        u = np.ones(1, dtype=CTYPE)
+    low = np.zeros(N, dtype=CTYPE)
+    high = np.zeros(N, dtype=CTYPE) + M - 1
+    if window is not None:
+        if window < 1:
+            window = np.ceil(window * max(N, M))
+        low = np.maximum(low, center - window)
+        high = np.minimum(high, center + window)
+    if slope is not None:
+        v_low = np.maximum(u / slope, 1 - slope * (1 - u))
+        v_high = np.minimum(u * slope, 1 - (1 - u) / slope)
+        low = np.maximum(low, v_low * (M - 1))
+        high = np.minimum(high, v_high * (M - 1))
+    start = np.ceil(low - 1e-9).astype(IND)
+    stop = np.floor(high + 1e-9).astype(IND) + 1
+    start = np.minimum(start, M - 1)
+    stop = np.maximum(stop, start + 1)
+    # the band must contain (0, 0) and (N-1, M-1) and successive lines must
+    # be connected by a step
+    start[0] = 0
+    stop[N - 1] = M
+    stop[:-1] = np.maximum(stop[:-1], start[1:])
+    start[1:] = np.minimum(start[1:], stop[:-1])
+    return start, stop
+
+
+def dtw_fused(x, y, metric, normalized, window=None, slope=None):
+    """DTW between x and y with the frame-level metric 'cosine' or
+    'euclidean' (see the compiled module)"""
+    if x.shape[0] == 0 or y.shape[0] == 0:
+        raise ValueError('Cannot compute distance between empty representations')
+    d = _frame_distances(np.asarray(x, dtype=CTYPE),
+                         np.asarray(y, dtype=CTYPE), METRICS[metric])
+    if window is not None or slope is not None:
+        start, stop = band_limits(x.shape[0], y.shape[0], window, slope)
+        d = _band_mask(d, start, stop)
+    return float(_wavefront([d], normalized)[0])
+
+
+def dtw_batch(frames, offsets, pairs, metric, normalized, window=None,
+              slope=None, n_threads=0):
+    """Fused DTW (see dtw_fused) for many pairs of items
+
+    Same parameters and results as the compiled dtw_batch, n_threads is
+    ignored. The anti-diagonals of successive pairs are computed together,
+    as long as their frame-by-frame distance matrices have at most
+    MAX_CELLS cells in total (a single pair can exceed it).
+    """
+    frames = np.asarray(frames, dtype=CTYPE)
+    offsets = np.asarray(offsets, dtype=IND)
+    pairs = np.asarray(pairs, dtype=IND).reshape((-1, 2))
+    metric = METRICS[metric]
+    dis = np.empty(pairs.shape[0], dtype=CTYPE)
+    dists = []
+    computed = []
+    n_cells = 0
+    for p, (a, b) in enumerate(pairs):
+        x = frames[offsets[a]:offsets[a + 1]]
+        y = frames[offsets[b]:offsets[b + 1]]
+        if x.shape[0] == 0 or y.shape[0] == 0:
+            # 0 between empty items, inf between an empty item and another
+            dis[p] = 0 if x.shape[0] == y.shape[0] else np.inf
+            continue
+        if dists and n_cells + x.shape[0] * y.shape[0] > MAX_CELLS:
+            dis[computed] = _wavefront(dists, normalized)
+            dists, computed, n_cells = [], [], 0
+        d = _frame_distances(x, y, metric)
+        if window is not None or slope is not None:
+            start, stop = band_limits(x.shape[0], y.shape[0], window, slope)
+            d = _band_mask(d, start, stop)
+        dists.append(d)
+        computed.append(p)
+        n_cells += d.size
+    if computed:
+        dis[computed] = _wavefront(dists, normalized)
+    return dis
+
+
+def _frame_distances(x, y, metric):
+    # frame-by-frame distances, as computed by the fused kernel
+    if metric == 0:
+        x_norm = np.sqrt(np.sum(x ** 2, axis=1))
+        y_norm = np.sqrt(np.sum(y ** 2, axis=1))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            s = np.dot(x, y.T) / np.outer(x_norm, y_norm)
+        d = np.arccos(np.clip(s, -1, 1)) / np.pi
+        x_null = x_norm == 0
+        y_null = y_norm == 0
+        d[x_null, :] = 1
+        d[:, y_null] = 1
+        d[np.ix_(x_null, y_null)] = 0
+        return d
+    else:
+        return np.sqrt(np.sum((x[:, None, :] - y[None, :, :]) ** 2, axis=2))
+
+
+def _band_mask(dist_array, start, stop):
+    # infinite distances outside of the band give infinite costs, as in the
+    # band-constrained compiled functions
+    columns = np.arange(dist_array.shape[1])
+    outside = ((columns[None, :] < np.asarray(start)[:, None]) |
+               (columns[None, :] >= np.asarray(stop)[:, None]))
+    return np.where(outside, np.inf, dist_array)
+
+
+def _wavefront(dists, normalized, threshold=None, scale=1):
+    """DTW costs of a list of frame-by-frame distance matrices
+
+    The costs of all the matrices are stored in a single flat array, each
+    matrix of size N by M being padded with a first line and a first column
+    of infinite costs (except for the corner, of cost 0), so that the cell
+    (i, j) of matrix p is at position cost_offsets[p] + (i+1) * (M+1) + j+1.
+    The length of the optimal path to each cell is propagated along with
+    its cost, choosing the predecessors with the rule of the backtracking of
+    the compiled module.
+
+    If threshold is given (single matrix), the computation is abandoned and
+    inf returned as soon as two consecutive anti-diagonals (that every path
+    crosses) only have costs larger than threshold once divided by scale
+    (the maximal length of a path in the normalized case, see _dtw_abandon).
+    """
+    N = np.array([d.shape[0] for d in dists], dtype=IND)
+    M = np.array([d.shape[1] for d in dists], dtype=IND)
+    cost_offsets = np.concatenate([[0], np.cumsum((N + 1) * (M + 1))])
+    dist_offsets = np.concatenate([[0], np.cumsum(N * M)])
+    dist = np.concatenate([np.ravel(d) for d in dists])
+    cost = np.empty(cost_offsets[-1], dtype=CTYPE)
+    cost.fill(np.inf)
+    cost[cost_offsets[:-1]] = 0
+    length = np.zeros(cost_offsets[-1], dtype=IND)
+    previous_min = np.inf
+    for s in range(2, np.max(N + M) + 1):
+        # lines (in padded coordinates) of the cells of anti-diagonal s
+        low = np.maximum(1, s - M)
+        high = np.minimum(N, s - 1)
+        count = np.maximum(high - low + 1, 0)
+        active = np.flatnonzero(count)
+        count = count[active]
+        pair = np.repeat(active, count)
+        i = (np.arange(np.sum(count)) -
+             np.repeat(np.cumsum(count) - count, count) +
+             np.repeat(low[active], count))
+        j = s - i
+        width = M[pair] + 1
+        cell = cost_offsets[pair] + i * width + j
+        up, left, diag = cell - width, cell - 1, cell - width - 1
+        c_up, c_left, c_diag = cost[up], cost[left], cost[diag]
+        take_diag = (c_diag <= c_left) & (c_diag <= c_up)
+        take_left = ~take_diag & (c_left <= c_up)
+        best = np.where(take_diag, diag, np.where(take_left, left, up))
+        cost[cell] = (dist[dist_offsets[pair] + (i - 1) * M[pair] + j - 1] +
+                      cost[best])
+        length[cell] = length[best] + 1
+        if threshold is not None:
+            current_min = np.min(cost[cell])
+            if min(previous_min, current_min) / scale > threshold:
+                return np.array([np.inf])
+            previous_min = current_min
+    last = cost_offsets[1:] - 1
+    if normalized:
+        return cost[last] / length[last]
+    return cost[last]
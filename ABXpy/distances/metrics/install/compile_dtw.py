@@ -10,9 +10,14 @@ from distutils.extension import Extension
 from Cython.Build import cythonize
 import numpy
 import os
+from openmp import openmp_flags
 path = os.path.dirname(os.path.realpath(__file__))
 
-extension = Extension("dtw", [os.path.join(path, "dtw.pyx")], extra_compile_args=[
-                      "-O3"], include_dirs=[numpy.get_include()])
+# OpenMP is used to compute the pairs of dtw_batch in parallel, if available
+openmp = openmp_flags()
+extension = Extension("dtw", [os.path.join(path, "dtw.pyx")],
+                      extra_compile_args=["-O3"] + openmp,
+                      extra_link_args=openmp,
+                      include_dirs=[numpy.get_include()])
 
 setup(name="DTW implementation in cython", ext_modules=cythonize(extension))
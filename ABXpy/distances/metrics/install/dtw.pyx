@@ -14,13 +14,19 @@ The function do not verify its arguments, common problems are:
     the dist_array is not of the correct size or type
 """
 
+import multiprocessing
 import numpy as np
 cimport numpy as np
 cimport cython
 from cpython cimport bool
+from libc.math cimport INFINITY, acos, sqrt, M_PI
+from cython.parallel cimport prange
 ctypedef np.float64_t CTYPE_t # cost type
 ctypedef np.intp_t IND_t # array index type
 CTYPE = np.float64 # cost type 
+IND = np.intp # array index type
+# frame-level metrics available in the fused kernel
+METRICS = {'cosine': 0, 'euclidean': 1}
 
 
 def dtw(x, y, metric, normalized):
@@ -28,6 +34,19 @@ def dtw(x, y, metric, normalized):
         raise ValueError('Cannot compute distance between empty representations')
     else:
         return _dtw(x.shape[0], y.shape[0], metric(x,y), normalized) 
+
+
+def dtw_band(x, y, metric, normalized, window=None, slope=None):
+    """DTW restricted to a Sakoe-Chiba band and/or an Itakura parallelogram
+
+    See band_limits for the window and slope parameters.
+    """
+    if x.shape[0] == 0 or y.shape[0] == 0:
+        raise ValueError('Cannot compute distance between empty representations')
+    else:
+        N, M = x.shape[0], y.shape[0]
+        start, stop = band_limits(N, M, window, slope)
+        return _dtw_band(N, M, metric(x,y), normalized, start, stop)
     
  
 # There was a bug at initialization in both Dan Ellis DTW and Gabriel's code:
@@ -37,7 +56,7 @@ def dtw(x, y, metric, normalized):
 cpdef _dtw(IND_t N, IND_t M, CTYPE_t[:,:] dist_array, bool normalized):
     cdef IND_t i, j
     cdef CTYPE_t[:,:] cost = np.empty((N, M), dtype=CTYPE)
-    cdef CTYPE_t final_cost, c_diag, c_left, c_up
+    cdef CTYPE_t final_cost
     # initialization
     cost[0,0] = dist_array[0,0]
     for i in range(1,N):
@@ -50,14 +69,172 @@ cpdef _dtw(IND_t N, IND_t M, CTYPE_t[:,:] dist_array, bool normalized):
             cost[i,j] = dist_array[i,j] + min(cost[i-1,j], cost[i-1,j-1], cost[i,j-1])
 
     final_cost = cost[N-1, M-1]
+    if normalized:
+        final_cost /= _path_length(N, M, cost)
+    return final_cost
+
+
+cdef IND_t _path_length(IND_t N, IND_t M, CTYPE_t[:,:] cost):
+    # length of the optimal path, found by backtracking in the cost matrix
+    cdef IND_t i, j, path_len
+    cdef CTYPE_t c_diag, c_left, c_up
+    path_len = 1
+    i = N-1
+    j = M-1
+    while i > 0 and j > 0:
+        c_up = cost[i-1, j]
+        c_left = cost[i, j-1]
+        c_diag = cost[i-1, j-1]
+        if c_diag <= c_left and c_diag <= c_up:
+            i -= 1
+            j -= 1
+        elif c_left <= c_up:
+            j -= 1
+        else:
+            i -= 1
+        path_len += 1
+    if i == 0:
+        path_len += j
+    if j == 0:
+        path_len += i
+    return path_len
+
+
+# The following function allows deciding which of two DTW distances is the
+# smallest without computing the largest one completely (see
+# ABXpy.score.score_with_bounds)
+cpdef _dtw_abandon(IND_t N, IND_t M, CTYPE_t[:,:] dist_array,
+                   bool normalized, CTYPE_t threshold):
+    """DTW distance, abandoned as soon as it exceeds threshold
+
+    Returns the same result as _dtw if it is lower or equal to threshold,
+    and possibly inf if it is strictly larger.
+    """
+    cdef IND_t i, j
+    cdef CTYPE_t[:,:] cost = np.empty((N, M), dtype=CTYPE)
+    cdef CTYPE_t final_cost, line_min, scale = 1
+    # every path goes through every line and costs only increase along a
+    # path, so the minimum of a line of the cost matrix is a lower bound of
+    # the final cost. In the normalized case, the final cost is divided by at
+    # most N + M - 1. The costs are divided rather than the threshold
+    # multiplied, so that a distance equal to the threshold is never
+    # abandoned because of rounding errors.
+    if normalized:
+        scale = N + M - 1
+    cost[0,0] = dist_array[0,0]
+    for j in range(1,M):
+        cost[0,j] = dist_array[0,j] + cost[0,j-1]
+    if cost[0,0] / scale > threshold:
+        return np.inf
+    for i in range(1,N):
+        cost[i,0] = dist_array[i,0] + cost[i-1,0]
+        line_min = cost[i,0]
+        for j in range(1,M):
+            cost[i,j] = dist_array[i,j] + min(cost[i-1,j], cost[i-1,j-1], cost[i,j-1])
+            line_min = min(line_min, cost[i,j])
+        if line_min / scale > threshold:
+            return np.inf
+
+    final_cost = cost[N-1, M-1]
+    if normalized:
+        final_cost /= _path_length(N, M, cost)
+    return final_cost
+
+# Band-constrained DTW: only the cells (i, j) with start[i] <= j < stop[i]
+# are allowed. The cost of the cells inside the band is stored line after
+# line in a 1D array.
+def band_limits(IND_t N, IND_t M, window=None, slope=None):
+    """Columns of each line of the N by M cost matrix inside the band
+
+    Parameters
+    ----------
+    window : int or float, optional
+        Sakoe-Chiba band: maximal distance (in frames) between a cell and the
+        diagonal going from (0, 0) to (N-1, M-1). A float smaller than 1 is
+        interpreted relatively to the length of the longest sequence.
+    slope : float, optional
+        Itakura parallelogram: maximal slope (larger than 1) of the path,
+        relatively to the slope of the diagonal.
+
+    Returns
+    -------
+    start, stop : numpy.Array
+        line i of the band goes from column start[i] to column stop[i]
+        (excluded). The band is widened where necessary so that it always
+        contains a path from (0, 0) to (N-1, M-1).
+    """
+    cdef IND_t i
+    lines = np.arange(N, dtype=CTYPE)
+    if N > 1:
+        # diagonal and position of each line relatively to the diagonal
+        center = lines * (M - 1) / (N - 1)
+        u = lines / (N - 1)
+    else:
+        center = np.zeros(1, dtype=CTYPE)
+        u = np.ones(1, dtype=CTYPE)
+    low = np.zeros(N, dtype=CTYPE)
+    high = np.zeros(N, dtype=CTYPE) + M - 1
+    if window is not None:
+        if window < 1:
+            window = np.ceil(window * max(N, M))
+        low = np.maximum(low, center - window)
+        high = np.minimum(high, center + window)
+    if slope is not None:
+        # relative coordinates v = j / (M-1) of the parallelogram bounded by
+        # lines of slope slope and 1/slope going through (0, 0) and (1, 1)
+        v_low = np.maximum(u / slope, 1 - slope * (1 - u))
+        v_high = np.minimum(u * slope, 1 - (1 - u) / slope)
+        low = np.maximum(low, v_low * (M - 1))
+        high = np.minimum(high, v_high * (M - 1))
+    start = np.ceil(low - 1e-9).astype(IND)
+    stop = np.floor(high + 1e-9).astype(IND) + 1
+    start = np.minimum(start, M - 1)
+    stop = np.maximum(stop, start + 1)
+    # the band must contain (0, 0) and (N-1, M-1) and successive lines must
+    # be connected by a step
+    start[0] = 0
+    stop[N-1] = M
+    for i in range(N-2, -1, -1):
+        stop[i] = max(stop[i], start[i+1])
+    for i in range(1, N):
+        start[i] = min(start[i], stop[i-1])
+    return start, stop
+
+
+cpdef _dtw_band(IND_t N, IND_t M, CTYPE_t[:,:] dist_array, bool normalized,
+                IND_t[:] start, IND_t[:] stop):
+    cdef IND_t i, j, k, path_len
+    cdef CTYPE_t final_cost, c_diag, c_left, c_up
+    cdef IND_t[:] offsets = np.empty(N+1, dtype=IND)
+    offsets[0] = 0
+    for i in range(N):
+        offsets[i+1] = offsets[i] + stop[i] - start[i]
+    cdef CTYPE_t[:] cost = np.empty(offsets[N], dtype=CTYPE)
+    # initialization
+    cost[0] = dist_array[0,0]
+    for j in range(1, stop[0]):
+        cost[j] = dist_array[0,j] + cost[j-1]
+    # the dynamic programming loop
+    for i in range(1,N):
+        for j in range(start[i], stop[i]):
+            k = offsets[i] + j - start[i]
+            c_up = _band_cost(cost, offsets, start, stop, i-1, j)
+            c_diag = _band_cost(cost, offsets, start, stop, i-1, j-1)
+            if j > start[i]:
+                c_left = cost[k-1]
+            else:
+                c_left = INFINITY
+            cost[k] = dist_array[i,j] + min(c_up, c_diag, c_left)
+
+    final_cost = cost[offsets[N]-1]
     if normalized:
         path_len = 1
         i = N-1
         j = M-1
         while i > 0 and j > 0:
-            c_up = cost[i-1, j]
-            c_left = cost[i, j-1]
-            c_diag = cost[i-1, j-1]
+            c_up = _band_cost(cost, offsets, start, stop, i-1, j)
+            c_left = _band_cost(cost, offsets, start, stop, i, j-1)
+            c_diag = _band_cost(cost, offsets, start, stop, i-1, j-1)
             if c_diag <= c_left and c_diag <= c_up:
                 i -= 1
                 j -= 1
@@ -72,7 +249,236 @@ cpdef _dtw(IND_t N, IND_t M, CTYPE_t[:,:] dist_array, bool normalized):
             path_len += i
         final_cost /= path_len
     return final_cost
-   
+
+
+cdef inline CTYPE_t _band_cost(CTYPE_t[:] cost, IND_t[:] offsets,
+                               IND_t[:] start, IND_t[:] stop, IND_t i,
+                               IND_t j):
+    # cost of cell (i, j), inf outside of the band
+    if j < start[i] or j >= stop[i]:
+        return INFINITY
+    return cost[offsets[i] + j - start[i]]
+
+# Fused DTW: the frame-by-frame distances are computed on the fly inside the
+# dynamic programming loop, only two lines of the cost matrix are kept and
+# the length of the optimal path is propagated along with the cost (choosing
+# predecessors with the same rule as the backtracking in _dtw), so that
+# memory is O(M) instead of O(NM) and no backtracking is needed.
+def dtw_fused(x, y, metric, normalized, window=None, slope=None):
+    """DTW between x and y with the frame-level metric computed on the fly
+
+    Gives the same result as dtw(x, y, metric, normalized) (up to rounding
+    errors) for metric 'cosine' (cosine.cosine_distance) or 'euclidean'.
+    See band_limits for the window and slope parameters.
+    """
+    if x.shape[0] == 0 or y.shape[0] == 0:
+        raise ValueError('Cannot compute distance between empty representations')
+    x = np.ascontiguousarray(x, dtype=CTYPE)
+    y = np.ascontiguousarray(y, dtype=CTYPE)
+    N, M = x.shape[0], y.shape[0]
+    if window is None and slope is None:
+        start = np.zeros(N, dtype=IND)
+        stop = np.zeros(N, dtype=IND) + M
+    else:
+        start, stop = band_limits(N, M, window, slope)
+    return _dtw_fused(x, y, np.sqrt(np.sum(x ** 2, axis=1)),
+                      np.sqrt(np.sum(y ** 2, axis=1)), METRICS[metric],
+                      normalized, start, stop, np.empty(M, dtype=CTYPE),
+                      np.empty(M, dtype=CTYPE), np.empty(M, dtype=IND),
+                      np.empty(M, dtype=IND))
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef CTYPE_t _dtw_fused(CTYPE_t[:,:] x, CTYPE_t[:,:] y, CTYPE_t[:] x_norm,
+                         CTYPE_t[:] y_norm, int metric, bint normalized,
+                         IND_t[:] start, IND_t[:] stop,
+                         CTYPE_t[:] cost_prev, CTYPE_t[:] cost_cur,
+                         IND_t[:] len_prev, IND_t[:] len_cur) nogil:
+    """x_norm and y_norm are the euclidean norms of the lines of x and y
+    (only used for the cosine metric), the four last arguments are buffers
+    of size M"""
+    cdef IND_t N = x.shape[0]
+    cdef IND_t M = y.shape[0]
+    cdef IND_t i, j, old_start, old_stop
+    cdef CTYPE_t c_diag, c_left, c_up, d
+    cdef CTYPE_t[:] cost_tmp
+    cdef IND_t[:] len_tmp
+    # first line
+    for j in range(M):
+        cost_cur[j] = INFINITY
+    for j in range(stop[0]):
+        d = _frame_distance(x, y, x_norm, y_norm, metric, 0, j)
+        if j == 0:
+            cost_cur[j] = d
+        else:
+            cost_cur[j] = d + cost_cur[j-1]
+        len_cur[j] = j + 1
+    # cells of the line two steps behind, to be reset when reusing its
+    # buffer
+    old_start, old_stop = 0, M
+    for i in range(1, N):
+        cost_tmp = cost_prev
+        cost_prev = cost_cur
+        cost_cur = cost_tmp
+        len_tmp = len_prev
+        len_prev = len_cur
+        len_cur = len_tmp
+        for j in range(old_start, old_stop):
+            cost_cur[j] = INFINITY
+        old_start, old_stop = start[i-1], stop[i-1]
+        for j in range(start[i], stop[i]):
+            c_up = cost_prev[j]
+            if j > 0:
+                c_diag = cost_prev[j-1]
+            else:
+                c_diag = INFINITY
+            if j > start[i]:
+                c_left = cost_cur[j-1]
+            else:
+                c_left = INFINITY
+            d = _frame_distance(x, y, x_norm, y_norm, metric, i, j)
+            if c_diag <= c_left and c_diag <= c_up:
+                cost_cur[j] = d + c_diag
+                len_cur[j] = len_prev[j-1] + 1
+            elif c_left <= c_up:
+                cost_cur[j] = d + c_left
+                len_cur[j] = len_cur[j-1] + 1
+            else:
+                cost_cur[j] = d + c_up
+                len_cur[j] = len_prev[j] + 1
+    if normalized:
+        return cost_cur[M-1] / len_cur[M-1]
+    return cost_cur[M-1]
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline CTYPE_t _frame_distance(CTYPE_t[:,:] x, CTYPE_t[:,:] y,
+                                    CTYPE_t[:] x_norm, CTYPE_t[:] y_norm,
+                                    int metric, IND_t i, IND_t j) nogil:
+    cdef IND_t k
+    cdef CTYPE_t s = 0, diff
+    if metric == 0:
+        # cosine distance, see cosine.cosine_distance
+        if x_norm[i] == 0:
+            if y_norm[j] == 0:
+                return 0
+            return 1
+        if y_norm[j] == 0:
+            return 1
+        for k in range(x.shape[1]):
+            s += x[i, k] * y[j, k]
+        s /= x_norm[i] * y_norm[j]
+        if s > 1:
+            s = 1
+        elif s < -1:
+            s = -1
+        return acos(s) / M_PI
+    else:
+        # euclidean distance
+        for k in range(x.shape[1]):
+            diff = x[i, k] - y[j, k]
+            s += diff * diff
+        return sqrt(s)
+
+# Batched DTW: all the pairs of a block are computed in a single call,
+# without the GIL, and in parallel if the extension was compiled with OpenMP
+# (see compile_dtw.py and setup.py).
+def dtw_batch(frames, offsets, pairs, metric, normalized, window=None,
+              slope=None, n_threads=0):
+    """Fused DTW (see dtw_fused) for many pairs of items
+
+    Parameters
+    ----------
+    frames : numpy.Array
+        the frames of all the items, one item after the other
+    offsets : numpy.Array
+        array of size n_items+1, the frames of item k are
+        frames[offsets[k]:offsets[k+1]]
+    pairs : numpy.Array
+        n_pairs by 2 array of item indices
+    metric : str
+        'cosine' or 'euclidean'
+    normalized : bool
+        whether the DTW cost is normalized by the length of the path
+    window, slope : optional
+        band constraints, see band_limits
+    n_threads : int, optional
+        number of threads, defaults to the number of cpus
+
+    Returns
+    -------
+    dis : numpy.Array
+        the distances between the items of each pair, empty items are at
+        distance 0 of each other and at infinite distance of other items
+    """
+    frames = np.ascontiguousarray(frames, dtype=CTYPE)
+    offsets = np.asarray(offsets, dtype=IND)
+    pairs = np.asarray(pairs, dtype=IND).reshape((-1, 2))
+    n_pairs = pairs.shape[0]
+    N = offsets[pairs[:, 0] + 1] - offsets[pairs[:, 0]]
+    M = offsets[pairs[:, 1] + 1] - offsets[pairs[:, 1]]
+    # band limits of all the pairs, one pair after the other
+    band_offsets = np.concatenate([[0], np.cumsum(N)]).astype(IND)
+    if window is None and slope is None:
+        start = np.zeros(band_offsets[-1], dtype=IND)
+        stop = np.repeat(M, N).astype(IND)
+    else:
+        start = np.empty(band_offsets[-1], dtype=IND)
+        stop = np.empty(band_offsets[-1], dtype=IND)
+        for p in range(n_pairs):
+            if N[p] > 0 and M[p] > 0:
+                b, e = band_offsets[p], band_offsets[p + 1]
+                start[b:e], stop[b:e] = band_limits(N[p], M[p], window, slope)
+    # one set of rolling buffers per pair, so that the threads share nothing
+    buffer_offsets = np.concatenate([[0], np.cumsum(M)]).astype(IND)
+    n_cells = buffer_offsets[-1]
+    if n_threads <= 0:
+        n_threads = multiprocessing.cpu_count()
+    dis = np.empty(n_pairs, dtype=CTYPE)
+    _dtw_batch(frames, np.sqrt(np.sum(frames ** 2, axis=1)), offsets, pairs,
+               METRICS[metric], normalized, start, stop, band_offsets,
+               np.empty(n_cells, dtype=CTYPE), np.empty(n_cells, dtype=CTYPE),
+               np.empty(n_cells, dtype=IND), np.empty(n_cells, dtype=IND),
+               buffer_offsets, dis, n_threads)
+    return dis
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _dtw_batch(CTYPE_t[:,:] frames, CTYPE_t[:] norms, IND_t[:] offsets,
+                     IND_t[:,:] pairs, int metric, bint normalized,
+                     IND_t[:] start, IND_t[:] stop, IND_t[:] band_offsets,
+                     CTYPE_t[:] cost_prev, CTYPE_t[:] cost_cur,
+                     IND_t[:] len_prev, IND_t[:] len_cur,
+                     IND_t[:] buffer_offsets, CTYPE_t[:] dis, int n_threads):
+    cdef IND_t p, a, b, ba, be, bb, bbe
+    cdef IND_t n_pairs = pairs.shape[0]
+    with nogil:
+        for p in prange(n_pairs, schedule='dynamic', num_threads=n_threads):
+            a = pairs[p, 0]
+            b = pairs[p, 1]
+            if offsets[a+1] == offsets[a] or offsets[b+1] == offsets[b]:
+                if offsets[a+1] - offsets[a] == offsets[b+1] - offsets[b]:
+                    # both items are empty
+                    dis[p] = 0
+                else:
+                    dis[p] = INFINITY
+                continue
+            ba = band_offsets[p]
+            be = band_offsets[p+1]
+            bb = buffer_offsets[p]
+            bbe = buffer_offsets[p+1]
+            dis[p] = _dtw_fused(frames[offsets[a]:offsets[a+1]],
+                                frames[offsets[b]:offsets[b+1]],
+                                norms[offsets[a]:offsets[a+1]],
+                                norms[offsets[b]:offsets[b+1]],
+                                metric, normalized,
+                                start[ba:be], stop[ba:be],
+                                cost_prev[bb:bbe], cost_cur[bb:bbe],
+                                len_prev[bb:bbe], len_cur[bb:bbe])
+
 """
 import numpy as np
 cimport numpy as np
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""
+Compiler flags for building the dtw extension with OpenMP
+
+The pairs of dtw_batch are computed in parallel (with prange) only if the
+compiler supports OpenMP; otherwise the extension is built without these
+flags and prange runs sequentially.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+from distutils.ccompiler import new_compiler
+from distutils.errors import CompileError, LinkError
+from distutils.sysconfig import customize_compiler
+
+OPENMP_FLAGS = ["-fopenmp"]
+TEST_PROGRAM = """#include <omp.h>
+int main(void) { return omp_get_max_threads() > 0 ? 0 : 1; }
+"""
+
+
+def openmp_flags():
+    """The OpenMP compile and link flags, if the compiler supports them"""
+    compiler = new_compiler()
+    customize_compiler(compiler)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        source = os.path.join(tmpdir, 'test_openmp.c')
+        with open(source, 'w') as fh:
+            fh.write(TEST_PROGRAM)
+        objects = compiler.compile([source], output_dir=tmpdir,
+                                   extra_postargs=OPENMP_FLAGS)
+        compiler.link_executable(objects, 'test_openmp', output_dir=tmpdir,
+                                 extra_postargs=OPENMP_FLAGS)
+    except (CompileError, LinkError):
+        sys.stderr.write('OpenMP is not supported by the compiler, the pairs '
+                         'of dtw_batch will be computed sequentially\n')
+        return []
+    finally:
+        shutil.rmtree(tmpdir)
+    return OPENMP_FLAGS
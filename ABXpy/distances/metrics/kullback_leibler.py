@@ -2,6 +2,15 @@
 
 import numpy as np
 
+# The divergences below are computed in two steps: a preprocessing of the
+# frames of each item (normalization, logarithms...) by the prepare_*
+# functions, and the computation of the divergences between the frames of
+# two preprocessed items by the *_prepared functions. When many pairs of
+# items are computed, the preprocessing can be done only once per item (see
+# ABXpy.distances.block_distances). The inputs are never modified in place.
+# The *_prepared functions always return a 2D array, even for items of a
+# single frame (np.float64 would turn a 1 by 1 matrix into a scalar).
+
 
 def kl_ptwise(x, y):
     return np.sum(x * (np.log(x) - np.log(y)))
@@ -12,16 +21,42 @@ def js_ptwise(x, y):
     return 0.5 * kl_ptwise(x, m) + 0.5 * kl_ptwise(y, m)
 
 
-def __kl_divergence(x, y):
+def _normalize_lines(x):
+    return x / x.sum(1).reshape(x.shape[0], 1)
+
+
+def __kl_divergence(x, log_x, log_y):
     """ just the KL-div """
-    pq = np.dot(x, np.log(y.transpose()))
-    pp = np.tile(
-        np.sum(x * np.log(x), axis=1).reshape(x.shape[0], 1), (1, y.shape[0]))
+    pq = np.dot(x, log_y.transpose())
+    pp = np.sum(x * log_x, axis=1).reshape(x.shape[0], 1)
     return pp - pq
 
 
+def prepare_kl(x, thresholded=True, normalize=True):
+    """Preprocessing of the frames of an item for kl_divergence_prepared
+
+    Returns the (normalized and/or thresholded) frames and their logarithm
+    """
+    if thresholded:
+        normalize = True
+    if normalize:
+        x = _normalize_lines(x)
+    if thresholded:
+        eps = np.finfo(x.dtype).eps
+        x = _normalize_lines(x + eps)
+    return x, np.log(x)
+
+
+def kl_divergence_prepared(x, y, symmetrized=True):
+    """kl_divergence between items preprocessed by prepare_kl"""
+    res = __kl_divergence(x[0], x[1], y[1])
+    if symmetrized:
+        res = 0.5 * res + 0.5 * __kl_divergence(y[0], y[1], x[1]).transpose()
+    return np.asarray(res, dtype=np.float64)
+
+
 def kl_divergence(x, y, thresholded=True, symmetrized=True, normalize=True):
-    """ Kullback-Leibler divergence 
+    """ Kullback-Leibler divergence
     x and y should be 2D numpy arrays with "times" on the lines and "features" on the columns
      - thresholded=True => means we add an epsilon to all the dimensions/values
                            AND renormalize inputs.
@@ -31,45 +66,40 @@ def kl_divergence(x, y, thresholded=True, symmetrized=True, normalize=True):
     assert (x.dtype == np.float64 and y.dtype == np.float64) or (
         x.dtype == np.float32 and y.dtype == np.float32)
     # assert (np.all(x.sum(1) != 0.) and np.all(y.sum(1) != 0.))
-    if thresholded:
-        normalize = True
+    return kl_divergence_prepared(prepare_kl(x, thresholded, normalize),
+                                  prepare_kl(y, thresholded, normalize),
+                                  symmetrized)
+
+
+def prepare_js(x, normalize=True):
+    """Preprocessing of the frames of an item for js_divergence_prepared
+
+    Returns the (normalized) frames and their negative entropies
+    """
     if normalize:
-        x /= x.sum(1).reshape(x.shape[0], 1)
-        y /= y.sum(1).reshape(y.shape[0], 1)
-    if thresholded:
-        eps = np.finfo(x.dtype).eps
-        x = x + eps
-        y = y + eps
-        x /= x.sum(1).reshape(x.shape[0], 1)
-        y /= y.sum(1).reshape(y.shape[0], 1)
-    res = __kl_divergence(x, y)
-    if symmetrized:
-        res = 0.5 * res + 0.5 * __kl_divergence(y, x).transpose()
-    return np.float64(res)
+        x = _normalize_lines(x)
+    return x, np.sum(x * np.log(x), axis=1)
+
+
+def js_divergence_prepared(x, y):
+    """js_divergence between items preprocessed by prepare_js"""
+    # x * log(m) + y * log(m) = 2 * m * log(m)
+    m = (x[0][:, None, :] + y[0][None, :, :]) / 2
+    m_m = np.sum(m * np.log(m), axis=2)
+    res = 0.5 * (x[1][:, None] + y[1][None, :]) - m_m
+    return np.asarray(res, dtype=np.float64)
 
 
 def js_divergence(x, y, normalize=True):
-    """ Jensen-Shannon divergence 
+    """ Jensen-Shannon divergence
     x and y should be 2D numpy arrays with "times" on the lines and "features" on the columns
      - normalize=True => normalize the inputs so that lines sum to one.
     """
     assert (x.dtype == np.float64 and y.dtype == np.float64) or (
         x.dtype == np.float32 and y.dtype == np.float32)
     assert (np.all(x.sum(1) != 0.) and np.all(y.sum(1) != 0.))
-    if normalize:
-        x /= x.sum(1).reshape(x.shape[0], 1)
-        y /= y.sum(1).reshape(y.shape[0], 1)
-    xx = np.tile(x, (y.shape[0], 1, 1)).transpose((1, 0, 2))
-    yy = np.tile(y, (x.shape[0], 1, 1))
-    m = (xx + yy) / 2
-    x_m = np.sum(xx * np.log(m), axis=2)
-    y_m = np.sum(yy * np.log(m), axis=2)
-    x_x = np.tile(
-        np.sum(x * np.log(x), axis=1).reshape(x.shape[0], 1), (1, y.shape[0]))
-    y_y = np.tile(np.sum(
-        y * np.log(y), axis=1).reshape(y.shape[0], 1), (1, x.shape[0])).transpose()
-    res = 0.5 * (x_x - x_m) + 0.5 * (y_y - y_m)
-    return np.float64(res)
+    return js_divergence_prepared(prepare_js(x, normalize),
+                                  prepare_js(y, normalize))
     # division by zero
 
 
@@ -77,28 +107,38 @@ def sqrt_js_divergence(x, y):
     return np.sqrt(js_divergence(x, y))
 
 
+def prepare_hellinger(x):
+    """Preprocessing of the frames of an item for hellinger_distance_prepared
+
+    Returns the square roots of the normalized frames
+    """
+    return np.sqrt(_normalize_lines(x))
+
+
+def hellinger_distance_prepared(x, y):
+    """hellinger_distance between items preprocessed by prepare_hellinger"""
+    # the difference is computed directly rather than from the expansion
+    # ||x||^2 + ||y||^2 - 2 x.y, whose rounding errors give distances of
+    # about 1e-8 between identical frames
+    d = np.sqrt(np.sum((x[:, None, :] - y[None, :, :]) ** 2, axis=2))
+    return np.asarray((1. / np.sqrt(2)) * d, dtype=np.float64)
+
+
 def hellinger_distance(x, y):
-    """ Hellinger distance 
+    """ Hellinger distance
     x and y should be 2D numpy arrays with "times" on the lines and "features" on the columns
      - normalize=True => normalize the inputs so that lines sum to one.
     """
     assert (x.dtype == np.float64 and y.dtype == np.float64) or (
         x.dtype == np.float32 and y.dtype == np.float32)
     assert (np.all(x.sum(1) != 0.) and np.all(y.sum(1) != 0.))
-    x /= x.sum(1).reshape(x.shape[0], 1)
-    y /= y.sum(1).reshape(y.shape[0], 1)
-    x = np.sqrt(x)
-    y = np.sqrt(y)
     # x (120, 40), y (100, 40), H(x,y) (120, 100)
-    xx = np.tile(x, (y.shape[0], 1, 1)).transpose((1, 0, 2))
-    yy = np.tile(y, (x.shape[0], 1, 1))
-    xx_yy = xx - yy
-    res = np.sqrt(np.sum(xx_yy ** 2, axis=-1))
-    return np.float64((1. / np.sqrt(2)) * res)
+    return hellinger_distance_prepared(prepare_hellinger(x),
+                                       prepare_hellinger(y))
 
 
 def is_distance(x, y):
-    """ Itakura-Saito distance 
+    """ Itakura-Saito distance
     x and y should be 2D numpy arrays with "times" on the lines and "features" on the columns
     """
     assert (x.dtype == np.float64 and y.dtype == np.float64) or (
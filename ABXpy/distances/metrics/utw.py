@@ -6,8 +6,13 @@ Created on Sat Dec 13 13:40:46 2014
 """
 
 
+import collections
 import numpy as np
 
+# maximal number of (n1, n2) alignments kept by distance_coordinates
+COORDINATES_CACHE_SIZE = 10000
+_coordinates_cache = collections.OrderedDict()
+
 def utw(x, y, div):  
     """
     Uniform Time Warping
@@ -43,8 +48,82 @@ def utw(x, y, div):
         dis = dis + np.sum(div(x[i_whole,:], y[j_whole,:]))
     return dis
 
-   
+
+def utw_batch(xs, ys, div):
+    """
+    Uniform Time Warping for many pairs
+
+    Gives the same result as [utw(x, y, div) for x, y in zip(xs, ys)], but
+    the pairs whose items have the same lengths are computed together: the
+    frames of all the pairs of a group are gathered along the (memoized)
+    alignment coordinates and div is called once for the whole group.
+
+    Parameters
+    ----------
+    xs, ys : list of numpy.Array
+        The items of each pair, with "time" on the lines and "features" on
+        the columns
+    div : function
+        See utw
+
+    Returns
+    -------
+    dis : numpy.Array
+        The UTW distances, an empty item is at distance 0 of another empty
+        item and at infinite distance of the others
+    """
+    dis = np.empty(len(xs))
+    groups = {}
+    for k, (x, y) in enumerate(zip(xs, ys)):
+        n1, n2 = sorted([x.shape[0], y.shape[0]])
+        groups.setdefault((n1, n2), []).append(k)
+    for (n1, n2), ks in groups.items():
+        if n1 == 0:
+            dis[ks] = 0 if n2 == 0 else np.inf
+            continue
+        # the shorter item of each pair first, as in utw
+        shorter = np.array([xs[k] if xs[k].shape[0] == n1 else ys[k]
+                          for k in ks])
+        longer = np.array([ys[k] if xs[k].shape[0] == n1 else xs[k]
+                         for k in ks])
+        dim = shorter.shape[2]
+        i_half, j_half, i_whole, j_whole = distance_coordinates(n1, n2)
+        res = np.zeros(len(ks))
+        if i_half.size > 0:
+            d = div(shorter[:, i_half, :].reshape((-1, dim)),
+                    longer[:, j_half, :].reshape((-1, dim)))
+            res = res + np.sum(np.reshape(d, (len(ks), -1)), axis=1) / 2.
+        if i_whole.size > 0:
+            d = div(shorter[:, i_whole, :].reshape((-1, dim)),
+                    longer[:, j_whole, :].reshape((-1, dim)))
+            res = res + np.sum(np.reshape(d, (len(ks), -1)), axis=1)
+        dis[ks] = res
+    return dis
+
+
 def distance_coordinates(n1, n2):
+    """Alignment coordinates of UTW between items of lengths n1 <= n2
+
+    The coordinates only depend on (n1, n2) and are memoized (for the
+    COORDINATES_CACHE_SIZE most recently used distinct lengths), the
+    returned arrays are read-only.
+    """
+    key = (n1, n2)
+    if key in _coordinates_cache:
+        # move to the end, the least recently used lengths are first
+        coordinates = _coordinates_cache.pop(key)
+        _coordinates_cache[key] = coordinates
+        return coordinates
+    coordinates = _distance_coordinates(n1, n2)
+    for c in coordinates:
+        c.flags.writeable = False
+    if len(_coordinates_cache) >= COORDINATES_CACHE_SIZE:
+        _coordinates_cache.popitem(last=False)
+    _coordinates_cache[key] = coordinates
+    return coordinates
+
+
+def _distance_coordinates(n1, n2):
     assert(n1 <= n2)
     l1 = np.arange(n2)
     l2 = n1/np.float(n2)*(np.arange(n2)+0.5)
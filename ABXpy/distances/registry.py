@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""
+Registry of the distances between items and of their capabilities.
+
+A Metric gathers the implementations of a distance (pair by pair, and block
+by block, see ABXpy.distances.block_distances) with the properties the
+pipeline needs to choose how to compute it:
+
+ - symmetric: d(x, y) == d(y, x) when the distance is not normalized, so
+   that the pairs (a, b) and (b, a) of a block are computed only once
+   (the normalized DTW costs are only symmetric up to the choice between
+   optimal paths of different lengths, so that the pairs of a normalized
+   distance are always all computed),
+ - preprocessing: the block distance preprocesses the features of each item
+   only once for all the pairs of the block,
+ - batched: the block distance computes all the pairs of the block in a
+   single call to a compiled kernel, and accepts an n_threads argument,
+ - float32: the distance is accurate with float32 features (otherwise the
+   features are converted to float64 before computing it).
+
+ABXpy.distances.distances.compute_distances accepts a Metric (or the name of
+a registered metric) instead of a distance function, and computes it with
+the kernel returned by Metric.block_kernel.
+"""
+
+import functools
+import multiprocessing
+import numpy as np
+import ABXpy.distances.block_distances as block_distances
+import ABXpy.distances.metrics.cosine as cosine
+import ABXpy.distances.metrics.dtw as dtw
+import ABXpy.distances.metrics.utw as utw
+import ABXpy.distances.metrics.kullback_leibler as kullback_leibler
+
+
+class Metric(object):
+    """A distance between items and its implementations
+
+    Parameters
+    ----------
+    name : string
+        name of the metric in the registry
+    distance : callable
+        distance(x, y, normalized) between the features of two items
+    block_distance : callable, optional
+        block distance giving the same results as distance (see
+        ABXpy.distances.block_distances)
+    symmetric, preprocessing, batched, float32 : bool
+        capabilities of the metric (see the module documentation)
+    options : dict, optional
+        keyword arguments passed to distance and block_distance (e.g. the
+        window and slope of a DTW)
+    """
+
+    def __init__(self, name, distance, block_distance=None, symmetric=False,
+                 preprocessing=False, batched=False, float32=False,
+                 options=None):
+        self.name = name
+        self.distance = distance
+        self.block_distance = block_distance
+        self.symmetric = symmetric
+        self.preprocessing = preprocessing
+        self.batched = batched
+        self.float32 = float32
+        self.options = dict(options or {})
+
+    def __repr__(self):
+        return 'Metric({!r}, options={!r})'.format(
+            self.name, sorted(self.options.items()))
+
+    def bind(self, **options):
+        """A copy of the metric with additional options"""
+        bound = dict(self.options)
+        bound.update(options)
+        return Metric(self.name, self.distance, self.block_distance,
+                      self.symmetric, self.preprocessing, self.batched,
+                      self.float32, bound)
+
+    def identity(self):
+        """A string identifying the results of the metric
+
+        Does not depend on the kernel chosen by block_kernel, as they all
+        give the same results (see ABXpy.distances.distance_cache).
+        """
+        return 'metric:{}({})'.format(self.name,
+                                      sorted(self.options.items()))
+
+    def block_kernel(self, n_cpu=1):
+        """The fastest block distance computing the metric
+
+        Parameters
+        ----------
+        n_cpu : int
+            number of processes computing the distances, the cpus are
+            shared between the threads of the batched kernels of the
+            processes (see batch_threads)
+
+        Returns
+        -------
+        kernel : callable
+            block distance kernel(features, pairs, normalized)
+        """
+        if self.block_distance is None:
+            kernel = functools.partial(pairwise_block, self.distance,
+                                       **self.options)
+        else:
+            options = dict(self.options)
+            if self.batched:
+                options['n_threads'] = batch_threads(
+                    options.get('n_threads', 0), n_cpu)
+            kernel = functools.partial(self.block_distance, **options)
+        if not(self.float32):
+            kernel = functools.partial(float64_block, kernel)
+        if self.symmetric:
+            kernel = functools.partial(symmetric_block, kernel)
+        return kernel
+
+
+def batch_threads(n_threads, n_cpu):
+    """Number of threads of a batched kernel in each of n_cpu processes
+
+    n_threads if it is positive, otherwise the cpus are shared between the
+    processes (at least one thread per process), so that the machine is not
+    oversubscribed.
+    """
+    if n_threads > 0:
+        return n_threads
+    return max(1, multiprocessing.cpu_count() // max(1, n_cpu))
+
+
+METRICS = {}
+
+
+def register(metric):
+    """Add a metric to the registry (replacing any metric of the same name)"""
+    METRICS[metric.name] = metric
+    return metric
+
+
+def get_metric(name):
+    """The registered metric called name"""
+    try:
+        return METRICS[name]
+    except KeyError:
+        raise ValueError('Unknown metric {}, registered metrics are: {}'
+                         .format(name, ', '.join(sorted(METRICS))))
+
+
+def pairwise_block(distance, features, pairs, normalized, **options):
+    """Block distance computing distance pair by pair"""
+    dis = np.empty(pairs.shape[0])
+    for p, (a, b) in enumerate(pairs):
+        dis[p] = distance(features[a], features[b], normalized, **options)
+    return dis
+
+
+def float64_block(block_distance, features, pairs, normalized):
+    """Block distance computing block_distance on float64 features"""
+    features = dict((item, np.asarray(features[item], dtype=np.float64))
+                    for item in np.unique(pairs))
+    return block_distance(features, pairs, normalized)
+
+
+def symmetric_block(block_distance, features, pairs, normalized):
+    """Block distance computing a symmetric block_distance
+
+    The pairs (a, b) and (b, a) are computed only once, if normalized is
+    False.
+    """
+    if pairs.shape[0] == 0:
+        return np.empty(0)
+    if normalized:
+        return block_distance(features, pairs, normalized)
+    ordered = np.sort(pairs, axis=1).astype(np.int64)
+    codes = ordered[:, 0] + (ordered[:, 1].max() + 1) * ordered[:, 1]
+    _, first, inverse = np.unique(codes, return_index=True,
+                                  return_inverse=True)
+    if len(first) == pairs.shape[0]:
+        return block_distance(features, pairs, normalized)
+    dis = np.asarray(block_distance(features, pairs[first], normalized))
+    return dis[inverse]
+
+
+def _dtw_or_empty(x, y, normalized, frame_distance, window=None,
+                  slope=None):
+    n, m = x.shape[0], y.shape[0]
+    if n > 0 and m > 0:
+        d = frame_distance(x, y)
+    else:
+        d = np.empty((n, m))
+    return block_distances.dtw_or_empty(d, bool(normalized), window, slope)
+
+
+def dtw_cosine(x, y, normalized, window=None, slope=None):
+    """Dynamic time warping cosine distance (see dtw.dtw_fused)"""
+    if x.shape[0] > 0 and y.shape[0] > 0:
+        # the frame-level cosine distances are computed inside the DTW
+        # kernel (same result as dtw.dtw with cosine.cosine_distance)
+        return dtw.dtw_fused(x, y, 'cosine', normalized,
+                             window=window, slope=slope)
+    elif x.shape[0] == y.shape[0]:
+        # both x and y are empty
+        return 0
+    else:
+        # x or y is empty
+        return np.inf
+
+
+def dtw_kl(x, y, normalized, window=None, slope=None):
+    """DTW with the symmetrized, thresholded Kullback-Leibler divergence"""
+    return _dtw_or_empty(x, y, normalized, kullback_leibler.kl_divergence,
+                         window, slope)
+
+
+def dtw_js(x, y, normalized, window=None, slope=None):
+    """DTW with the Jensen-Shannon divergence"""
+    return _dtw_or_empty(x, y, normalized, kullback_leibler.js_divergence,
+                         window, slope)
+
+
+def dtw_hellinger(x, y, normalized, window=None, slope=None):
+    """DTW with the Hellinger distance"""
+    return _dtw_or_empty(x, y, normalized,
+                         kullback_leibler.hellinger_distance, window, slope)
+
+
+def utw_cosine(x, y, normalized=None):
+    """Uniform time warping cosine distance (not normalized)"""
+    return utw.utw(x, y, cosine.cosine_distance_rows)
+
+
+# the DTW costs are symmetric, the normalized costs are symmetric up to the
+# choice between optimal paths of different lengths (see symmetric_block)
+register(Metric('dtw_cosine', dtw_cosine, block_distances.dtw_cosine_batch,
+                symmetric=True, batched=True, float32=True))
+register(Metric('dtw_kl', dtw_kl, block_distances.dtw_kl_block,
+                symmetric=True, preprocessing=True, float32=True))
+register(Metric('dtw_js', dtw_js, block_distances.dtw_js_block,
+                symmetric=True, preprocessing=True, float32=True))
+register(Metric('dtw_hellinger', dtw_hellinger,
+                block_distances.dtw_hellinger_block,
+                symmetric=True, preprocessing=True, float32=True))
+register(Metric('utw_cosine', utw_cosine, block_distances.utw_cosine_block,
+                symmetric=True, float32=True))
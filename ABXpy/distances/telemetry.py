@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Timing and throughput of the computation of the distances.
+
+A MetricsLog appends one JSON record per line to a metrics file (by default
+next to the distance file, see metrics_file), for each block of pairs computed
+(wall time, pairs computed or found in the cache, number of DTW cells i.e. sum
+of n_frames_a * n_frames_b over the computed pairs, time spent loading
+features, computing the distances, looking them up in and adding them to the
+distance cache and writing them), each merge of the worker shards into the
+distance file, each job and each run. Successive runs (e.g. when resuming) are
+appended to the same file and distinguished by their 'run' field.
+
+The summary of a run tells whether it is limited by the I/O (load and write
+times), by a few long blocks (slowest blocks compared to the total time) or
+by the metric (cells per second).
+"""
+
+import json
+import time
+import uuid
+
+
+def metrics_file(distance_file):
+    """The metrics file associated to a distance file"""
+    return distance_file + '.metrics.jsonl'
+
+
+def block_stats():
+    """An empty dictionary of block statistics (see compute_block_distances)"""
+    return {'pairs': 0, 'cached_pairs': 0, 'cells': 0, 'load_time': 0.,
+            'compute_time': 0., 'cache_time': 0., 'write_time': 0.}
+
+
+class MetricsLog(object):
+    """JSON-lines log of the timings of a distance computation
+
+    Parameters
+    ----------
+    filename : string
+        the metrics file, created if necessary, records are appended
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.run = uuid.uuid4().hex
+        self.start = time.time()
+        self.blocks = []
+        self.merge_time = 0.
+        self.n_merges = 0
+
+    def record(self, event, **fields):
+        """Append a record to the metrics file"""
+        record = {'event': event, 'run': self.run, 'time': time.time()}
+        for key, value in fields.items():
+            record[key] = _to_json(value)
+        with open(self.filename, 'a') as fh:
+            fh.write(json.dumps(record, sort_keys=True) + '\n')
+        return record
+
+    def record_block(self, by, rows, wall_time, stats, **fields):
+        """Record the statistics of a block of pairs"""
+        fields.update(stats)
+        self.blocks.append(self.record('block', by=by, rows=rows,
+                                       wall_time=wall_time, **fields))
+
+    def record_merge(self, wall_time, n_rows):
+        """Record a merge of the shards into the distance file"""
+        self.merge_time += wall_time
+        self.n_merges += 1
+        self.record('merge', wall_time=wall_time, rows=n_rows)
+
+    def summary(self):
+        """Totals of the run so far"""
+        wall_time = time.time() - self.start
+        summary = {'wall_time': wall_time, 'blocks': len(self.blocks),
+                   'merge_time': self.merge_time, 'merges': self.n_merges}
+        for key in ['pairs', 'cached_pairs', 'cells', 'load_time',
+                    'compute_time', 'cache_time', 'write_time']:
+            summary[key] = sum(block[key] for block in self.blocks)
+        summary['block_time'] = sum(block['wall_time']
+                                    for block in self.blocks)
+        if summary['compute_time'] > 0:
+            summary['cells_per_second'] = (summary['cells'] /
+                                           summary['compute_time'])
+        else:
+            summary['cells_per_second'] = None
+        slowest = sorted(self.blocks, key=lambda block: -block['wall_time'])
+        summary['slowest_blocks'] = [
+            {'by': block['by'], 'rows': block['rows'],
+             'wall_time': block['wall_time'], 'pairs': block['pairs'],
+             'cells': block['cells']} for block in slowest[:5]]
+        return summary
+
+    def close(self, **fields):
+        """Record the summary of the run and return it as a string"""
+        summary = self.summary()
+        summary.update(fields)
+        self.record('run', **summary)
+        return format_summary(summary)
+
+
+def format_summary(summary):
+    """Human-readable summary of a run"""
+    block_time = max(summary['block_time'], 1e-12)
+
+    def share(key):
+        return '{:.1f}s ({:.0f}%)'.format(summary[key],
+                                          100 * summary[key] / block_time)
+    lines = [
+        'Distance computation: {:.1f}s, {} blocks, {} pairs computed, {} '
+        'pairs from the cache, {} DTW cells'.format(
+            summary['wall_time'], summary['blocks'], summary['pairs'],
+            summary['cached_pairs'], summary['cells']),
+        '  time in blocks: {:.1f}s, loading features {}, computing {}, '
+        'distance cache {}, writing {}'.format(
+            summary['block_time'], share('load_time'), share('compute_time'),
+            share('cache_time'), share('write_time')),
+        '  merges of the worker shards: {} in {:.1f}s'.format(
+            summary['merges'], summary['merge_time'])]
+    if summary['cells_per_second'] is not None:
+        lines.append('  throughput: {:.3g} cells/s per cpu'.format(
+            summary['cells_per_second']))
+    for block in summary['slowest_blocks']:
+        lines.append('  slow block {} rows {}-{}: {:.1f}s, {} pairs, {} cells'
+                     .format(block['by'], block['rows'][0], block['rows'][1],
+                             block['wall_time'], block['pairs'],
+                             block['cells']))
+    return '\n'.join(lines)
+
+
+def _to_json(value):
+    # numpy scalars and arrays, bytes
+    if hasattr(value, 'tolist'):
+        value = value.tolist()
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    if isinstance(value, (list, tuple)):
+        return [_to_json(v) for v in value]
+    if isinstance(value, dict):
+        return dict((k, _to_json(v)) for k, v in value.items())
+    return value
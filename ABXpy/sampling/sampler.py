@@ -114,12 +114,40 @@ class IncrementalSampler(object):
             the indices to be kept relative to the current position
             in the sample
         """
-        k = hypergeometric_sample(self.N, self.K, n)  # get the sample size
+        # get the sample size (the arithmetic between the numpy uint64 self.N,
+        # self.K and python integers can give floats)
+        k = int(hypergeometric_sample(self.N, self.K, n))
         sample = sample_without_replacement(k, n, self.type)
         self.N = self.N - n
         self.K = self.K - k
         return sample
 
+    def split(self, sizes):
+        """get the sample sizes of the next groups of items
+
+        The items are consumed as by successive calls to sample, so that the
+        groups can then be sampled independently.
+
+        Parameters
+        ----------
+        sizes : list
+            the sizes of the successive groups
+        Returns
+        -------
+        sample_sizes : list
+            the number of items to be sampled in each group
+        """
+        sample_sizes = []
+        for n in sizes:
+            if n == 0:
+                k = 0
+            else:
+                k = int(hypergeometric_sample(self.N, self.K, n))
+            self.N = self.N - n
+            self.K = self.K - k
+            sample_sizes.append(k)
+        return sample_sizes
+
 
 # function np.random.hypergeometric is buggy so I did my own
 # implementation...  (error, at least, line 784 in computation of
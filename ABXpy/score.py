@@ -51,12 +51,17 @@ if not(package_path in sys.path):
 
 import h5py
 import numpy as np
+import pandas
 import ABXpy.h5tools.h52np as h52np
 import ABXpy.h5tools.np2h5 as np2h5
 import ABXpy.misc.type_fitting as type_fitting
+import ABXpy.task
+import ABXpy.distances.distances as distances
+import ABXpy.distances.block_distances as block_distances
+import ABXpy.distances.registry as registry
+import ABXpy.distances.metrics.dtw as dtw
 
 
-# FIXME: include distance computation here
 def score(task_file, distance_file, score_file=None, score_group='scores'):
     """Calculate the score of a task and put the results in a hdf5 file.
 
@@ -88,6 +93,9 @@ def score(task_file, distance_file, score_file=None, score_group='scores'):
         bys = t['bys'][...]
         # bys = t['feat_dbs'].keys()
         n_triplets = t['triplets']['data'].shape[0]
+        # pairs (a, b) and (b, a) are encoded in the same way if the task
+        # was generated with symmetric pairs
+        symmetric = bool(t['unique_pairs/data'].attrs.get('symmetric', False))
     with h5py.File(score_file) as s:
         s.create_dataset('scores', (n_triplets, 1), dtype=np.int8)
         for n_by, by in enumerate(bys):
@@ -102,30 +110,291 @@ def score(task_file, distance_file, score_file=None, score_group='scores'):
                 pairs = t['unique_pairs']['data'][pair_attrs[1]:pair_attrs[2]][...]
                 pairs = np.reshape(pairs, pairs.shape[0])
                 base = pair_attrs[0]
-                pair_key_type = type_fitting.fit_integer_type((base) ** 2 - 1,
-                                                              is_signed=False)
-            with h52np.H52NP(task_file) as t:
-                inp = t.add_subdataset('triplets', 'data', indexes=trip_attrs)
-                idx_start = trip_attrs[0]
-                for triplets in inp:
-                    triplets = pair_key_type(triplets)
-                    idx_end = idx_start + triplets.shape[0]
-
-                    pairs_AX = triplets[:, 0] + base * triplets[:, 2]
-                    # FIXME change the encoding (and type_fitting) so that
-                    # A,B and B,A have the same code ... (take a=min(a,b),
-                    # b=max(a,b))
-                    pairs_BX = triplets[:, 1] + base * triplets[:, 2]
-                    dis_AX = dis[np.searchsorted(pairs, pairs_AX)]
-
-                    dis_BX = dis[np.searchsorted(pairs, pairs_BX)]
-                    scores = (np.int8(dis_AX < dis_BX) -
-                              np.int8(dis_AX > dis_BX))
-                    # 1 if X closer to A, -1 if X closer to B, 0 if equal
-                    # distance (this doesn't use 0, 1/2, 1 to use the
-                    # compact np.int8 data format)
-                    s['scores'][idx_start:idx_end] = np.reshape(scores, (-1, 1))
-                    idx_start = idx_end
+            score_triplets(s['scores'], task_file, trip_attrs, pairs, base,
+                           symmetric,
+                           lambda i_AX, i_BX: compare(dis[i_AX], dis[i_BX]))
+
+
+def score_with_bounds(task_file, feature_file, score_file=None,
+                      normalized=True, feature_group='features',
+                      max_cells=10 ** 7):
+    """Calculate the score of a task with the dtw cosine distance, computing
+    exact distances only when needed
+
+    Only the sign of d(A, X) - d(B, X) is needed for the score of a triplet.
+    Cheap lower and upper bounds are first computed for the distance of
+    every pair, without computing their frame-by-frame distance matrix (see
+    block_distances.dtw_cosine_bounds), and the exact distances are only
+    computed for the triplets that cannot be decided from the bounds. The
+    computation of d(B, X) is then abandoned as soon as it is known to exceed
+    d(A, X).
+
+    The scores are the same as those obtained with score from the distances
+    computed with ABXpy.distance.default_distance (up to rounding errors) but
+    no distance file is needed.
+
+    Parameters
+    ----------
+    task_file : string
+        The hdf5 file containing the task (with the triplets and pairs
+        generated)
+    feature_file : string
+        The h5features file containing the features of the items
+    score_file : string, optional
+        The hdf5 file that will contain the results
+    normalized : bool, optional
+        whether the DTW cost is normalized by the length of the path
+    feature_group : string, optional
+        group to read in the h5features file
+    max_cells : int, optional
+        maximum number of frame-by-frame distances computed by a single
+        matrix product, controls the memory used
+    """
+    if score_file is None:
+        (basename_task, _) = os.path.splitext(task_file)
+        (basename_feat, _) = os.path.splitext(feature_file)
+        score_file = basename_task + '_' + basename_feat + '.score'
+    # file verification:
+    assert os.path.exists(task_file), 'Cannot find task file ' + task_file
+    assert os.path.exists(feature_file), ('Cannot find feature file ' +
+                                          feature_file)
+    assert not os.path.exists(score_file), ('score file already exist ' +
+                                            score_file)
+    normalized = bool(normalized)
+    times, features = distances.load_features([feature_file],
+                                              [feature_group])
+    get_features = distances.Features_Accessor(
+        times, features).get_features_from_raw
+    with h5py.File(task_file) as t:
+        bys = t['bys'][...]
+        n_triplets = t['triplets']['data'].shape[0]
+        symmetric = bool(t['unique_pairs/data'].attrs.get('symmetric', False))
+    with h5py.File(score_file) as s:
+        s.create_dataset('scores', (n_triplets, 1), dtype=np.int8)
+        for n_by, by in enumerate(bys):
+            with h5py.File(task_file) as t:
+                trip_attrs = t['triplets']['by_index'][n_by]
+                pair_attrs = t['unique_pairs'].attrs[by]
+                pairs = t['unique_pairs']['data'][pair_attrs[1]:pair_attrs[2]][...]
+                pairs = np.reshape(pairs, pairs.shape[0])
+                base = pair_attrs[0]
+            store = pandas.HDFStore(task_file)
+            by_db = store['feat_dbs/' + by]
+            store.close()
+            items = np.column_stack([np.mod(pairs, base), pairs // base])
+            by_features = get_features(by_db.iloc[np.unique(items)])
+            bounds = PairBounds(by_features, items, normalized, max_cells)
+            score_triplets(s['scores'], task_file, trip_attrs, pairs, base,
+                           symmetric, bounds.scores)
+
+
+def score_with_distance(task_file, feature_file, metric='dtw_cosine',
+                        score_file=None, normalized=True,
+                        feature_group='features'):
+    """Calculate the score of a task, computing the distances by block
+
+    The distances of the pairs of each 'by' block are computed in memory
+    with the metric and the triplets of the block are scored right away, so
+    that no distance file is written. The scores are the same as those
+    obtained with score from the distances computed with
+    ABXpy.distances.distances.compute_distances.
+
+    Parameters
+    ----------
+    task_file : string
+        The hdf5 file containing the task (with the triplets and pairs
+        generated)
+    feature_file : string
+        The h5features file containing the features of the items
+    metric : string or ABXpy.distances.registry.Metric, optional
+        the distance, or the name of a registered metric, computed with the
+        kernel chosen from its capabilities (see Metric.block_kernel)
+    score_file : string, optional
+        The hdf5 file that will contain the results
+    normalized : bool, optional
+        normalization flag passed to the metric
+    feature_group : string, optional
+        group to read in the h5features file
+    """
+    if score_file is None:
+        (basename_task, _) = os.path.splitext(task_file)
+        (basename_feat, _) = os.path.splitext(feature_file)
+        score_file = basename_task + '_' + basename_feat + '.score'
+    # file verification:
+    assert os.path.exists(task_file), 'Cannot find task file ' + task_file
+    assert os.path.exists(feature_file), ('Cannot find feature file ' +
+                                          feature_file)
+    assert not os.path.exists(score_file), ('score file already exist ' +
+                                            score_file)
+    if not(isinstance(metric, registry.Metric)):
+        metric = registry.get_metric(metric)
+    kernel = metric.block_kernel()
+    normalized = distances.normalization_flag(normalized)
+    times, features = distances.load_features([feature_file],
+                                              [feature_group])
+    get_features = distances.Features_Accessor(
+        times, features).get_features_from_raw
+    with h5py.File(task_file) as t:
+        bys = t['bys'][...]
+        n_triplets = t['triplets']['data'].shape[0]
+        symmetric = bool(t['unique_pairs/data'].attrs.get('symmetric', False))
+    with h5py.File(score_file) as s:
+        s.create_dataset('scores', (n_triplets, 1), dtype=np.int8)
+        for n_by, by in enumerate(bys):
+            with h5py.File(task_file) as t:
+                trip_attrs = t['triplets']['by_index'][n_by]
+                pair_attrs = t['unique_pairs'].attrs[by]
+                pairs = t['unique_pairs']['data'][pair_attrs[1]:pair_attrs[2]][...]
+                pairs = np.reshape(pairs, pairs.shape[0])
+                base = pair_attrs[0]
+            if pairs.shape[0] == 0:
+                continue
+            store = pandas.HDFStore(task_file)
+            by_db = store['feat_dbs/' + by]
+            store.close()
+            items = np.column_stack([np.mod(pairs, base), pairs // base])
+            by_features = get_features(by_db.iloc[np.unique(items)])
+            dis = np.asarray(kernel(by_features, items, normalized))
+            del by_features
+            score_triplets(s['scores'], task_file, trip_attrs, pairs, base,
+                           symmetric,
+                           lambda i_AX, i_BX: compare(dis[i_AX], dis[i_BX]))
+
+
+def score_triplets(scores, task_file, trip_attrs, pairs, base, symmetric,
+                   score_pairs):
+    """Score the triplets of a 'by' block
+
+    Parameters
+    ----------
+    scores : h5py.Dataset
+        the scores dataset, the scores of the triplets of the block are
+        written at their position in the task
+    task_file : string
+        the task file
+    trip_attrs : numpy.Array
+        first and last (included) triplets of the block in the task
+    pairs : numpy.Array
+        sorted codes of the unique pairs of the block
+    base : int
+        base of the pair codes
+    symmetric : bool
+        whether the pairs were generated with the symmetric encoding
+    score_pairs : callable
+        score_pairs(i_AX, i_BX) returns the scores of the triplets whose AX
+        and BX pairs are pairs[i_AX] and pairs[i_BX] (see compare)
+    """
+    pair_key_type = type_fitting.fit_integer_type((base) ** 2 - 1,
+                                                  is_signed=False)
+    with h52np.H52NP(task_file) as t:
+        inp = t.add_subdataset('triplets', 'data', indexes=trip_attrs)
+        idx_start = trip_attrs[0]
+        for triplets in inp:
+            triplets = pair_key_type(triplets)
+            idx_end = idx_start + triplets.shape[0]
+            i_AX = np.searchsorted(pairs, ABXpy.task.pair_codes(
+                triplets[:, 0], triplets[:, 2], base, symmetric))
+            i_BX = np.searchsorted(pairs, ABXpy.task.pair_codes(
+                triplets[:, 1], triplets[:, 2], base, symmetric))
+            scores[idx_start:idx_end] = np.reshape(score_pairs(i_AX, i_BX),
+                                                   (-1, 1))
+            idx_start = idx_end
+
+
+def compare(dis_AX, dis_BX):
+    """Scores of triplets from their AX and BX distances
+
+    1 if X closer to A, -1 if X closer to B, 0 if equal distance (this
+    doesn't use 0, 1/2, 1 to use the compact np.int8 data format)
+    """
+    return np.int8(dis_AX < dis_BX) - np.int8(dis_AX > dis_BX)
+
+
+class PairBounds(object):
+
+    """Bounds and exact values of the dtw cosine distances of the pairs of
+    a by block, the exact values being computed only when needed"""
+
+    # relative margin on the bounds, to account for the rounding errors
+    # between the computation of the bounds and of the distances
+    tolerance = 1e-9
+    # absolute margin on the frame distances in the bounds: the arccos of the
+    # cosine distance amplifies the rounding errors for close frames
+    frame_tolerance = 1e-6
+
+    def __init__(self, features, pairs, normalized, max_cells):
+        self.features = features
+        self.pairs = pairs
+        self.normalized = normalized
+        self.max_cells = max_cells
+        # the frame-by-frame distances are only computed for the pairs whose
+        # exact distance is needed (see compute)
+        lower, upper = block_distances.dtw_cosine_bounds(features, pairs,
+                                                         normalized)
+        # nan when not computed yet
+        self.exact = np.where(lower == upper, lower, np.nan)
+        if normalized:
+            margin = self.frame_tolerance
+        else:
+            # maximal length of a path
+            n_frames = {item: features[item].shape[0]
+                        for item in np.unique(pairs)}
+            margin = self.frame_tolerance * np.array(
+                [n_frames[a] + n_frames[b] - 1 for a, b in pairs])
+        self.lower = lower - margin
+        self.upper = upper + margin
+
+    def scores(self, i_AX, i_BX):
+        """Scores of the triplets whose AX and BX pairs are i_AX and i_BX
+
+        1 if X closer to A, -1 if X closer to B, 0 if equal distance
+        """
+        scores = np.zeros(i_AX.shape[0], dtype=np.int8)
+        closer_A = (self.upper[i_AX] * (1 + self.tolerance) <
+                    self.lower[i_BX] * (1 - self.tolerance))
+        closer_B = (self.upper[i_BX] * (1 + self.tolerance) <
+                    self.lower[i_AX] * (1 - self.tolerance))
+        scores[closer_A] = 1
+        scores[closer_B] = -1
+        undecided = np.where(~(closer_A | closer_B))[0]
+        if undecided.size > 0:
+            i_AX, i_BX = i_AX[undecided], i_BX[undecided]
+            self.compute(np.unique(i_AX))
+            dis_AX = self.exact[i_AX]
+            # the computation of a BX distance can be abandoned as soon as it
+            # is larger than all the AX distances it is compared to
+            BX, BX_triplets = np.unique(i_BX, return_inverse=True)
+            thresholds = np.empty(BX.shape[0])
+            thresholds.fill(-np.inf)
+            np.maximum.at(thresholds, BX_triplets, dis_AX)
+            dis_BX = self.compute(BX, thresholds)[BX_triplets]
+            scores[undecided] = (np.int8(dis_AX < dis_BX) -
+                                 np.int8(dis_AX > dis_BX))
+        return scores
+
+    def compute(self, pairs, thresholds=None):
+        """Distances of pairs, computed if not already known
+
+        If thresholds are given, the computation of the distance of pairs[k]
+        can be abandoned as soon as it exceeds thresholds[k], in which case
+        inf is returned.
+        """
+        dis = self.exact[pairs]
+        todo = np.where(np.isnan(dis))[0]
+        if todo.size > 0:
+            for p, d in block_distances.cosine_frame_distances(
+                    self.features, self.pairs[pairs[todo]], self.max_cells):
+                k = todo[p]
+                n, m = d.shape
+                if thresholds is None:
+                    dis[k] = dtw._dtw(n, m, d, self.normalized)
+                else:
+                    dis[k] = dtw._dtw_abandon(n, m, d, self.normalized,
+                                              thresholds[k])
+                # abandoned distances are not stored
+                if not(np.isinf(dis[k])):
+                    self.exact[pairs[k]] = dis[k]
+        return dis
 
 
 # FIXME write command-line interface
@@ -71,6 +71,13 @@ class FilterManager(side_operations_manager.SideOperationsManager):
     def on_across_by_filter(self, on_across_by_values):
         return singleton_filter(self.evaluate_on_across_by(on_across_by_values))
 
+    def on_across_by_table_filter(self, table):
+        # on_across_by_filter for each line of table, as a boolean array
+        keep = np.ones(len(table), dtype=bool)
+        for results in self.evaluate_on_across_by_table(table):
+            keep &= np.array([bool(result) for result in results], dtype=bool)
+        return keep
+
     def A_filter(self, on_across_by_values, db, indices):
         # Caution: indices contains db-related indices
         # but the returned result contains indices with respect to indices
@@ -89,6 +89,11 @@ class RegressorManager(side_operations_manager.SideOperationsManager):
         self.on_across_by_regressors = [
             result for result in self.evaluate_on_across_by(on_across_by_values)]
 
+    def on_across_by_table_regressors(self, table):
+        # on_across_by_regressors for each line of table
+        results = list(self.evaluate_on_across_by_table(table))
+        return [[rows[k] for rows in results] for k in range(len(table))]
+
     def set_A_regressors(self, on_across_by_values, db, indices):
         self.A_regressors = [
             result for result in self.evaluate_A(on_across_by_values, db, indices)]
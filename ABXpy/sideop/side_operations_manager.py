@@ -15,8 +15,10 @@ Class working closely with task.py providing services for it, specifically by:
       point in the execution flow to which they were attributed
 """
 
+import ast
 import copy
 import numpy as np
+import ABXpy.dbfun.dbfun_compute as dbfun_compute
 
 
 class SideOperationsManager(object):
@@ -334,6 +336,25 @@ class SideOperationsManager(object):
         # evaluate dbfuns
         return singleton_result_generator(self.on_across_by, context)
 
+    def set_on_across_by_table_context(self, context, stage, table):
+        # one element per line of table, i.e. per on/across block
+        for radical, extension in set.union(self.by_context[stage],
+                                            self.on_context[stage],
+                                            self.across_context[stage]):
+            context[radical + extension] = list(table[radical])
+        return context
+
+    def evaluate_on_across_by_table(self, table):
+        """Evaluate the on_across_by operations for several blocks at once
+
+        table is a DataFrame containing the on_across_by_values of one
+        on/across block per line. For each operation, yields the list of the
+        results that evaluate_on_across_by gives for each line.
+        """
+        context = self.set_on_across_by_table_context(
+            {}, 'on_across_by', table)
+        return table_result_generator(self.on_across_by, context, len(table))
+
     # possible optimization: group A, B, X context in case there is some
     # overlap ?
     def evaluate_A_B_X(self, name, on_across_by_values, db, indices, context=None):
@@ -388,6 +409,77 @@ def singleton_result_generator(db_funs, context):
     # each time
     return (db_fun.evaluate(copy.deepcopy(context))[0] for db_fun in db_funs)
 
+
+def table_result_generator(db_funs, context, n_rows):
+    # each db_fun is evaluated once for all the rows of the context, the
+    # results are then split as singleton_result_generator would give them
+    for db_fun in db_funs:
+        if n_rows == 0:
+            yield []
+        else:
+            yield split_rows(db_fun, context, n_rows)
+
+
+def split_rows(db_fun, context, n_rows):
+    """Singleton results of db_fun for each row of context
+
+    db_fun is evaluated once on the whole context when its result is known
+    to have one element per row, and once per row otherwise.
+    """
+    if isinstance(db_fun, dbfun_compute.DBfun_Compute):
+        if is_rowwise(db_fun):
+            result = db_fun.evaluate(copy.deepcopy(context))
+            if len(result) == n_rows:
+                return [result[k] for k in range(n_rows)]
+    else:
+        # lookup tables give one array per output, with one keyed value per
+        # row, the singleton result is the first output
+        result = db_fun.evaluate(copy.deepcopy(context))
+        if len(result[0]) == n_rows:
+            return [result[0][k:k + 1] for k in range(n_rows)]
+    return [db_fun.evaluate(dict((var, copy.deepcopy(values[k:k + 1]))
+                                 for var, values in context.items()))[0]
+            for k in range(n_rows)]
+
+
+def is_rowwise(db_fun):
+    """Whether the result of a DBfun_Compute has one element per row
+
+    Only the forms that cannot mix the rows of the context are recognized: a
+    column, or a list comprehension over a column (or over a zip of columns)
+    whose element does not refer to any column, e.g.
+    "[a == 0 for a in c0]". Anything else, such as comparing a column to its
+    mean, is evaluated row by row.
+    """
+    if db_fun.main_ast.body or db_fun.code_nodes:
+        return False
+    columns = set(db_fun.input_names)
+    expr = db_fun.final_ast.body
+    if isinstance(expr, ast.Name):
+        return expr.id in columns
+    if not isinstance(expr, ast.ListComp) or len(expr.generators) != 1:
+        return False
+    generator = expr.generators[0]
+    if generator.ifs:
+        return False
+    iterated = generator.iter
+    if (isinstance(iterated, ast.Call) and
+            isinstance(iterated.func, ast.Name) and
+            iterated.func.id == 'zip' and iterated.args and
+            not iterated.keywords and
+            getattr(iterated, 'starargs', None) is None):
+        iterated = iterated.args
+    else:
+        iterated = [iterated]
+    if not all(isinstance(it, ast.Name) and it.id in columns
+               for it in iterated):
+        return False
+    used = set(node.id for node in ast.walk(expr.elt)
+               if isinstance(node, ast.Name))
+    targets = set(node.id for node in ast.walk(generator.target)
+                  if isinstance(node, ast.Name))
+    return not (used - targets) & columns
+
 # db_fun.evaluate returns [[np_array_output_1_dbfun_1, np_array_output_2_dbfun_1,...], [np_array_output_1_dbfun_2, ...], ...]
 # Would the previous functions change with VLEN outputs that would change
 # this pattern ?
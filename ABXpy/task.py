@@ -71,10 +71,24 @@ import ABXpy.sideop.filter_manager as filter_manager
 import ABXpy.sideop.regressor_manager as regressor_manager
 import ABXpy.sampling.sampler as sampler
 import ABXpy.misc.progress_display as progress_display
+import multiprocessing
+import shutil
 import tempfile
+import traceback
+try:
+    import Queue as queue
+except ImportError:
+    import queue
 from tables import NaturalNameWarning
 from ABXpy.misc.type_fitting import fit_integer_type
 
+# number of triplets of successive on/across blocks accumulated before being
+# written to the task file (see Task._compute_triplets)
+WRITE_BATCH_SIZE = 10 ** 6
+# maximum number of candidate triplets of an on/across block generated at
+# once (see Task.on_across_triplet_chunks)
+CHUNK_SIZE = 10 ** 6
+
 # FIXME many of the fixmes should be presented as feature requests in a
 # github instead of fixmes
 """
@@ -232,7 +246,7 @@ class Task(object):
         self.on_blocks = {}
         self.across_blocks = {}
         self.on_across_blocks = {}
-        self.antiacross_blocks = {}
+        self.block_codes = {}
         by_groups = db.groupby(by)
 
         if self.verbose > 0:
@@ -267,15 +281,9 @@ class Task(object):
                     by_key].groupby(across)
                 self.on_across_blocks[by_key] = self.by_dbs[
                     by_key].groupby(on + across)
-                if len(across) > 1:
-                    self.antiacross_blocks[by_key] = dict()
-                    for across_key in (self.across_blocks[by_key]
-                                       .groups.iterkeys()):
-                        b = True
-                        for i, col in enumerate(across):
-                            b = b * (by_frame[col] != across_key[i])
-                        self.antiacross_blocks[by_key][
-                            across_key] = by_frame[b].index
+                self.block_codes[by_key] = block_codes(
+                    by_frame, self.on_blocks[by_key],
+                    self.across_blocks[by_key], across)
 
         # store parameters
         self.database = db_name
@@ -349,6 +357,7 @@ class Task(object):
                 self.stats['nb_blocks'])
 
         for by, db in self.by_dbs.iteritems():
+            by_db = ItemColumns(db)
             stats = self.by_stats[by]
             stats['block_sizes'] = {}
             stats['nb_triplets'] = 0
@@ -385,13 +394,10 @@ class Task(object):
                         stats['nb_triplets'] += n_A * n_B * n_X
                         stats['block_sizes'][block_key] = n_A * n_B * n_X
                     else:
-                        # count exact number of triplets, could be further
-                        # optimized because it isn't necessary to do the whole
-                        # triplet generation, in particular in the case where
-                        # there are no ABX filters
-                        nb_triplets = self.on_across_triplets(
+                        # count exact number of triplets
+                        nb_triplets = self.count_triplets(
                             by, on, across, block, on_across_by_values,
-                            with_regressors=False).shape[0]
+                            by_db=by_db)
                         stats['nb_triplets'] += nb_triplets
                         stats['block_sizes'][block_key] = nb_triplets
                 else:
@@ -404,7 +410,8 @@ class Task(object):
         self.n_blocks = self.stats['nb_blocks']
 
     def on_across_triplets(self, by, on, across, on_across_block,
-                           on_across_by_values, with_regressors=True):
+                           on_across_by_values, with_regressors=True,
+                           by_db=None):
         """Generate all possible triplets for a given by block.
 
         Given an on_across_block of the database and the parameters of the \
@@ -423,6 +430,10 @@ class Task(object):
             the actual values
         with_regressors : bool, optional
             By default, true
+        by_db : optional
+            the database of the by block used by the filters and
+            regressors, self.by_dbs[by] by default (or the corresponding
+            ItemColumns)
 
         Returns
         -------
@@ -431,32 +442,92 @@ class Task(object):
         regressors : numpy.Array
             the regressors generated
         """
+        A, B, X, db = self.block_items(by, on, across, on_across_block,
+                                       on_across_by_values, with_regressors,
+                                       by_db)
+        return self._block_triplets(by, A, B, X, on_across_by_values, db,
+                                    with_regressors)
+
+    def count_triplets(self, by, on, across, on_across_block,
+                       on_across_by_values, by_db=None):
+        """Exact number of triplets of an on/across block
+
+        The singleton filters select the A, B and X items independently, so
+        that in the absence of ABX filters the number of triplets is the
+        product of the numbers of A, B and X items and no triplet is
+        generated. Otherwise the ABX filters are evaluated on the candidate
+        triplets by chunks of at most CHUNK_SIZE triplets. The parameters are
+        the same as for on_across_triplets.
+
+        Returns
+        -------
+        nb_triplets : int
+            the number of triplets of the block, before sampling
+        """
+        A, B, X, db = self.block_items(by, on, across, on_across_block,
+                                       on_across_by_values, False, by_db)
+        size = len(A) * len(B) * len(X)
+        if not(self.filters.ABX):
+            return size
+        nb_triplets = 0
+        for start in range(0, size, CHUNK_SIZE):
+            indices = np.arange(start, min(start + CHUNK_SIZE, size))
+            iA, iB, iX = factorial_indices(indices, len(B), len(X))
+            nb_triplets += len(self.filters.ABX_filter(
+                on_across_by_values, db,
+                np.column_stack((A[iA], B[iB], X[iX]))))
+        return nb_triplets
+
+    def block_items(self, by, on, across, on_across_block,
+                    on_across_by_values, with_regressors=True, by_db=None):
+        """The A, B and X items of an on/across block
+
+        The singleton filters are applied and, if with_regressors, the A, B
+        and X regressors are instantiated (see on_across_triplets for the
+        parameters).
+
+        Returns
+        -------
+        A, B, X : numpy.Array
+            the items that can be used as A, B and X
+        db
+            the database of the by block used by the filters and regressors
+        """
         # find all possible A, B, X where A and X have the 'on' feature of the
         # block and A and B have the 'across' feature of the block
         A = np.array(on_across_block, dtype=self.types[by])
-        on_set = set(self.on_blocks[by].groups[on])
+        codes = self.block_codes[by]
+        same_on = codes['on'] == codes['on_keys'][on]
         # FIXME quick fix to process case whith no across, but better done in a
         # separate loop ...
         if self.across == ['#across']:
             # in this case A is a singleton and B can be anything in the by
             # block that doesn't have the same 'on' as A
-            B = np.array(
-                list(set(self.by_dbs[by].index).difference(on_set)),
-                dtype=self.types[by])
+            B = codes['items'][~same_on]
         else:
-            B = self.across_blocks[by].groups[across]
             # remove B with the same 'on' than A
-            B = np.array(list(set(B).difference(A)), dtype=self.types[by])
+            B = codes['items'][
+                (codes['across'] == codes['across_keys'][across]) & ~same_on]
+        B = B.astype(self.types[by])
         # remove X with the same 'across' than A
-
         if type(across) is tuple:
-            antiacross_set = set(self.antiacross_blocks[by][across])
-            X = np.array(list(antiacross_set & on_set), dtype=self.types[by])
+            # X differs from A on every 'across' column
+            anti_across = same_on
+            for (column_codes, column_keys), value in zip(
+                    codes['across_columns'], across):
+                anti_across = anti_across & (column_codes !=
+                                             column_keys[value])
+            X = codes['items'][anti_across]
         else:
-            X = np.array(list(on_set.difference(A)), dtype=self.types[by])
+            X = codes['items'][
+                same_on & (codes['across'] != codes['across_keys'][across])]
+        X = X.astype(self.types[by])
 
         # apply singleton filters
-        db = self.by_dbs[by]
+        if by_db is None:
+            db = self.by_dbs[by]
+        else:
+            db = by_db
 
         if self.filters.A:
             iA = self.filters.A_filter(on_across_by_values, db, A)
@@ -473,7 +544,10 @@ class Task(object):
             self.regressors.set_A_regressors(on_across_by_values, db, A)
             self.regressors.set_B_regressors(on_across_by_values, db, B)
             self.regressors.set_X_regressors(on_across_by_values, db, X)
+        return A, B, X, db
 
+    def _block_triplets(self, by, A, B, X, on_across_by_values, db,
+                        with_regressors=True):
         # A, B, X can then be combined efficiently in a full (or randomly
         # sampled) factorial design
         size = len(A) * len(B) * len(X)
@@ -487,9 +561,7 @@ class Task(object):
             else:
                 indices = np.arange(size, dtype=ind_type)
             # generate triplets from indices
-            iX = np.mod(indices, len(X))
-            iB = np.mod(np.divide(indices, len(X)), len(B))
-            iA = np.divide(indices, len(B) * len(X))
+            iA, iB, iX = factorial_indices(indices, len(B), len(X))
             triplets = np.column_stack((A[iA], B[iB], X[iX]))
 
             # apply triplets filters
@@ -633,6 +705,142 @@ class Task(object):
         else:
             return triplets
 
+    def on_across_triplet_chunks(self, by, on, across, on_across_block,
+                                 on_across_by_values, by_db=None):
+        """Generate the triplets of an on/across block by chunks
+
+        Blocks of at most CHUNK_SIZE candidate triplets (before the ABX
+        filters and the sampling) are generated at once by
+        on_across_triplets. Larger blocks are enumerated by chunks of at
+        most CHUNK_SIZE candidate triplets, each chunk going through the ABX
+        filters, the sampling and the regressors before the next one is
+        generated, so that the memory used does not depend on the size of
+        the block.
+
+        The parameters are the same as for on_across_triplets.
+
+        Yields
+        ------
+        triplets, regressors, on_across_block_index :
+            as returned by on_across_triplets, for successive parts of the
+            block (the on_across_block_index of all the parts together is
+            the one of the block)
+        """
+        A, B, X, db = self.block_items(by, on, across, on_across_block,
+                                       on_across_by_values, True, by_db)
+        if len(A) * len(B) * len(X) <= CHUNK_SIZE:
+            yield self._block_triplets(by, A, B, X, on_across_by_values, db)
+        else:
+            for chunk in self._stream_triplets(A, B, X, on_across_by_values,
+                                               db):
+                yield chunk
+
+    def _stream_triplets(self, A, B, X, on_across_by_values, db):
+        # The triplets with the same B and X regressors (indexed by the
+        # on_across_block_index and thresholded together) must be
+        # contiguous: instead of sorting the whole block, the triplets are
+        # enumerated in the order of their regressors.
+        B_codes = regressor_codes(
+            [reg for regs in self.regressors.B_regressors for reg in regs],
+            len(B))
+        X_codes = regressor_codes(
+            [reg for regs in self.regressors.X_regressors for reg in regs],
+            len(X))
+        if self.threshold:
+            group_sampler = GroupSampler(self.threshold)
+        n_rows = 0
+        previous_key = None
+        for keys, iA, iB, iX in self._candidate_chunks(
+                A, B, X, B_codes, X_codes, on_across_by_values, db):
+            if self.threshold:
+                groups = group_sampler.add(
+                    keys, np.column_stack((iA, iB, iX)))
+                if not(groups):
+                    continue
+                group_sizes = np.array([len(group) for group in groups])
+                block_index = n_rows + np.concatenate(
+                    ([0], np.cumsum(group_sizes)[:-1]))
+                iA, iB, iX = np.concatenate(groups).T
+            else:
+                if len(keys) == 0:
+                    continue
+                new_group = np.concatenate(([keys[0] != previous_key],
+                                            keys[1:] != keys[:-1]))
+                previous_key = keys[-1]
+                block_index = n_rows + np.flatnonzero(new_group)
+            yield self._chunk_triplets(A, B, X, iA, iB, iX,
+                                       on_across_by_values, db, block_index)
+            n_rows += len(iA)
+        if self.threshold:
+            group = group_sampler.flush()
+            if group is not None:
+                iA, iB, iX = group.T
+                yield self._chunk_triplets(A, B, X, iA, iB, iX,
+                                           on_across_by_values, db, [n_rows])
+                n_rows += len(iA)
+        # end of the last group
+        empty = np.empty(shape=0, dtype=np.int64)
+        yield self._chunk_triplets(A, B, X, empty, empty, empty,
+                                   on_across_by_values, db, [n_rows])
+
+    def _candidate_chunks(self, A, B, X, B_codes, X_codes,
+                          on_across_by_values, db):
+        # For each combination of B regressors, the candidate triplets are
+        # enumerated with X (in the order of the X regressors) varying the
+        # slowest, then A, then B, by chunks of at most CHUNK_SIZE. Yields the
+        # code of the regressors of the kept triplets (after ABX filtering
+        # and sampling) and their indices in A, B and X.
+        X_order = np.argsort(X_codes, kind='mergesort')
+        n_X_codes = np.max(X_codes) + 1
+        for B_code in np.unique(B_codes):
+            B_group = np.flatnonzero(B_codes == B_code)
+            size = len(X) * len(A) * len(B_group)
+            for start in range(0, size, CHUNK_SIZE):
+                stop = min(start + CHUNK_SIZE, size)
+                # if sampling in the absence of triplets filters, do it here
+                if self.sampling and not(self.filters.ABX):
+                    indices = start + self.sampler.sample(stop - start)
+                else:
+                    indices = np.arange(start, stop)
+                jX, iA, jB = factorial_indices(indices, len(A),
+                                               len(B_group))
+                iX, iB = X_order[jX], B_group[jB]
+                if self.filters.ABX:
+                    kept = self.filters.ABX_filter(
+                        on_across_by_values, db,
+                        np.column_stack((A[iA], B[iB], X[iX])))
+                    # if sampling in the presence of triplets filters, do it
+                    # here
+                    if self.sampling:
+                        kept = kept[self.sampler.sample(len(kept))]
+                    iA, iB, iX = iA[kept], iB[kept], iX[kept]
+                yield B_code * n_X_codes + X_codes[iX], iA, iB, iX
+
+    def _chunk_triplets(self, A, B, X, iA, iB, iX, on_across_by_values, db,
+                        on_across_block_index):
+        # triplets and regressors of a chunk (see on_across_triplets)
+        triplets = np.column_stack((A[iA], B[iB], X[iX]))
+        if self.regressors.ABX:  # instantiate ABX regressors here
+            self.regressors.set_ABX_regressors(
+                on_across_by_values, db, triplets)
+        regressors = {}
+        scalar_names = self.regressors.by_names + \
+            self.regressors.on_across_by_names
+        scalar_regressors = self.regressors.by_regressors + \
+            self.regressors.on_across_by_regressors
+        for names, regs in zip(scalar_names, scalar_regressors):
+            for name, reg in zip(names, regs):
+                regressors[name] = np.tile(np.array(reg),
+                                           (np.size(triplets, 0), 1))
+        for field, indices in [('A', iA), ('B', iB), ('X', iX)]:
+            for names, regs in zip(getattr(self.regressors, field + '_names'),
+                                   getattr(self.regressors,
+                                           field + '_regressors')):
+                for name, reg in zip(names, regs):
+                    regressors[name] = reg[indices]
+        return triplets, regressors, np.array(
+            on_across_block_index, dtype=np.int64)[:, None]
+
     # FIXME add a mechanism to allow the specification of a random seed in a
     # way that would produce reliably the same triplets on different machines
     # (means cross-platform random number generator + having its state so as
@@ -640,7 +848,7 @@ class Task(object):
     # altering the sequence)
     # FIXME in case of sampling, get rid of blocks with no samples ?
     def generate_triplets(self, output=None, sample=None, threshold=None,
-                          tmpdir=None):
+                          tmpdir=None, symmetric=False, n_cpu=1):
         """Generate all possible triplets for the whole task and the \
 associated pairs
 
@@ -655,6 +863,15 @@ associated pairs
 
         sample : bool, optional
                  apply the function on a sample of the task
+
+        symmetric : bool, optional
+                 encode the pairs (a, b) and (b, a) in the same way, so that
+                 only one distance is computed for both. Only valid for
+                 symmetric distances.
+
+        n_cpu : int, optional
+                 number of processes generating the triplets and pairs of
+                 the by blocks in parallel (see generate_in_parallel)
         """
         if self.stats['nb_triplets'] == 0:
             warnings.warn('There are no possible ABX triplets'
@@ -703,115 +920,349 @@ associated pairs
             display.add(
                 'sampled_triplets', 'Triplets sampled:', self.n_triplets)
 
-        self.by_block_indices = [0]
-        self.current_index = 0
         # fill output file with list of needed ABX triplets, it is done
         # independently for each 'by' value
+        if n_cpu > 1 and len(self.by_dbs) > 1:
+            self.generate_in_parallel(output, n_cpu, tmpdir=tmpdir,
+                                      symmetric=symmetric)
+            return
 
         with np2h5.NP2H5(h5file=output) as fh:
-            # FIXME test if not fixed size impacts performance a lot
-            out = fh.add_dataset(
-                group='triplets', dataset='data',
-                n_rows=self.n_triplets, n_columns=3,
-                item_type=fit_integer_type(self.total_n_triplets),
-                fixed_size=False)
-
-            out_block_index = fh.add_dataset(
-                group='triplets', dataset='on_across_block_index',
-                n_rows=self.stats['nb_blocks'], n_columns=1,
-                item_type=fit_integer_type(self.stats['nb_blocks']),
-                fixed_size=False)  # TODO add item type
-            empty_by_blocks = []
-            bys = []
-            for by, db in self.by_dbs.iteritems():
-                # class for efficiently writing to datasets of the output file
-                # (using a buffer under the hood)
-                if self.verbose > 0:
-                    print("Writing ABX triplets to task file...")
-
-                # allow to get by values as well as values of other
-                # variables that are determined by these
-                by_values = dict(db.iloc[0])
-
-                datasets, indexes = self.regressors.get_regressor_info()
-                with (h5io.H5IO(
-                        filename=output, datasets=datasets,
-                        indexes=indexes,
-                        group='/regressors/' + str(by) + '/')) as out_regs:
-                    self._compute_triplets(
-                        by, out, out_block_index,
-                        out_regs, sample, db, fh, by_values, display=display)
-
-                    # if no triplets found: delete by block
-                    if self.current_index == self.by_block_indices[-1]:
-                        empty_by_blocks.append(by)
-                    else:
-                        self.by_block_indices.append(self.current_index)
-                        bys.append(by)
-
-            # saving by index, deleting empty by blocks:
-            aux = np.array(self.by_block_indices,
-                           dtype=fit_integer_type(self.by_block_indices[-1]))
-            self.by_block_indices = np.hstack((aux[:-1, None], aux[1:, None]))
-            for by in empty_by_blocks:
-                del self.by_dbs[by]
-            fh.file.create_dataset(
-                'bys', (aux.shape[0] - 1,),
-                dtype=h5py.special_dtype(vlen=unicode))
-            fh.file['bys'][:] = [str(by) for by in bys]
-            fh.file['triplets'].create_dataset(
-                'by_index', data=self.by_block_indices)
-
-            fh.file['triplets/data'].resize(aux[-1], axis=0)
+            rows = self._write_by_triplets(fh, list(self.by_dbs),
+                                           self.n_triplets, display=display)
+            self._write_by_index(fh, rows)
 
         if self.verbose > 0:
             print("done.")
         with warnings.catch_warnings():
             warnings.simplefilter("ignore", NaturalNameWarning)
-            self.generate_pairs(output, tmpdir=tmpdir)
+            self.generate_pairs(output, tmpdir=tmpdir, symmetric=symmetric)
+
+    def _add_triplet_datasets(self, fh, n_rows):
+        # the triplets and on/across block index datasets of a task file
+        # (or of a shard, see generate_in_parallel)
+        # FIXME test if not fixed size impacts performance a lot
+        out = fh.add_dataset(
+            group='triplets', dataset='data',
+            n_rows=n_rows, n_columns=3,
+            item_type=fit_integer_type(self.total_n_triplets),
+            fixed_size=False)
+        out_block_index = fh.add_dataset(
+            group='triplets', dataset='on_across_block_index',
+            n_rows=self.stats['nb_blocks'], n_columns=1,
+            item_type=fit_integer_type(self.stats['nb_blocks']),
+            fixed_size=False)  # TODO add item type
+        return out, out_block_index
+
+    def _write_by_triplets(self, fh, bys, n_rows, samples=None,
+                           display=None):
+        # Write the triplets, regressors and on/across block indices of the
+        # by blocks bys to the file opened by fh (a np2h5.NP2H5). If samples
+        # is specified, the triplets of each by block are sampled
+        # independently, samples[by] among by_stats[by]['nb_triplets'].
+        # Returns a list of (by, triplet rows, on/across block index rows).
+        out, out_block_index = self._add_triplet_datasets(fh, n_rows)
+        self.current_index = 0
+        self.current_block_index = 0
+        rows = []
+        for by in bys:
+            db = self.by_dbs[by]
+            # class for efficiently writing to datasets of the output file
+            # (using a buffer under the hood)
+            if self.verbose > 0:
+                print("Writing ABX triplets to task file...")
+            if samples is not None:
+                self.sampler = sampler.IncrementalSampler(
+                    self.by_stats[by]['nb_triplets'], samples[by], step=1)
+
+            # allow to get by values as well as values of other
+            # variables that are determined by these
+            by_values = dict(db.iloc[0])
+
+            start = self.current_index
+            block_start = self.current_block_index
+            datasets, indexes = self.regressors.get_regressor_info()
+            with (h5io.H5IO(
+                    filename=fh.filename, datasets=datasets,
+                    indexes=indexes,
+                    group='/regressors/' + str(by) + '/')) as out_regs:
+                self._compute_triplets(
+                    by, out, out_block_index,
+                    out_regs, db, by_values, display=display)
+            rows.append((by, (start, self.current_index),
+                         (block_start, self.current_block_index)))
+        return rows
+
+    def _write_by_index(self, fh, rows):
+        # saving by index, deleting empty by blocks (rows as returned by
+        # _write_by_triplets)
+        self.by_block_indices = [0]
+        bys = []
+        for by, (start, stop), _ in rows:
+            # if no triplets found: delete by block
+            if stop == start:
+                del self.by_dbs[by]
+            else:
+                self.by_block_indices.append(stop)
+                bys.append(by)
+        aux = np.array(self.by_block_indices,
+                       dtype=fit_integer_type(self.by_block_indices[-1]))
+        self.by_block_indices = np.hstack((aux[:-1, None], aux[1:, None]))
+        fh.file.create_dataset(
+            'bys', (aux.shape[0] - 1,),
+            dtype=h5py.special_dtype(vlen=unicode))
+        fh.file['bys'][:] = [str(by) for by in bys]
+        fh.file['triplets'].create_dataset(
+            'by_index', data=self.by_block_indices)
+
+        fh.file['triplets/data'].resize(aux[-1], axis=0)
 
     def _compute_triplets(self, by, out, out_block_index,
-                          out_regs, sample, db, fh, by_values, display=None):
-        #out_index = h5io.H5IO(filename=output, datasets=datasets, group='/on_across_block_index/' + str(by) + '/')
+                          out_regs, db, by_values, display=None):
+        # The on/across blocks of the by block are processed together: their
+        # on_across_by filters and regressors are evaluated column-wise on a
+        # table with one line per block and the triplets, regressors and
+        # block indices of successive blocks are written with a single call
+        # per dataset (at least every WRITE_BATCH_SIZE triplets).
 
         # instantiate by regressors here
         self.regressors.set_by_regressors(by_values)
 
-        # iterate over on/across blocks
-        for block_key, block in (self.on_across_blocks[by]
-                                 .groups.iteritems()):
+        groups = self.on_across_blocks[by].groups
+        block_keys = list(groups.keys())
+        if not(block_keys):
+            return
+        # allow to get on, across, by values as well as values of other
+        # variables that are determined by these
+        table = db.loc[[groups[block_key][0] for block_key in block_keys]]
+        if self.filters.on_across_by:
+            kept = np.flatnonzero(
+                self.filters.on_across_by_table_filter(table))
+            table = table.iloc[kept]
+        else:
+            kept = np.arange(len(block_keys))
+        # instantiate on_across_by regressors here
+        block_regressors = self.regressors.on_across_by_table_regressors(
+            table)
+        by_db = ItemColumns(db)
+        batch = []
+        batch_size = 0
+        for block_values, regressors, k in zip(
+                table.to_dict('records'), block_regressors, kept):
+            block_key = block_keys[k]
+            self.regressors.on_across_by_regressors = regressors
+            on, across = on_across_from_key(block_key)
+            for chunk in self.on_across_triplet_chunks(
+                    by, on, across, groups[block_key], block_values,
+                    by_db=by_db):
+                batch.append(chunk)
+                batch_size += chunk[0].shape[0]
+                if batch_size >= WRITE_BATCH_SIZE:
+                    self._write_triplets(batch, out, out_regs,
+                                         out_block_index, display)
+                    batch = []
+                    batch_size = 0
             if self.verbose > 0:
-                display.update('block', 1)
-            # allow to get on, across, by values as well as values
-            # of other variables that are determined by these
-            on_across_by_values = dict(db.ix[block[0]])
-            if ((self.filters
-                 .on_across_by_filter(on_across_by_values))):
-                # instantiate on_across_by regressors here
-                self.regressors.set_on_across_by_regressors(
-                    on_across_by_values)
-                on, across = on_across_from_key(block_key)
-                triplets, regressors, on_across_block_index = (
-                    self.on_across_triplets(
-                        by, on, across, block, on_across_by_values))
-                out.write(triplets)
-                out_regs.write(regressors, indexed=True)
-                out_block_index.write(on_across_block_index)
-                self.current_index += triplets.shape[0]
-                if self.verbose > 0:
-                    display.update(
-                        'sampled_triplets', triplets.shape[0])
-                    display.update('triplets',
-                                   (self.by_stats[by]
-                                    ['block_sizes'][block_key]))
+                display.update('triplets',
+                               self.by_stats[by]['block_sizes'][block_key])
+        if batch:
+            self._write_triplets(batch, out, out_regs, out_block_index,
+                                 display)
+        if self.verbose > 0:
+            display.update('block', len(block_keys))
+            display.display()
+
+    def _write_triplets(self, batch, out, out_regs, out_block_index,
+                        display=None):
+        # write the triplets, regressors and block indices of several blocks
+        # (as returned by on_across_triplet_chunks) in a single call per
+        # dataset
+        triplets = np.concatenate([block[0] for block in batch])
+        regressors = dict(
+            (name, np.concatenate([block[1][name] for block in batch]))
+            for name in batch[0][1])
+        on_across_block_index = np.concatenate([block[2] for block in batch])
+        out.write(triplets)
+        out_regs.write(regressors, indexed=True)
+        out_block_index.write(on_across_block_index)
+        self.current_index += triplets.shape[0]
+        self.current_block_index += on_across_block_index.shape[0]
+        if self.verbose > 0:
+            display.update('sampled_triplets', triplets.shape[0])
+
+    def generate_in_parallel(self, output, n_cpu, tmpdir=None,
+                             symmetric=False):
+        """Generate the triplets and pairs of the by blocks with n_cpu
+        worker processes
+
+        The by blocks are distributed between the workers so as to balance
+        their number of triplets. Each worker writes the triplets,
+        regressors and on/across block indices of its by blocks to its own
+        shard file, then computes their unique pairs into a second shard
+        file (a temporary directory in tmpdir holds the shards). The calling
+        process then copies the shards to the task file, by block after by
+        block, in the same order as generate_triplets with n_cpu=1.
+
+        When sampling, the number of triplets sampled in each by block is
+        drawn beforehand, so that the by blocks can be sampled
+        independently.
+
+        .. note:: This function is called by generate_triplets and should not
+            be used independantly
+        """
+        bys = list(self.by_dbs)
+        n_workers = min(n_cpu, len(bys))
+        # assign the by blocks to the least loaded worker, largest first
+        owners = {}
+        loads = np.zeros(n_workers)
+        for by in sorted(bys,
+                         key=lambda by: -self.by_stats[by]['nb_triplets']):
+            owners[by] = np.argmin(loads)
+            loads[owners[by]] += self.by_stats[by]['nb_triplets']
+        if self.sampling:
+            samples = self.sampler.split(
+                [self.by_stats[by]['nb_triplets'] for by in bys])
+            samples = dict(zip(bys, samples))
+        else:
+            samples = None
+
+        if self.verbose > 0:
+            print("Computing triplets and pairs with %d processes..."
+                  % n_workers)
+        shard_dir = tempfile.mkdtemp(dir=tmpdir)
+        try:
+            results = multiprocessing.Queue()
+            processes = []
+            for w in range(n_workers):
+                # keep the order of the by blocks in the task file
+                worker_bys = [by for by in bys if owners[by] == w]
+                process = multiprocessing.Process(
+                    target=self._by_blocks_worker,
+                    args=(w, worker_bys, samples, shard_dir, tmpdir,
+                          symmetric, results))
+                process.daemon = True
+                process.start()
+                processes.append(process)
+            shard_rows = {}
+            n_pairs = {}
+            try:
+                for n_done in range(1, n_workers + 1):
+                    message = None
+                    while message is None:
+                        try:
+                            message = results.get(timeout=1.)
+                        except queue.Empty:
+                            for w, process in enumerate(processes):
+                                if process.exitcode not in (None, 0):
+                                    raise RuntimeError(
+                                        'Task worker {} died (exit code {})'
+                                        .format(w, process.exitcode))
+                    if message[0] == 'error':
+                        raise RuntimeError(
+                            'Error in task worker {}:\n{}'.format(
+                                message[1], message[2]))
+                    _, w, worker_rows, worker_n_pairs = message
+                    shard_rows.update(worker_rows)
+                    n_pairs.update(worker_n_pairs)
+                    if self.verbose > 0:
+                        print('Computed triplets and pairs for worker %d on '
+                              '%d' % (n_done, n_workers))
+            finally:
+                for process in processes:
+                    if process.is_alive():
+                        process.terminate()
+                    process.join()
+
             if self.verbose > 0:
-                display.display()
+                print("Merging the worker shards to the task file...")
+            shards = [os.path.join(shard_dir, 'triplets_%d' % w)
+                      for w in range(n_workers)]
+            with np2h5.NP2H5(h5file=output) as fh:
+                rows = self._merge_triplet_shards(fh, bys, owners, shards,
+                                                  shard_rows)
+                self._write_by_index(fh, rows)
+            pair_files = dict(
+                (by, os.path.join(shard_dir, 'pairs_%d' % owners[by]))
+                for by in n_pairs)
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", NaturalNameWarning)
+                self._merge_pairs(output, pair_files, n_pairs, symmetric)
+        finally:
+            shutil.rmtree(shard_dir)
+        if self.verbose > 0:
+            print("done.")
+
+    def _by_blocks_worker(self, worker_id, bys, samples, shard_dir, tmpdir,
+                          symmetric, results):
+        # Worker process for generate_in_parallel: writes the triplets of the
+        # by blocks bys to the shard triplets_<worker_id> and their unique
+        # pairs to the shard pairs_<worker_id>, then sends back the position
+        # of the triplets of each by block in the first shard and its number
+        # of unique pairs.
+        try:
+            # the workers must not share the random state of their parent
+            np.random.seed()
+            self.verbose = 0
+            triplet_file = os.path.join(shard_dir, 'triplets_%d' % worker_id)
+            pair_file = os.path.join(shard_dir, 'pairs_%d' % worker_id)
+            if samples is None:
+                n_rows = sum(self.by_stats[by]['nb_triplets'] for by in bys)
+            else:
+                n_rows = sum(samples[by] for by in bys)
+            with np2h5.NP2H5(h5file=triplet_file) as fh:
+                rows = self._write_by_triplets(fh, bys, n_rows, samples)
+            n_pairs = {}
+            for by, (start, stop), _ in rows:
+                if stop > start:
+                    n_pairs[by] = self._by_block_pairs(
+                        triplet_file, (start, stop), by, pair_file,
+                        tmpdir=tmpdir, symmetric=symmetric)
+            results.put(('done', worker_id,
+                         dict((by, (triplet_rows, block_rows))
+                              for by, triplet_rows, block_rows in rows),
+                         n_pairs))
+        except:
+            results.put(('error', worker_id, traceback.format_exc()))
+
+    def _merge_triplet_shards(self, fh, bys, owners, shards, shard_rows):
+        # copy the triplets, regressors and on/across block indices of each
+        # by block from the shard of its worker to the file opened by fh,
+        # returns the rows of each by block in fh (as _write_by_triplets)
+        out, out_block_index = self._add_triplet_datasets(fh,
+                                                          self.n_triplets)
+        shards = [h5py.File(shard, 'r') for shard in shards]
+        try:
+            regressors = fh.file.require_group('regressors')
+            rows = []
+            index = 0
+            for by in bys:
+                shard = shards[owners[by]]
+                (start, stop), (block_start, block_stop) = shard_rows[by]
+                for i in range(start, stop, WRITE_BATCH_SIZE):
+                    out.write(shard['triplets/data'][
+                        i:min(i + WRITE_BATCH_SIZE, stop)])
+                out_block_index.write(shard['triplets/on_across_block_index'][
+                    block_start:block_stop])
+                shard.copy(shard['regressors/' + str(by)], regressors,
+                           name=str(by))
+                rows.append((by, (index, index + stop - start), None))
+                index += stop - start
+        finally:
+            for shard in shards:
+                shard.close()
+        return rows
 
     # FIXME clean this function (maybe do a few well-separated sub-functions
     # for getting the pairs and unique them)
-    def generate_pairs(self, output=None, tmpdir=None):
+    def generate_pairs(self, output=None, tmpdir=None, symmetric=False):
         """Generate the pairs associated to the triplet list
 
+        The pair of items (a, b) of a by block is encoded as a + base * b,
+        where base is the number of items in the by block. If symmetric is
+        True the canonical (min(a, b), max(a, b)) pair is encoded instead,
+        so that AX and BX pairs sharing the same items are computed only
+        once.
+
         .. note:: This function is called by generate_triplets and should not
             be used independantly
         """
@@ -823,124 +1274,134 @@ associated pairs
             output = basename + '.abx'
         # list all pairs
         n_pairs_dict = {}
-        max_ind_dict = {}
+        pair_files = {}
         try:
             _, output_tmp = tempfile.mkstemp(dir=tmpdir)
-            for n_by, (by, db) in enumerate(self.by_dbs.iteritems()):
+            for n_by, by in enumerate(self.by_dbs):
                 if self.verbose > 0:
                     print("Writing AX/BX pairs to task file...")
                 with h5py.File(output) as fh:
                     triplets_attrs = fh['/triplets']['by_index'][n_by][...]
-                max_ind = np.max(db.index.values)
-                max_ind_dict[by] = max_ind
-                pair_key_type = fit_integer_type(
-                    (max_ind + 1) ** 2 - 1, is_signed=False)
-                with h52np.H52NP(output) as f_in:
-                    with np2h5.NP2H5(output_tmp) as f_out:
-                        inp = f_in.add_subdataset('triplets', 'data',
-                                                  indexes=triplets_attrs)
-                        out = f_out.add_dataset(
-                            'pairs', str(by), n_columns=1,
-                            item_type=pair_key_type, fixed_size=False)
-                        for data in inp:
-                            triplets = pair_key_type(data)
-                            n = triplets.shape[0]
-                            ind = np.arange(n)
-                            i1 = 2 * ind
-                            i2 = 2 * ind + 1
-                            pairs = np.empty(
-                                shape=(2 * n, 1), dtype=pair_key_type)
-                            # FIXME change the encoding (and type_fitting)
-                            # so that A,B and B,A have the same code ...
-                            # (take a=min(a,b), b=max(a,b))
-                            # FIXME but allow a flag to control the
-                            # behavior to be able to enforce A,X and B,X
-                            # order when using assymetrical distance
-                            # functions
-                            pairs[i1, 0] = triplets[:, 0] + (
-                                max_ind + 1) * triplets[:, 2]  # AX
-                            pairs[i2, 0] = triplets[:, 1] + (
-                                max_ind + 1) * triplets[:, 2]  # BX
-                            # FIXME do a unique here already? Do not store
-                            # the inverse mapping ? (could sort triplets on
-                            # pair1, complete pair1, sort on pair2,
-                            # complete pair 2 and shuffle ?)
-                            out.write(pairs)
-
-                    sort_pairs(output_tmp, by, tmpdir=tmpdir)
-
-                    # counting unique
-                    with np2h5.NP2H5(output_tmp) as f_out:
-                        with h52np.H52NP(output_tmp) as f_in:
-                            inp = f_in.add_dataset('pairs', str(by))
-                            n_pairs = 0
-                            last = -1
-                            for pairs in inp:
-                                # unique alters the shape
-                                pairs = np.reshape(pairs, (pairs.shape[0], 1))
-                                n_pairs += np.unique(pairs).size
-                                if pairs[0, 0] == last:
-                                    n_pairs -= 1
-                                if pairs.size > 0:
-                                    last = pairs[-1, 0]
-                        n_pairs_dict[by] = n_pairs
-
-                    # FIXME should have a unique function directly instead of
-                    # sorting + unique ?
-                    with np2h5.NP2H5(output_tmp) as f_out:
-                        with h52np.H52NP(output_tmp) as f_in:
-                            inp = f_in.add_dataset('pairs', str(by))
-                            out = f_out.add_dataset(
-                                'unique_pairs', str(by), n_rows=n_pairs, n_columns=1,
-                                item_type=pair_key_type, fixed_size=False)
-                            # out = out_unique_pairs
-                            last = -1
-                            for pairs in inp:
-                                pairs = np.unique(pairs)
-                                # unique alters the shape
-                                pairs = np.reshape(pairs, (pairs.shape[0], 1))
-                                if pairs[0, 0] == last:
-                                    pairs = pairs[1:]
-                                if pairs.size > 0:
-                                    last = pairs[-1, 0]
-                                    out.write(pairs)
-
-                        # store for ulterior decoding
-                        store = pd.HDFStore(output)
-                        # use append to make use of table format, which is better at
-                        # handling strings without much space (fixed-size format)
-                        store.append('/feat_dbs/' + str(by), self.feat_dbs[by],
-                                     expectedrows=len(self.feat_dbs[by]))
-                        store.close()
-                        # FIXME generate inverse mapping to triplets (1 and 2) ?
-
-            # Now merge all datasets
-            by_index = 0
-            with np2h5.NP2H5(output) as f_out:
-                n_rows = sum(n_pairs_dict.itervalues())
-                out_unique_pairs = f_out.add_dataset(
-                    'unique_pairs', 'data', n_rows=n_rows, n_columns=1,
-                    item_type=np.int64, fixed_size=False)
-                for n_by, (by, db) in enumerate(self.by_dbs.iteritems()):
-                    triplets_attrs = f_out.file['/triplets']['by_index'][n_by]
-                    if triplets_attrs[0] == triplets_attrs[1]:
-                        # subdataset is empty
-                        continue
-
-                    with h52np.H52NP(output_tmp) as f_in:
-                        inp = f_in.add_dataset('unique_pairs', str(by))
-                        for pairs in inp:
-                            out_unique_pairs.write(pairs)
-
-                    with h5py.File(output) as fh:
-                        fh['/unique_pairs'].attrs[str(by)] = (
-                            max_ind_dict[by] + 1, by_index, by_index + n_pairs_dict[by])
-                    by_index += n_pairs_dict[by]
+                n_pairs_dict[by] = self._by_block_pairs(
+                    output, triplets_attrs, by, output_tmp, tmpdir=tmpdir,
+                    symmetric=symmetric)
+                pair_files[by] = output_tmp
+            self._merge_pairs(output, pair_files, n_pairs_dict, symmetric)
         finally:
             os.remove(output_tmp)
         if self.verbose > 0:
             print("done.")
 
+    def _by_block_pairs(self, triplet_file, triplets_attrs, by, output_tmp,
+                        tmpdir=None, symmetric=False):
+        # Write the sorted unique pairs of the triplets triplets_attrs of the
+        # by block by (read from triplet_file) to the 'unique_pairs/<by>'
+        # dataset of output_tmp, returns their number
+        max_ind = np.max(self.by_dbs[by].index.values)
+        pair_key_type = fit_integer_type(
+            (max_ind + 1) ** 2 - 1, is_signed=False)
+        with h52np.H52NP(triplet_file) as f_in:
+            with np2h5.NP2H5(output_tmp) as f_out:
+                inp = f_in.add_subdataset('triplets', 'data',
+                                          indexes=triplets_attrs)
+                out = f_out.add_dataset(
+                    'pairs', str(by), n_columns=1,
+                    item_type=pair_key_type, fixed_size=False)
+                for data in inp:
+                    triplets = pair_key_type(data)
+                    n = triplets.shape[0]
+                    ind = np.arange(n)
+                    i1 = 2 * ind
+                    i2 = 2 * ind + 1
+                    pairs = np.empty(
+                        shape=(2 * n, 1), dtype=pair_key_type)
+                    pairs[i1, 0] = pair_codes(
+                        triplets[:, 0], triplets[:, 2],
+                        max_ind + 1, symmetric)  # AX
+                    pairs[i2, 0] = pair_codes(
+                        triplets[:, 1], triplets[:, 2],
+                        max_ind + 1, symmetric)  # BX
+                    # FIXME do a unique here already? Do not store
+                    # the inverse mapping ? (could sort triplets on
+                    # pair1, complete pair1, sort on pair2,
+                    # complete pair 2 and shuffle ?)
+                    out.write(pairs)
+
+        sort_pairs(output_tmp, by, tmpdir=tmpdir)
+
+        # counting unique
+        with h52np.H52NP(output_tmp) as f_in:
+            inp = f_in.add_dataset('pairs', str(by))
+            n_pairs = 0
+            last = -1
+            for pairs in inp:
+                # unique alters the shape
+                pairs = np.reshape(pairs, (pairs.shape[0], 1))
+                n_pairs += np.unique(pairs).size
+                if pairs[0, 0] == last:
+                    n_pairs -= 1
+                if pairs.size > 0:
+                    last = pairs[-1, 0]
+
+        # FIXME should have a unique function directly instead of
+        # sorting + unique ?
+        with np2h5.NP2H5(output_tmp) as f_out:
+            with h52np.H52NP(output_tmp) as f_in:
+                inp = f_in.add_dataset('pairs', str(by))
+                out = f_out.add_dataset(
+                    'unique_pairs', str(by), n_rows=n_pairs, n_columns=1,
+                    item_type=pair_key_type, fixed_size=False)
+                last = -1
+                for pairs in inp:
+                    pairs = np.unique(pairs)
+                    # unique alters the shape
+                    pairs = np.reshape(pairs, (pairs.shape[0], 1))
+                    if pairs[0, 0] == last:
+                        pairs = pairs[1:]
+                    if pairs.size > 0:
+                        last = pairs[-1, 0]
+                        out.write(pairs)
+        return n_pairs
+
+    def _merge_pairs(self, output, pair_files, n_pairs_dict, symmetric):
+        # Store the feature databases of the by blocks for ulterior decoding
+        # and concatenate their unique pairs (the 'unique_pairs/<by>' dataset
+        # of pair_files[by]) in the 'unique_pairs/data' dataset of output
+        store = pd.HDFStore(output)
+        try:
+            for by in self.by_dbs:
+                # use append to make use of table format, which is better at
+                # handling strings without much space (fixed-size format)
+                store.append('/feat_dbs/' + str(by), self.feat_dbs[by],
+                             expectedrows=len(self.feat_dbs[by]))
+        finally:
+            store.close()
+        # FIXME generate inverse mapping to triplets (1 and 2) ?
+
+        # Now merge all datasets
+        by_index = 0
+        with np2h5.NP2H5(output) as f_out:
+            n_rows = sum(n_pairs_dict.itervalues())
+            out_unique_pairs = f_out.add_dataset(
+                'unique_pairs', 'data', n_rows=n_rows, n_columns=1,
+                item_type=np.int64, fixed_size=False)
+            out_unique_pairs.dataset.attrs['symmetric'] = symmetric
+            for n_by, (by, db) in enumerate(self.by_dbs.iteritems()):
+                triplets_attrs = f_out.file['/triplets']['by_index'][n_by]
+                if triplets_attrs[0] == triplets_attrs[1]:
+                    # subdataset is empty
+                    continue
+
+                with h52np.H52NP(pair_files[by]) as f_in:
+                    inp = f_in.add_dataset('unique_pairs', str(by))
+                    for pairs in inp:
+                        out_unique_pairs.write(pairs)
+
+                max_ind = np.max(db.index.values)
+                f_out.file['/unique_pairs'].attrs[str(by)] = (
+                    max_ind + 1, by_index, by_index + n_pairs_dict[by])
+                by_index += n_pairs_dict[by]
+
     # number of triplets when triplets with same on, across, by are counted as
     # one
     # FIXME current implementation won't work with A, B, X or ABX filters
@@ -1043,6 +1504,166 @@ associated pairs
                              stats['nb_on_across_levels'])
 
 
+def block_codes(by_db, on_blocks, across_blocks, across):
+    """Integer codes of the 'on' and 'across' values of the items of a by
+    block
+
+    Returns a dictionary with the items of the block ('items', sorted), the
+    code of the 'on' and 'across' values of each item ('on' and 'across')
+    and dictionaries from the keys of the on_blocks and across_blocks groups
+    to their codes ('on_keys' and 'across_keys'). If there are several
+    'across' columns, 'across_columns' contains the codes of the values of
+    each column and dictionaries from these values to their codes.
+    """
+    items = np.sort(by_db.index.values)
+    codes = {'items': items}
+    for name, blocks in [('on', on_blocks), ('across', across_blocks)]:
+        # items with a missing value are in no group
+        item_codes = np.zeros(len(items), dtype=np.int64) - 1
+        keys = {}
+        for code, (key, indices) in enumerate(blocks.groups.items()):
+            item_codes[np.searchsorted(items, np.asarray(indices))] = code
+            keys[key] = code
+        codes[name] = item_codes
+        codes[name + '_keys'] = keys
+    if len(across) > 1:
+        codes['across_columns'] = []
+        for column in across:
+            values = by_db[column].loc[items].values
+            column_codes, uniques = pd.factorize(values)
+            codes['across_columns'].append(
+                (column_codes, dict((value, code) for code, value
+                                    in enumerate(uniques))))
+    return codes
+
+
+class ItemColumns(object):
+    """Columns of a by database, looked up by item
+
+    ItemColumns(by_db)[column][items] gives the same values as
+    list(by_db[column][items]) with a binary search in the sorted items of
+    the block instead of a pandas label lookup, whose cost dominates the
+    processing of small on/across blocks.
+    """
+
+    def __init__(self, by_db):
+        self.by_db = by_db
+        self.items = np.sort(by_db.index.values)
+        self.columns = {}
+
+    def __len__(self):
+        return len(self.by_db)
+
+    def __getitem__(self, column):
+        if column not in self.columns:
+            self.columns[column] = ItemColumn(
+                self.items, self.by_db[column].loc[self.items].values)
+        return self.columns[column]
+
+
+class ItemColumn(object):
+    """A column of ItemColumns"""
+
+    def __init__(self, items, values):
+        self.items = items
+        self.values = values
+
+    def __getitem__(self, items):
+        return self.values[np.searchsorted(self.items, items)].tolist()
+
+
+class GroupSampler(object):
+    """Uniform sample of at most threshold rows of each group of a stream
+
+    The rows of a group are contiguous in the stream, but a group can be
+    spread over several chunks: the sample of the current group is updated
+    with each chunk (reservoir sampling) and returned once the group is
+    complete.
+    """
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.key = None
+
+    def add(self, keys, rows):
+        """Add a chunk of rows with the key of their group
+
+        Returns the samples of the groups completed by the chunk, in the
+        order of the stream.
+        """
+        samples = []
+        if len(keys) == 0:
+            return samples
+        bounds = np.flatnonzero(np.concatenate(
+            ([True], keys[1:] != keys[:-1], [True])))
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            if keys[start] != self.key:
+                if self.key is not None:
+                    samples.append(self.flush())
+                self.key = keys[start]
+                self.count = 0
+                self.sample = rows[:0]
+                self.positions = np.empty(0, dtype=np.int64)
+            self._add(rows[start:stop])
+        return samples
+
+    def flush(self):
+        """Returns the sample of the current group (None if there is none)"""
+        if self.key is None:
+            return None
+        self.key = None
+        return self.sample[np.argsort(self.positions)]
+
+    def _add(self, rows):
+        n = len(rows)
+        # the first rows of the group fill the sample
+        fill = max(0, min(n, self.threshold - self.count))
+        self.sample = np.concatenate((self.sample, rows[:fill]))
+        self.positions = np.concatenate(
+            (self.positions, self.count + np.arange(fill)))
+        if fill < n:
+            # the row at position t of the group replaces a random element
+            # of the sample with probability threshold / (t + 1)
+            t = self.count + np.arange(fill, n)
+            slot = np.floor(np.random.random(n - fill) * (t + 1)).astype(
+                np.int64)
+            replacing = np.flatnonzero(slot < self.threshold)[::-1]
+            # only the last replacement of a slot matters
+            slots, last = np.unique(slot[replacing], return_index=True)
+            self.sample[slots] = rows[fill + replacing[last]]
+            self.positions[slots] = t[replacing[last]]
+        self.count += n
+
+
+def regressor_codes(regressors, n):
+    """Codes of the combinations of regressors of n items
+
+    The codes are in the lexicographic order of the regressors (a list of
+    arrays of size n).
+    """
+    if not(regressors):
+        return np.zeros(n, dtype=np.int64)
+    regressors = np.array(regressors)
+    order = np.lexsort(regressors[::-1])
+    ordered = regressors[:, order]
+    new_code = np.concatenate(
+        ([True], np.any(ordered[:, 1:] != ordered[:, :-1], axis=0)))
+    codes = np.empty(n, dtype=np.int64)
+    codes[order] = np.cumsum(new_code) - 1
+    return codes
+
+
+def factorial_indices(indices, n_middle, n_last):
+    """Decompose indices in a full factorial design of three factors
+
+    The last factor varies the fastest and the first one the slowest: index
+    i corresponds to the levels (i // (n_middle * n_last),
+    (i // n_last) % n_middle, i % n_last).
+    """
+    return (indices // (n_middle * n_last), (indices // n_last) % n_middle,
+            indices % n_last)
+
+
 # utility function necessary because of current inconsistencies in panda:
 # you can't seem to index a dataframe with a tuple with only one element,
 # even though tuple with more than one element are fine
@@ -1080,8 +1701,23 @@ def sort_and_threshold(permut, new_index, ind_type,
         else:
             new_permut.append(permut[i:i+c])
         i += c
+    if threshold:
+        # start of each group in the thresholded triplets
+        unique_idx = np.concatenate(
+            ([0], np.cumsum(np.minimum(counts, threshold))))
     return np.concatenate(new_permut), unique_idx
 
+
+def pair_codes(first, second, base, symmetric=False):
+    """Integer codes of the pairs of items (first, second) of a by block
+
+    With symmetric=True, (a, b) and (b, a) get the same code.
+    """
+    if symmetric:
+        first, second = np.minimum(first, second), np.maximum(first, second)
+    return first + base * second
+
+
 def sort_pairs(output_tmp, by, tmpdir=None):
     # sort pairs
     handler = h5_handler.H5Handler(output_tmp, '/pairs/', str(by))
@@ -1138,7 +1774,7 @@ if __name__ == '__main__':
         usage="""%(prog)s database [output] -o ON [-a ACROSS [ACROSS ...]] \
 [-b BY [BY ...]] [-f FILT [FILT ...]] [-r REG [REG ...]] [-s SAMPLING_AMOUNT\
 _OR_PROPORTION] [--stats_only] [-h] [-v VERBOSE_LEVEL] \
-        [--threshold THRESHOLD] [--tempdir TEMPDIR]""",
+        [--threshold THRESHOLD] [--tempdir TEMPDIR] [--symmetric] [-j NCPU]""",
         description='ABX task specification')
     message = """must be defined by the database you are using (e.g. speaker \
 or phonemes, if your database contains columns defining these attributes)"""
@@ -1184,6 +1820,13 @@ or phonemes, if your database contains columns defining these attributes)"""
     g4.add_argument('--tempdir', default=None,
                     help='optional: directory where temporary files will '
                     'be stored')
+    g4.add_argument('--symmetric', default=False, action='store_true',
+                    help='optional: encode the pairs (a, b) and (b, a) in '
+                         'the same way so that their distance is computed '
+                         'only once, use only with symmetric distances')
+    g4.add_argument('-j', '--ncpu', default=1, type=int,
+                    help='optional: number of processes generating the '
+                         'triplets and pairs of the by blocks in parallel')
 
     args = parser.parse_args()
     if args.stats_only:
@@ -1203,6 +1846,7 @@ or phonemes, if your database contains columns defining these attributes)"""
 
         # generate triplets and unique pairs
         task.generate_triplets(args.output, args.sample, args.threshold,
-                               tmpdir=args.tempdir)
+                               tmpdir=args.tempdir, symmetric=args.symmetric,
+                               n_cpu=args.ncpu)
     else:
         task.print_stats()
@@ -0,0 +1,528 @@
+"""This test script contains tests for the distances module"""
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+package_path = os.path.dirname(os.path.dirname(
+    os.path.dirname(os.path.realpath(__file__))))
+if not(package_path in sys.path):
+    sys.path.append(package_path)
+import json
+import multiprocessing
+import shutil
+import tempfile
+import warnings
+import h5py
+import numpy as np
+import pandas
+import ABXpy.task
+import ABXpy.misc.items as items
+import ABXpy.distances.distances as distances
+import ABXpy.distances.block_distances as block_distances
+import ABXpy.distances.feature_store as feature_store
+import ABXpy.distances.distance_cache as distance_cache
+import ABXpy.distances.registry as registry
+import ABXpy.distances.telemetry as telemetry
+import ABXpy.distances.metrics.cosine as cosine
+import ABXpy.distances.metrics.dtw as dtw
+import ABXpy.distances.metrics.utw as utw
+import ABXpy.distances.metrics.kullback_leibler as kullback_leibler
+
+
+def test_features_accessor():
+    times = {'f1': np.array([0.1, 0.2, 0.3, 0.4, 0.5]),
+             'f2': np.array([0.2, 0.1, 0.3])}
+    features = {'f1': np.arange(10, dtype=np.float64).reshape((5, 2)),
+                'f2': np.arange(6, dtype=np.float64).reshape((3, 2))}
+    items = pandas.DataFrame({'file': ['f1', 'f1', 'f1', 'f2'],
+                              'onset': [0.1, 0.25, 0.6, 0.1],
+                              'offset': [0.3, 0.45, 0.7, 0.2]})
+    accessor = distances.Features_Accessor(times, features)
+    res = accessor.get_features_from_raw(items)
+    assert np.array_equal(res[0], features['f1'][0:3])
+    assert np.array_equal(res[1], features['f1'][2:4])
+    assert res[2].shape == (0, 2)
+    # frames of unsorted files are reordered by time
+    assert np.array_equal(res[3], np.array([[2., 3.], [0., 1.]]))
+    assert np.array_equal(accessor.get_n_frames_from_raw(items),
+                          [3, 2, 0, 2])
+
+
+def make_task(directory):
+    # item, feature and task files of a small task in directory
+    item_file = os.path.join(directory, 'data.item')
+    feature_file = os.path.join(directory, 'data.features')
+    task_file = os.path.join(directory, 'data.abx')
+    items.generate_db_and_feat(3, 3, 1, item_file, 2, 3, feature_file)
+    task = ABXpy.task.Task(item_file, 'c0', 'c1', 'c2')
+    task.generate_triplets(task_file)
+    return feature_file, task_file
+
+
+def test_split_feature_file():
+    directory = tempfile.mkdtemp()
+    try:
+        feature_file, task_file = make_task(directory)
+        times, features = distances.load_features([feature_file],
+                                                  ['features'])
+        raw = distances.Features_Accessor(times, features)
+        with h5py.File(task_file, 'r') as fh:
+            tasks = [(task_file, by, 0, stop - start) for by, (_, start, stop)
+                     in fh['unique_pairs'].attrs.items()]
+        # with a small mem, the tasks are divided until one pair per task
+        for mem in [None, 10 ** -4]:
+            split_file = os.path.join(directory, 'split_{}.h5'.format(mem))
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                split_tasks, groups = distances.split_feature_file(
+                    times, features, tasks, split_file, mem)
+            if mem is None:
+                assert split_tasks == tasks
+            else:
+                assert len(split_tasks) > len(tasks)
+            # the tasks still cover all the pairs, in order
+            for pair_file, by, start, stop in tasks:
+                rows = [(sta, sto) for _, b, sta, sto in split_tasks
+                        if b == by]
+                assert rows[0][0] == start and rows[-1][1] == stop
+                assert all(r1[1] == r2[0] for r1, r2 in zip(rows[:-1],
+                                                             rows[1:]))
+            for (pair_file, by, start, stop), group in zip(split_tasks,
+                                                           groups):
+                _, block_items, _ = distances.load_block(pair_file, by,
+                                                         start, stop)
+                expected = raw.get_features_from_raw(block_items)
+                if group is None:
+                    assert all(x.shape[0] == 0 for x in expected.values())
+                    continue
+                split = distances.Features_Accessor(
+                    *distances.load_features([split_file], [group]))
+                res = split.get_features_from_splitted(block_items)
+                assert sorted(res) == sorted(expected)
+                for ix in expected:
+                    assert np.array_equal(res[ix], expected[ix])
+        # same distances with split features
+        results = []
+        for split_features in [False, True]:
+            distance_file = os.path.join(
+                directory, 'data_{}.distance'.format(split_features))
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                distances.compute_distances(
+                    feature_file, 'features', task_file, distance_file,
+                    registry.dtw_cosine, True, n_cpu=1, mem=10 ** -4,
+                    split_features=split_features, metrics=False)
+            with h5py.File(distance_file, 'r') as fh:
+                results.append(fh['distances/data'][...])
+        assert np.array_equal(results[0], results[1])
+    finally:
+        shutil.rmtree(directory)
+
+
+# marker file of dying_distance, created by the first worker it kills
+kill_marker = [None]
+
+
+def dying_distance(features, pairs, normalized):
+    # kills the first worker calling it, as the system would
+    if not(os.path.exists(kill_marker[0])):
+        open(kill_marker[0], 'w').close()
+        os._exit(1)
+    kernel = registry.get_metric('dtw_cosine').block_kernel(1)
+    return kernel(features, pairs, normalized)
+
+
+def failing_distance(features, pairs, normalized):
+    raise ValueError('distance failure')
+
+
+def test_run_distance_tasks():
+    directory = tempfile.mkdtemp()
+    try:
+        feature_file, task_file = make_task(directory)
+        kill_marker[0] = os.path.join(directory, 'killed')
+
+        def compute(name, distance, n_cpu):
+            distance_file = os.path.join(directory, name + '.distance')
+            distances.compute_distances(
+                feature_file, 'features', task_file, distance_file,
+                distance, True, n_cpu=n_cpu, block=True, metrics=False)
+            with h5py.File(distance_file, 'r') as fh:
+                return (fh['distances/data'][...],
+                        fh['distances/completed'][...])
+
+        kernel = registry.get_metric('dtw_cosine').block_kernel(1)
+        serial, _ = compute('serial', kernel, 1)
+        # the task of the killed worker is computed again by another worker
+        parallel, completed = compute('parallel', dying_distance, 2)
+        assert os.path.exists(kill_marker[0])
+        assert distances.missing_rows(completed, 0, serial.shape[0]) == []
+        assert np.array_equal(parallel, serial)
+        # an exception in a worker stops the computation
+        try:
+            compute('failing', failing_distance, 2)
+        except RuntimeError as e:
+            assert 'distance failure' in str(e)
+        else:
+            assert False, 'the error of the worker was not raised'
+    finally:
+        shutil.rmtree(directory)
+
+
+# number of pairs computed by counting_distance
+n_computed = [0]
+
+
+def counting_distance(features, pairs, normalized):
+    n_computed[0] += pairs.shape[0]
+    kernel = registry.get_metric('dtw_cosine').block_kernel(1)
+    return kernel(features, pairs, normalized)
+
+
+def test_resume():
+    directory = tempfile.mkdtemp()
+    try:
+        feature_file, task_file = make_task(directory)
+        fresh_file = os.path.join(directory, 'fresh.distance')
+        distances.compute_distances(
+            feature_file, 'features', task_file, fresh_file,
+            counting_distance, True, n_cpu=1, block=True, metrics=False)
+        with h5py.File(fresh_file, 'r') as fh:
+            fresh = fh['distances/data'][...]
+        n = fresh.shape[0]
+        for n_cpu in [1, 2]:
+            # a computation interrupted after two ranges of rows
+            distance_file = os.path.join(directory,
+                                         'resumed_%d.distance' % n_cpu)
+            shutil.copyfile(fresh_file, distance_file)
+            done = [(0, n // 3), (2 * n // 3, n - 1)]
+            with h5py.File(distance_file) as fh:
+                fh.attrs.modify('done', False)
+                del fh['distances/completed']
+                distances.create_completion_table(fh)
+                fh['distances/data'][...] = np.nan
+                for start, stop in done:
+                    fh['distances/data'][start:stop] = fresh[start:stop]
+                    distances.record_completed(fh, start, stop)
+            n_computed[0] = 0
+            distances.compute_distances(
+                feature_file, 'features', task_file, distance_file,
+                counting_distance, True, n_cpu=n_cpu, block=True,
+                resume=True, metrics=False)
+            if n_cpu == 1:
+                # only the missing rows are computed
+                assert n_computed[0] == n - sum(sto - sta
+                                                for sta, sto in done)
+            with h5py.File(distance_file, 'r') as fh:
+                assert fh.attrs['done']
+                assert np.array_equal(fh['distances/data'][...], fresh)
+                completed = fh['distances/completed'][...]
+            assert distances.missing_rows(completed, 0, n) == []
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_dtw_cosine_block():
+    np.random.seed(0)
+    features = {i: np.random.randn(np.random.randint(1, 8), 3)
+                for i in range(10)}
+    pairs = np.array([[a, b] for a in range(10) for b in range(10) if a < b])
+    for normalized in [True, False]:
+        for max_cells in [1, 10 ** 7]:
+            dis = block_distances.dtw_cosine_block(features, pairs,
+                                                   normalized, max_cells)
+            for (a, b), d in zip(pairs, dis):
+                expected = dtw.dtw(features[a], features[b],
+                                   cosine.cosine_distance, normalized)
+                assert np.allclose(d, expected)
+
+
+def test_dtw_cosine_bounds():
+    rng = np.random.RandomState(0)
+    features = {i: rng.randn(rng.randint(0, 6), 3) for i in range(8)}
+    # null frames
+    features[1][0] = 0.
+    features[2][:] = 0.
+    pairs = np.array([(a, b) for a in range(8) for b in range(8)])
+    for normalized in [True, False]:
+        lower, upper = block_distances.dtw_cosine_bounds(features, pairs,
+                                                         normalized)
+        dis = block_distances.dtw_cosine_block(features, pairs, normalized)
+        finite = np.isfinite(dis)
+        assert np.array_equal(lower[~finite], dis[~finite])
+        assert np.array_equal(upper[~finite], dis[~finite])
+        # up to the rounding errors of arccos for close frames
+        assert np.all(lower[finite] <= dis[finite] + 1e-6)
+        assert np.all(dis[finite] <= upper[finite] + 1e-6)
+
+
+def test_dtw_cosine_batch():
+    np.random.seed(0)
+    features = {i: np.random.randn(np.random.randint(0, 8), 3)
+                for i in range(10)}
+    pairs = np.array([[a, b] for a in range(10) for b in range(10) if a < b])
+    for normalized in [True, False]:
+        dis = block_distances.dtw_cosine_batch(features, pairs, normalized,
+                                               n_threads=2)
+        expected = block_distances.dtw_cosine_block(features, pairs,
+                                                    normalized)
+        assert np.allclose(dis, expected)
+
+
+def test_feature_store():
+    times = {'f1': np.array([0.1, 0.2, 0.3]), 'f2': np.array([0.2, 0.1])}
+    features = {'f1': np.arange(6, dtype=np.float32).reshape((3, 2)),
+                'f2': np.arange(4, dtype=np.float32).reshape((2, 2))}
+    directory = tempfile.mkdtemp()
+    try:
+        feature_store.FeatureStore.create(times, features, directory)
+        # as opened by a worker
+        store = feature_store.FeatureStore(directory)
+        store_times, store_features = store.get_times_and_features()
+        assert np.array_equal(store_times['f1'], times['f1'])
+        assert np.array_equal(store_features['f1'], features['f1'])
+        # frames are sorted by time
+        assert np.array_equal(store_times['f2'], [0.1, 0.2])
+        assert np.array_equal(store_features['f2'], [[2., 3.], [0., 1.]])
+    finally:
+        shutil.rmtree(directory)
+
+
+# the store of several feature files, read one at a time
+def test_create_feature_store():
+    directory = tempfile.mkdtemp()
+    try:
+        feature_files = []
+        for k in range(2):
+            feature_files.append(os.path.join(directory,
+                                              'data_%d.features' % k))
+            distances.h5features.write(
+                feature_files[-1], 'features', ['f%d' % k, 'g%d' % k],
+                [np.array([0.3, 0.1, 0.2]), np.array([0.1, 0.2])],
+                [np.random.rand(3, 2), np.random.rand(2, 2)])
+        store_dir = os.path.join(directory, 'store')
+        os.mkdir(store_dir)
+        store = distances.create_feature_store(
+            feature_files, ['features', 'features'], store_dir)
+        assert sorted(os.listdir(store_dir)) == [
+            'files.npy', 'frames.npy', 'offsets.npy', 'times.npy']
+        store_times, store_features = store.get_times_and_features()
+        raw = distances.Features_Accessor(*distances.load_features(
+            feature_files, ['features', 'features']))
+        assert sorted(store_times) == sorted(raw.times)
+        for f in raw.times:
+            assert np.array_equal(store_times[f], raw.times[f])
+            assert np.array_equal(store_features[f], raw.features[f])
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_missing_rows():
+    completed = np.array([[0, 5], [8, 10], [12, 20]])
+    assert distances.missing_rows(completed, 0, 30) == [(5, 8), (10, 12),
+                                                        (20, 30)]
+    assert distances.missing_rows(completed, 3, 9) == [(5, 8)]
+    assert distances.missing_rows(completed, 13, 18) == []
+    assert distances.missing_rows(np.zeros((0, 2)), 2, 4) == [(2, 4)]
+
+
+def test_merge_distance_shards():
+    directory = tempfile.mkdtemp()
+    try:
+        distance_file = os.path.join(directory, 'data.distance')
+        with h5py.File(distance_file, 'w') as fh:
+            fh.create_dataset('distances/data', (10, 1), dtype=np.float64)
+            distances.create_completion_table(fh)
+        # worker 0 computed rows 0-3 then 6-8, worker 1 rows 3-6
+        expected = np.arange(10, dtype=np.float64) / 10
+        np.concatenate([expected[0:3], expected[6:8]]).tofile(
+            os.path.join(directory, 'shard_0'))
+        expected[3:6].tofile(os.path.join(directory, 'shard_1'))
+        parts = [(6, 8, 0, 3), (0, 3, 0, 0), (3, 6, 1, 0)]
+        distances.merge_distance_shards(distance_file, directory, parts,
+                                        buffer_size=5)
+        with h5py.File(distance_file, 'r') as fh:
+            assert np.array_equal(fh['distances/data'][:8, 0],
+                                  expected[:8])
+            completed = fh['distances/completed'][...]
+        # contiguous parts are written together, up to buffer_size rows
+        assert completed.tolist() == [[0, 3], [3, 8]] or \
+            completed.tolist() == [[0, 6], [6, 8]]
+        assert distances.missing_rows(completed, 0, 10) == [(8, 10)]
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_distance_cache():
+    directory = tempfile.mkdtemp()
+    try:
+        feature_file = os.path.join(directory, 'features')
+        with open(feature_file, 'w') as fh:
+            fh.write('features')
+        cache = distance_cache.DistanceCache(directory, [feature_file],
+                                             ['features'], np.dot, True)
+        items = pandas.DataFrame({'file': ['f1', 'f1', 'f2'],
+                                  'onset': [0.1, 0.2, 0.1],
+                                  'offset': [0.3, 0.4, 0.3]})
+        keys = distance_cache.item_keys(items)
+        assert len(np.unique(keys)) == 3
+        cache.add(keys[[0, 1]], keys[[1, 2]], [1., 2.])
+        # a new process sees the distances added to the cache
+        cache = distance_cache.DistanceCache(directory, [feature_file],
+                                             ['features'], np.dot, True)
+        dis, found = cache.lookup(keys[[1, 0, 2]], keys[[2, 1, 0]])
+        assert np.array_equal(found, [True, True, False])
+        assert np.array_equal(dis[found], [2., 1.])
+        # the entry file being written is not compacted
+        writer = distance_cache.DistanceCache(directory, [feature_file],
+                                              ['features'], np.dot, True)
+        writer.add(keys[[2]], keys[[0]], [3.])
+        cache.compact()
+        assert len(cache.entry_files()) == 1
+        writer.close()
+        cache = distance_cache.DistanceCache(directory, [feature_file],
+                                             ['features'], np.dot, True,
+                                             compact_size=0)
+        assert cache.entry_files() == []
+        dis, found = cache.lookup(keys[[1, 0, 2]], keys[[2, 1, 0]])
+        assert np.array_equal(dis, [2., 1., 3.])
+        # different normalization, different cache
+        cache = distance_cache.DistanceCache(directory, [feature_file],
+                                             ['features'], np.dot, False)
+        assert not(np.any(cache.lookup(keys[[0]], keys[[1]])[1]))
+        # the pairs of symmetric metrics are stored in canonical order, but
+        # the normalized DTW is not symmetric
+        metric = registry.get_metric('dtw_cosine')
+        for normalized in [False, True]:
+            cache = distance_cache.DistanceCache(
+                directory, [feature_file], ['features'], metric, normalized)
+            cache.add(keys[[0]], keys[[1]], [1.])
+            cache.close()
+            cache.load()
+            assert cache.lookup(keys[[1]], keys[[0]])[1][0] == \
+                (not(normalized))
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_utw_batch():
+    metric = lambda x, y: np.sum(np.abs(x - y), axis=1)
+    x = np.array([[0, 0], [0, -1], [0, 0], [4, 0], [0, 1], [-4, 5], [5, 0]])
+    y = np.array([[0, 1], [0, 1], [0, -2], [1, 1]])
+    empty = np.empty((0, 2))
+    assert np.array_equal(utw.utw_batch([x, y, x, empty, empty],
+                                        [y, x, x, x, empty], metric),
+                          [26.5, 26.5, utw.utw(x, x, metric), np.inf, 0])
+
+
+def test_utw_coordinates_cache():
+    size = utw.COORDINATES_CACHE_SIZE
+    try:
+        utw.COORDINATES_CACHE_SIZE = 2
+        utw._coordinates_cache.clear()
+        first = utw.distance_coordinates(1, 2)
+        utw.distance_coordinates(2, 3)
+        # (1, 2) is used again, so (2, 3) is the least recently used
+        assert utw.distance_coordinates(1, 2) is first
+        utw.distance_coordinates(3, 4)
+        assert list(utw._coordinates_cache) == [(1, 2), (3, 4)]
+    finally:
+        utw.COORDINATES_CACHE_SIZE = size
+        utw._coordinates_cache.clear()
+
+
+def test_utw_cosine_block():
+    np.random.seed(0)
+    features = {i: np.random.randn(np.random.randint(1, 5), 3)
+                for i in range(10)}
+    features[3][0] = 0
+    pairs = np.array([[a, b] for a in range(10) for b in range(10) if a < b])
+    dis = block_distances.utw_cosine_block(features, pairs)
+    for (a, b), d in zip(pairs, dis):
+        expected = utw.utw(features[a], features[b],
+                           lambda x, y: np.diag(cosine.cosine_distance(x, y)))
+        assert np.allclose(d, expected)
+
+
+def test_dtw_prepared_block():
+    np.random.seed(0)
+    features = {i: np.random.rand(np.random.randint(1, 6), 3)
+                for i in range(8)}
+    original = {i: features[i].copy() for i in features}
+    pairs = np.array([[a, b] for a in range(8) for b in range(8) if a < b])
+    for block_distance, metric in [
+            (block_distances.dtw_kl_block, kullback_leibler.kl_divergence),
+            (block_distances.dtw_js_block, kullback_leibler.js_divergence),
+            (block_distances.dtw_hellinger_block,
+             kullback_leibler.hellinger_distance)]:
+        dis = block_distance(features, pairs, True)
+        for (a, b), d in zip(pairs, dis):
+            assert np.allclose(d, dtw.dtw(features[a], features[b], metric,
+                                          True))
+    # the features are not modified
+    for i in features:
+        assert np.array_equal(features[i], original[i])
+    # identical frames are at distance 0
+    x = features[0]
+    assert np.all(np.diag(kullback_leibler.hellinger_distance(x, x)) == 0)
+
+
+def test_registry():
+    np.random.seed(0)
+    features = {i: np.random.rand(np.random.randint(0, 6), 3)
+                .astype(np.float32) for i in range(6)}
+    # all ordered pairs, each unordered pair twice
+    pairs = np.array([[a, b] for a in range(6) for b in range(6) if a != b])
+    for name in sorted(registry.METRICS):
+        metric = registry.get_metric(name)
+        for n_cpu in [1, 4]:
+            dis = metric.block_kernel(n_cpu)(features, pairs, True)
+            for (a, b), d in zip(pairs, dis):
+                assert np.allclose(d, metric.distance(
+                    features[a], features[b], True))
+
+
+def test_batch_threads():
+    n = multiprocessing.cpu_count()
+    assert registry.batch_threads(3, 4) == 3
+    assert registry.batch_threads(0, 1) == n
+    assert registry.batch_threads(0, 2 * n) == 1
+    assert registry.batch_threads(0, 2) == max(1, n // 2)
+
+
+def test_symmetric_block():
+    computed = []
+
+    def block_distance(features, pairs, normalized):
+        computed.append(pairs)
+        return pairs[:, 0] + pairs[:, 1]
+    pairs = np.array([[0, 1], [1, 0], [2, 1], [1, 2], [2, 2]])
+    dis = registry.symmetric_block(block_distance, None, pairs, False)
+    assert np.array_equal(dis, [1, 1, 3, 3, 4])
+    assert len(computed[0]) == 3
+    # normalized distances are only symmetric up to ties
+    dis = registry.symmetric_block(block_distance, None, pairs, True)
+    assert np.array_equal(dis, [1, 1, 3, 3, 4])
+    assert len(computed[1]) == 5
+
+
+def test_metrics_log():
+    directory = tempfile.mkdtemp()
+    try:
+        log = telemetry.MetricsLog(os.path.join(directory, 'metrics.jsonl'))
+        for by, cells in [('a', 10), ('b', 1000)]:
+            stats = telemetry.block_stats()
+            stats['pairs'] = 2
+            stats['cells'] = np.int64(cells)
+            log.record_block(by, (0, 2), 0.1 * cells, stats, job=1)
+        log.record_merge(0.5, 4)
+        summary = log.summary()
+        assert summary['pairs'] == 4 and summary['cells'] == 1010
+        assert summary['slowest_blocks'][0]['by'] == 'b'
+        assert 'slow block b' in log.close()
+        with open(log.filename) as fh:
+            records = [json.loads(line) for line in fh]
+        assert [r['event'] for r in records] == ['block', 'block', 'merge',
+                                                 'run']
+    finally:
+        shutil.rmtree(directory)
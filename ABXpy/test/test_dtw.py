@@ -1,7 +1,10 @@
 """Module for testing the dtw module"""
 
 import ABXpy.distances.metrics.dtw as dtw
+import ABXpy.distances.metrics.dtw_numpy as dtw_numpy
+import ABXpy.distances.metrics.cosine as cosine
 import numpy as np
+from scipy.spatial.distance import cdist
 
 
 def test_small():
@@ -34,3 +37,100 @@ def test_normalized():
     dists_mid = np.concatenate([dists[:, :3], dists_mid, dists[:, 3:]], axis=1)
     res = dtw._dtw(5, 7, dists_mid, normalized=True)
     assert res == 1
+
+
+def test_band():
+    np.random.seed(0)
+    dists = np.random.rand(6, 9)
+    # a band containing the whole matrix gives the unconstrained dtw
+    start, stop = dtw.band_limits(6, 9, window=9)
+    assert np.all(start == 0) and np.all(stop == 9)
+    for normalized in [True, False]:
+        assert np.allclose(dtw._dtw_band(6, 9, dists, normalized, start, stop),
+                           dtw._dtw(6, 9, dists, normalized))
+    # the band always contains a path from (0, 0) to (N-1, M-1)
+    for window, slope in [(1, None), (0.1, None), (None, 2.), (2, 1.5)]:
+        start, stop = dtw.band_limits(6, 9, window, slope)
+        assert start[0] == 0 and stop[-1] == 9
+        assert np.all(start[1:] <= stop[:-1])
+        res = dtw._dtw_band(6, 9, dists, False, start, stop)
+        assert res >= dtw._dtw(6, 9, dists, False)
+        # same as giving an infinite cost to the cells outside of the band
+        outside = np.ones((6, 9), dtype=bool)
+        for i in range(6):
+            outside[i, start[i]:stop[i]] = False
+        masked = np.where(outside, np.inf, dists)
+        assert np.allclose(res, dtw._dtw(6, 9, masked, False))
+
+
+def test_fused():
+    np.random.seed(0)
+    x = np.random.randn(5, 3)
+    y = np.random.randn(8, 3)
+    y[2] = 0
+    for normalized in [True, False]:
+        assert np.allclose(dtw.dtw_fused(x, y, 'cosine', normalized),
+                           dtw.dtw(x, y, cosine.cosine_distance, normalized))
+        assert np.allclose(dtw.dtw_fused(x, y, 'euclidean', normalized),
+                           dtw.dtw(x, y, cdist, normalized))
+        start, stop = dtw.band_limits(5, 8, window=1, slope=2.)
+        dists = cosine.cosine_distance(x, y)
+        assert np.allclose(
+            dtw.dtw_fused(x, y, 'cosine', normalized, window=1, slope=2.),
+            dtw._dtw_band(5, 8, dists, normalized, start, stop))
+
+
+def test_numpy_fallback():
+    np.random.seed(0)
+    for n, m in [(1, 1), (1, 6), (7, 1), (6, 9), (12, 5)]:
+        # ties between the predecessors decide the length of the path
+        dists = np.round(np.random.rand(n, m) * 3)
+        start, stop = dtw.band_limits(n, m, window=2, slope=2.)
+        start_np, stop_np = dtw_numpy.band_limits(n, m, window=2, slope=2.)
+        assert np.array_equal(start, start_np)
+        assert np.array_equal(stop, stop_np)
+        for normalized in [True, False]:
+            assert (dtw._dtw(n, m, dists, normalized) ==
+                    dtw_numpy._dtw(n, m, dists, normalized))
+            assert (dtw._dtw_band(n, m, dists, normalized, start, stop) ==
+                    dtw_numpy._dtw_band(n, m, dists, normalized, start, stop))
+    frames = np.random.randn(20, 3)
+    frames[4] = 0
+    offsets = np.array([0, 5, 5, 12, 20])
+    pairs = np.array([[a, b] for a in range(4) for b in range(4)])
+    for metric in ['cosine', 'euclidean']:
+        assert np.allclose(
+            dtw.dtw_batch(frames, offsets, pairs, metric, True, window=2),
+            dtw_numpy.dtw_batch(frames, offsets, pairs, metric, True,
+                                window=2))
+
+
+def test_abandon_ties():
+    # a distance equal to the threshold is never abandoned
+    np.random.seed(0)
+    for _ in range(2000):
+        n, m = np.random.randint(1, 8, 2)
+        dists = np.random.rand(n, m)
+        for module in [dtw, dtw_numpy]:
+            for normalized in [True, False]:
+                res = module._dtw(n, m, dists, normalized)
+                assert module._dtw_abandon(n, m, dists, normalized,
+                                           res) == res
+
+
+def test_numpy_batch_chunks():
+    # the pairs are computed by chunks of bounded size, with the same results
+    np.random.seed(0)
+    frames = np.random.randn(30, 3)
+    offsets = np.array([0, 5, 5, 12, 20, 30])
+    pairs = np.array([[a, b] for a in range(5) for b in range(5)])
+    expected = dtw_numpy.dtw_batch(frames, offsets, pairs, 'cosine', True)
+    max_cells = dtw_numpy.MAX_CELLS
+    try:
+        for cells in [1, 50, 100]:
+            dtw_numpy.MAX_CELLS = cells
+            assert np.array_equal(
+                dtw_numpy.dtw_batch(frames, offsets, pairs, 'cosine', True),
+                expected)
+    finally:
+        dtw_numpy.MAX_CELLS = max_cells
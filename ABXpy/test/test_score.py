@@ -10,6 +10,8 @@ package_path = os.path.dirname(os.path.dirname(
     os.path.dirname(os.path.realpath(__file__))))
 if not(package_path in sys.path):
     sys.path.append(package_path)
+import h5py
+import numpy as np
 import ABXpy.task
 import ABXpy.distances.distances as distances
 import ABXpy.distances.metrics.cosine as cosine
@@ -49,3 +51,75 @@ def test_score():
             # os.remove(scorefilename)
         except:
             pass
+
+
+def test_score_with_bounds():
+    try:
+        if not os.path.exists('test_items'):
+            os.makedirs('test_items')
+        item_file = 'test_items/data.item'
+        feature_file = 'test_items/data.features'
+        taskfilename = 'test_items/data.abx'
+        items.generate_named_testitems(3, 3, 1, item_file)
+        # the items s0 and s1 (same across and by values, different on
+        # values) have the same features, so that the triplets with A = s0
+        # and B = s1 are ties
+        np.random.seed(0)
+        features = [np.random.randn(np.random.randint(3) + 1, 2)
+                    for _ in range(54)]
+        features[1] = features[0].copy()
+        items.h5features.write(
+            feature_file, 'features', ['s%d' % i for i in range(54)],
+            [np.linspace(0, 1, f.shape[0]) for f in features], features)
+        task = ABXpy.task.Task(item_file, 'c0', 'c1', 'c2')
+        task.generate_triplets()
+        for normalized in [True, False]:
+            distance_file = 'test_items/data_{}.distance'.format(normalized)
+            scorefilename = 'test_items/data_{}.score'.format(normalized)
+            boundsfilename = 'test_items/data_bounds_{}.score'.format(
+                normalized)
+            distances.compute_distances(
+                feature_file, '/features/', taskfilename,
+                distance_file, dtw_cosine_distance,
+                normalized=normalized, n_cpu=1)
+            score.score(taskfilename, distance_file, scorefilename)
+            score.score_with_bounds(taskfilename, feature_file,
+                                    boundsfilename, normalized=normalized)
+            with h5py.File(scorefilename) as s, \
+                    h5py.File(boundsfilename) as b:
+                assert np.array_equal(s['scores'][...], b['scores'][...])
+                assert np.any(b['scores'][...] == 0)
+    finally:
+        try:
+            shutil.rmtree('test_items')
+        except:
+            pass
+
+
+def test_score_with_distance():
+    try:
+        if not os.path.exists('test_items'):
+            os.makedirs('test_items')
+        item_file = 'test_items/data.item'
+        feature_file = 'test_items/data.features'
+        distance_file = 'test_items/data.distance'
+        scorefilename = 'test_items/data.score'
+        fusedfilename = 'test_items/data_fused.score'
+        taskfilename = 'test_items/data.abx'
+        items.generate_db_and_feat(3, 3, 1, item_file, 2, 3, feature_file)
+        task = ABXpy.task.Task(item_file, 'c0', 'c1', 'c2')
+        task.generate_triplets()
+        distances.compute_distances(
+            feature_file, '/features/', taskfilename,
+            distance_file, dtw_cosine_distance,
+            normalized=True, n_cpu=1)
+        score.score(taskfilename, distance_file, scorefilename)
+        score.score_with_distance(taskfilename, feature_file, 'dtw_cosine',
+                                  fusedfilename, normalized=True)
+        with h5py.File(scorefilename) as s, h5py.File(fusedfilename) as f:
+            assert np.array_equal(s['scores'][...], f['scores'][...])
+    finally:
+        try:
+            shutil.rmtree('test_items')
+        except:
+            pass
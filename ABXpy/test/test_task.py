@@ -78,6 +78,28 @@ def test_basic():
             pass
 
 
+# test symmetric pair encoding, pairs verification
+def test_symmetric_pairs():
+    items.generate_testitems(2, 3, name='data.item')
+    try:
+        task = ABXpy.task.Task('data.item', 'c0', 'c1', 'c2')
+        task.generate_triplets(symmetric=True)
+        f = h5py.File('data.abx', 'r')
+        assert f['unique_pairs/data'].attrs['symmetric']
+        # (a, x) and (x, a) share the same code min(a, x) + 4 * max(a, x)
+        pairs = [8, 9, 12, 13]
+        pairs_block0 = get_pairs(f, '0')
+        pairs_block1 = get_pairs(f, '1')
+        assert (set(pairs) == set(pairs_block0[:, 0])), error_pairs
+        assert (set(pairs) == set(pairs_block1[:, 0])), error_pairs
+    finally:
+        try:
+            os.remove('data.abx')
+            os.remove('data.item')
+        except:
+            pass
+
+
 # testing with a list of across attributes, triplets verification
 def test_multiple_across():
     items.generate_testitems(2, 3, name='data.item')
@@ -245,3 +267,194 @@ def test_filter_on_C():
 # test_filter_on_A()
 # test_filter_on_B()
 # test_filter_on_C()
+
+
+# on/across blocks written in several batches, with an on_across_by filter
+# and regressors
+def test_write_batches():
+    items.generate_testitems(3, 4, name='data.item')
+    try:
+        results = []
+        for batch_size in [10 ** 6, 5]:
+            ABXpy.task.WRITE_BATCH_SIZE = batch_size
+            task = ABXpy.task.Task('data.item', 'c0', 'c1', 'c2',
+                                   filters=["[a != 1 for a in c1_1]"],
+                                   regressors=["c1_1", "c3_A"])
+            task.generate_triplets()
+            f = h5py.File('data.abx', 'r')
+            results.append(dict(
+                (name, f[name][...]) for name in
+                ['triplets/data', 'triplets/on_across_block_index',
+                 'triplets/by_index', 'unique_pairs/data']))
+            f.close()
+            os.remove('data.abx')
+        for name in results[0]:
+            assert np.array_equal(results[0][name], results[1][name])
+    finally:
+        ABXpy.task.WRITE_BATCH_SIZE = 10 ** 6
+        for filename in ['data.abx', 'data.item']:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+
+# large on/across blocks enumerated by chunks, with an ABX filter
+def test_chunked_blocks():
+    items.generate_testitems(3, 4, name='data.item')
+    try:
+        results = []
+        for chunk_size in [10 ** 6, 7]:
+            ABXpy.task.CHUNK_SIZE = chunk_size
+            task = ABXpy.task.Task(
+                'data.item', 'c0', 'c1', 'c2',
+                filters=["[a != b for a, b in zip(c3_A, c3_X)]"],
+                regressors=["c3_B"])
+            task.generate_triplets()
+            f = h5py.File('data.abx', 'r')
+            results.append(
+                (f['triplets/on_across_block_index'][...],
+                 dict((by, get_triplets(f, by)) for by in ['0', '1', '2'])))
+            f.close()
+            os.remove('data.abx')
+        # same triplets, in the same regressor groups
+        assert np.array_equal(results[0][0], results[1][0])
+        for by in ['0', '1', '2']:
+            assert tables_equivalent(results[0][1][by], results[1][1][by]), \
+                error_triplets
+    finally:
+        ABXpy.task.CHUNK_SIZE = 10 ** 6
+        for filename in ['data.abx', 'data.item']:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+
+# thresholded groups of triplets, generated by chunks
+def test_chunked_threshold():
+    items.generate_testitems(3, 4, name='data.item')
+    try:
+        results = []
+        for chunk_size in [10 ** 6, 7]:
+            ABXpy.task.CHUNK_SIZE = chunk_size
+            task = ABXpy.task.Task('data.item', 'c0', 'c1', 'c2',
+                                   regressors=["c3_B"])
+            task.generate_triplets(threshold=2)
+            f = h5py.File('data.abx', 'r')
+            index = f['triplets/on_across_block_index'][:, 0]
+            # the start of each group and the end of the last one, in each
+            # on/across block
+            steps = np.diff(index)
+            assert np.all(((steps > 0) & (steps <= 2)) | (index[1:] == 0))
+            results.append(index)
+            f.close()
+            os.remove('data.abx')
+        assert np.array_equal(results[0], results[1])
+    finally:
+        ABXpy.task.CHUNK_SIZE = 10 ** 6
+        for filename in ['data.abx', 'data.item']:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+
+# sampled triplets, generated by chunks
+def test_chunked_sample():
+    items.generate_testitems(3, 4, name='data.item')
+    try:
+        for filters in [None, ["[a != b for a, b in zip(c3_A, c3_X)]"]]:
+            for chunk_size in [10 ** 6, 7]:
+                ABXpy.task.CHUNK_SIZE = chunk_size
+                task = ABXpy.task.Task('data.item', 'c0', 'c1', 'c2',
+                                       filters=filters)
+                task.generate_triplets(sample=50)
+                f = h5py.File('data.abx', 'r')
+                assert f['triplets/data'].shape[0] == 50
+                f.close()
+                os.remove('data.abx')
+    finally:
+        ABXpy.task.CHUNK_SIZE = 10 ** 6
+        for filename in ['data.abx', 'data.item']:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+
+# by blocks generated by several worker processes
+def test_parallel_by_blocks():
+    items.generate_testitems(3, 4, name='data.item')
+    try:
+        results = []
+        for n_cpu in [1, 2]:
+            task = ABXpy.task.Task('data.item', 'c0', 'c1', 'c2',
+                                   filters=["[a != 1 for a in c1_1]"],
+                                   regressors=["c1_1", "c3_A"])
+            task.generate_triplets(n_cpu=n_cpu)
+            f = h5py.File('data.abx', 'r')
+            result = dict(
+                (name, f[name][...]) for name in
+                ['triplets/data', 'triplets/on_across_block_index',
+                 'triplets/by_index', 'unique_pairs/data', 'bys'])
+            result['attrs'] = dict(f['unique_pairs'].attrs.items())
+
+            def add_regressor(name, obj):
+                if isinstance(obj, h5py.Dataset):
+                    result['regressors/' + name] = obj[...]
+            f['regressors'].visititems(add_regressor)
+            results.append(result)
+            f.close()
+            os.remove('data.abx')
+        assert sorted(results[0]) == sorted(results[1])
+        for name in results[0]:
+            if name == 'attrs':
+                for by in results[0][name]:
+                    assert np.array_equal(results[0][name][by],
+                                          results[1][name][by])
+            else:
+                assert np.array_equal(results[0][name], results[1][name])
+    finally:
+        for filename in ['data.abx', 'data.item']:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+
+# exact number of triplets with singleton and ABX filters, counted without
+# generating the triplets
+def test_filtered_counts():
+    items.generate_testitems(3, 4, name='data.item')
+    try:
+        for filters in [["[a != 1 for a in c3_A]", "[a == 0 for a in c3_X]"],
+                        ["[a != 2 for a in c3_B]",
+                         "[a != b for a, b in zip(c3_A, c3_X)]"]]:
+            for chunk_size in [10 ** 6, 7]:
+                ABXpy.task.CHUNK_SIZE = chunk_size
+                task = ABXpy.task.Task('data.item', 'c0', 'c1', 'c2',
+                                       filters=filters)
+                task.generate_triplets()
+                f = h5py.File('data.abx', 'r')
+                assert task.stats['nb_triplets'] == \
+                    f['triplets/data'].shape[0]
+                f.close()
+                os.remove('data.abx')
+    finally:
+        ABXpy.task.CHUNK_SIZE = 10 ** 6
+        for filename in ['data.abx', 'data.item']:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+
+# a filter on the on/across/by values that is not computed row by row must
+# give the same result when the blocks of a by block are processed together
+def test_filter_not_rowwise():
+    items.generate_testitems(2, 4, name='data.item')
+    try:
+        results = []
+        # comparing to the max over the block always holds
+        for filters in [None, ["[a == max(c1_1) for a in c1_1]"]]:
+            task = ABXpy.task.Task('data.item', 'c0', 'c1', 'c2',
+                                   filters=filters)
+            task.generate_triplets(output='data.abx')
+            f = h5py.File('data.abx', 'r')
+            results.append(f['triplets/data'][...])
+            f.close()
+            os.remove('data.abx')
+        assert np.array_equal(results[0], results[1]), error_triplets
+    finally:
+        for filename in ['data.abx', 'data.item']:
+            if os.path.exists(filename):
+                os.remove(filename)
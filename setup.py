@@ -6,6 +6,7 @@ from distutils.core import Command
 from distutils.extension import Extension
 from Cython.Build import cythonize
 import os
+import sys
 import numpy
 
 
@@ -31,9 +32,14 @@ class PyTest(Command):
 path = os.path.join(os.path.dirname(os.path.realpath(__file__)),
                     'ABXpy/distances/metrics/install')
 lib = os.path.dirname(path)
+sys.path.insert(0, path)
+from openmp import openmp_flags
+# OpenMP is used to compute the pairs of dtw_batch in parallel, if available
+openmp = openmp_flags()
 extension = Extension("ABXpy.distances.metrics.dtw",
                       sources=[os.path.join(path, "dtw.pyx")],
-                      extra_compile_args=["-O3"],
+                      extra_compile_args=["-O3"] + openmp,
+                      extra_link_args=openmp,
                       include_dirs=[numpy.get_include()])
 
 setup(